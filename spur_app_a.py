@@ -18,51 +18,49 @@ import sys
 #sys.setdefaultencoding('utf-8')
 import time
 import json
-import pickle
 import struct
 import base64
 import random
+import hashlib
+from functools import partial
+from binascii import hexlify
 from cbcommslib import CbApp, CbClient
 from cbconfig import *
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from subprocess import check_output
-
-FUNCTIONS = {
-    "include_req": 0x00,
-    "s_include_req": 0x01,
-    "include_grant": 0x02,
-    "reinclude": 0x04,
-    "config": 0x05,
-    "send_battery": 0x06,
-    "alert": 0x09,
-    "woken_up": 0x07,
-    "ack": 0x08,
-    "beacon": 0x0A,
-    "start": 0x0B,
-    "nack": 0x0C,
-    "include_not": 0x0D,
-    "configuring": 0x0E,
-    "reset": 0xFF
-}
-Y_STARTS = (
-    (38, 0, 0 ,0, 0),
-    (18, 56, 0, 0, 0),
-    (4, 34, 64, 0, 0),
-    (4, 26, 48, 70, 0),
-    (0, 20, 40, 60, 80)
-);
+from spur_queue import RadioQueue, packFrame, QUANTUM
+from spur_codec import encodeFrame, decodeFrame
+from spur_screens import ScreenCache
+from spur_log import Logger, lazy
+from spur_journal import StateJournal
+from spur_deadlines import Deadlines
+from spur_scheduler import TxScheduler
+from spur_rssi import RssiRequests, RssiCache, RSSI_CACHE_TTL
+from spur_uplink import Uplink, UPLINK_BATCH_SIZE, UPLINK_LATENCY
+from spur_metrics import Metrics, ATTEMPT_BUCKETS, BYTE_BUCKETS, LAG_BUCKETS
+from spur_nodes import NodeTable
+from spur_links import LinkEstimator
+from spur_shards import ShardTable, SHARD_OVERLOAD
+from spur_slots import WakeupPlanner, WAKEUP_JITTER
+from spur_workers import Workers
+from spur_grants import GrantBatcher, GRANT, NOT, GRANT_ADDRESS
+from spur_memory import MemoryAccount
+from spur_trace import TraceWriter, INPUTS, CONFIGURE, STATE, ADAPTOR_OUT, CLIENT_OUT, TRACE_MAX_BYTES
 
 SPUR_ADDRESS        = int(CB_BID[3:])
 CHECK_START_DELAY   = 10
 CHECK_INTERVAL      = 900
 FAST_CHECK_INTERVAL = 60
 TIME_TO_FIRST_CHECK = 60               # Time from start to sending first status message
-GRANT_ADDRESS       = 0xBB00
 PRESSED_WAKEUP      = 5*60              # How long node should sleep for in pressed state, seconds/2
 BEACON_START_DELAY  = 5                 # Delay before starting to send beacons to allow other things to start
 GRACE_TIME_MULT     = 1.2               # Time to wait after we should have heard from node before reporting it missing
 MONITOR_INTERVAL    = 10                # Check to see if nodes are overdue in waking up at this interval
 FAILS_BEFORE_REMOVE = 9                 # App tries to send to a button this many times before removing all messages for that button
+FRAME_BUDGET        = 60                # Send max of this many bytes in a frame if more than one message sent
+EVICT_INTERVAL      = 3600              # How often nodes that have been gone too long are looked for, seconds
+INACTIVE_NODE_TTL   = 7*86400           # Forget all but the address of a node that is not active on this bridge after this long, seconds
+MAX_INACTIVE_NODES  = 5000              # Forget the least recently seen nodes that are not active on this bridge beyond this many
 config              = {
                         "nodes": [ ]
 }
@@ -72,39 +70,95 @@ class App(CbApp):
     def __init__(self, argv):
         self.appClass           = "control"
         self.state              = "stopped"
-        self.id2addr            = {}          # Node id to node address mapping
-        self.id2addr[0]         = 0           # For including
-        self.addr2id            = {}          # Node address to node if mapping
-        self.addr2id[0]         = 0
-        self.activeNodes        = []
-        self.excludedNodes      = []
-        self.messageQueue       = []
-        self.sentTo             = []
-        self.includeGrants      = []
-        self.includeReqMessage  = {}
-        self.nodeConfig         = {} 
-        self.wakeups            = {}
-        self.wakeupCount        = {}
-        self.beaconCalled       = 0
-        self.configuring        = []
-        self.sendingConfig      = []
-        self.buttonState        = {}
-        self.requestBatteries   = []
-        self.nextWakeupTime     = {}
-        self.lastAlertType      = {}
-        self.alert0AfterStart   = []
-        self.beaconInterval     = 6
-        self.beaconRunning      = False
-        self.findingRssiAddr    = None
-        self.doingWakeup        = False
+        self.seed               = config.get("random_seed", random.randrange(1 << 32))  # Recorded in traces
+        self.nodes              = NodeTable()
+        self.memory             = MemoryAccount()
+        self.workers            = Workers(threads.deferToThread, self.cbLog)
+        self.shards             = ShardTable(config.get("channels"), config.get("shard_overload", SHARD_OVERLOAD))
+        self.addShard()
+        self.rssiCache          = RssiCache(config.get("rssi_cache_ttl", RSSI_CACHE_TTL))
+        self.links              = LinkEstimator(self.rssiCache.peek)
+        self.screenCache        = ScreenCache(run=self.workers.run)
+        self.nextWakeupTime     = Deadlines()
+        self.wakeupPlanner      = WakeupPlanner(config.get("wakeup_jitter", WAKEUP_JITTER))
         self.lastClientMessage  = time.time()
         self.connected          = False
+        self.logger             = Logger(self.cbLog, CB_LOGGING_LEVEL, config.get("log_levels"))
+        self.metrics            = Metrics()
+        self.monitorDue         = None
+        self.metrics.gauge("queue_depth", lambda: sum(len(s.radioQueue) for s in self.shards))
+        self.metrics.gauge("queued_nodes", lambda: sum(len(s.radioQueue.pending) for s in self.shards))
+        self.metrics.gauge("active_nodes", lambda: len(self.nodes.active))
+        self.metrics.gauge("rssi_cache", lambda: {"hits": self.rssiCache.hits, "misses": self.rssiCache.misses})
+        self.metrics.gauge("rssi_timeouts", lambda: sum(s.rssiRequests.timeouts for s in self.shards))
+        self.metrics.gauge("rssi_late_discarded", lambda: sum(s.rssiRequests.discarded for s in self.shards))
+        self.metrics.gauge("links", self.links.stats)
+        self.metrics.gauge("shards", self.shards.stats)
+        self.metrics.gauge("wakeup_slots", self.wakeupPlanner.stats)
+        self.metrics.gauge("workers", self.workers.stats)
+        self.metrics.gauge("screen_cache", self.screenCache.stats)
+        self.grantBatcher       = GrantBatcher(self.formatRadioMessage, FRAME_BUDGET, config.get("batch_grants", False))
+        self.metrics.gauge("grants", self.grantBatcher.stats)
+        self.metrics.gauge("memory_entries", self.memory.entries)
+        self.addMemoryAccounts()
+        self.trace              = None
+        self.clientHandlers     = {     # Client message function: handler(message)
+            "include_grant": self.onIncludeGrant,
+            "include_not": self.onIncludeNot,
+            "config": self.onConfig,
+            "send_battery": self.onSendBattery,
+            "update_address": self.onUpdateAddress,
+            "remove_button": self.onRemoveButton,
+            "assign_node": self.onAssignNode,
+            "reset": self.onReset,
+            "get_metrics": self.onGetMetrics,
+            "get_memory": self.onGetMemory
+        }
         #self.testCount         = 0           # Test use only
         #self.ackCount          = 0           # Used purely for test of nack
 
         # Super-class init must be called
         CbApp.__init__(self, argv)
 
+    def addShard(self):
+        shard = self.shards.add()
+        shard.radioQueue = RadioQueue(quantum=config.get("queue_quantum", QUANTUM))
+        shard.txScheduler = TxScheduler(reactor.callLater, partial(self.sendQueued, shard), partial(self.nextTxDue, shard), \
+                                        lag=self.onTickLag, rng=random.Random(self.seed + len(self.shards)))
+        shard.rssiRequests = RssiRequests(partial(self.sendRssiRequest, shard), reactor.callLater)
+        self.memory.add("radio_queue.{}".format(shard.index), lambda: shard.radioQueue.fifos)
+        return shard
+
+    def addMemoryAccounts(self):
+        """ Registers the per-node structures for the memory report. Indexes of objects counted elsewhere are not deep. """
+        self.memory.add("nodes", lambda: self.nodes.byID)
+        self.memory.add("node_addrs", lambda: self.nodes.byAddr, deep=False)
+        self.memory.add("dormant_nodes", lambda: self.nodes.dormant)
+        for flag in NodeTable.ID_FLAGS + NodeTable.ADDR_FLAGS:
+            self.memory.add("flag." + flag, partial(getattr, self.nodes, flag))
+        self.memory.add("next_wakeup_time", lambda: self.nextWakeupTime.times)
+        self.memory.add("next_wakeup_heap", lambda: self.nextWakeupTime.heap)
+        self.memory.add("wakeup_slots", lambda: self.wakeupPlanner.expected)
+        self.memory.add("wakeup_slot_counts", lambda: self.wakeupPlanner.counts)
+        self.memory.add("rssi_cache", lambda: self.rssiCache.entries)
+        self.memory.add("links", lambda: self.links.links)
+        self.memory.add("shard_addrs", lambda: self.shards.byAddr, deep=False)
+        self.memory.add("include_shards", lambda: self.shards.includes, deep=False)
+        self.memory.add("screen_cache", lambda: self.screenCache.screens)
+
+    def startTrace(self, path, managerConfig):
+        """ Records the app's inputs and outputs to path, for spur_replay.py, starting with managerConfig. """
+        try:
+            self.trace = TraceWriter(path, self.cbLog, config.get("trace_max_bytes", TRACE_MAX_BYTES))
+            for name, kind in INPUTS.items():
+                setattr(self, name, self.trace.wrap(kind, getattr(self, name)))
+            self.sendMessage = self.trace.wrap(ADAPTOR_OUT, self.sendMessage)
+            self.trace.write(CONFIGURE, (managerConfig,))
+            self.metrics.gauge("trace", self.trace.stats)
+            self.cbLog("info", "Recording trace to {}".format(path))
+        except Exception as ex:
+            self.cbLog("warning", "Problem starting trace. Type: " + str(type(ex)) + ", exception: " +  str(ex.args))
+
     def setState(self, action):
         self.state = action
         msg = {"id": self.id,
@@ -112,45 +166,36 @@ class App(CbApp):
                "state": self.state}
         self.sendManagerMessage(msg)
 
-    def save(self):
-        state = {
-            "id2addr": self.id2addr,
-            "addr2id": self.addr2id,
-            "activeNodes": self.activeNodes,
-            "excludedNodes": self.excludedNodes,
-            "buttonState": self.buttonState,
-            "wakeupCount": self.wakeupCount,
-            "wakeups": self.wakeups
-        }
+    def save(self, nodeID=None, wait=False):
+        """ Journals the state of nodeID, or writes a complete snapshot if nodeID is None.
+            Writing is done in a worker thread unless wait is set.
+        """
         try:
-            with open(self.saveFile, 'w') as f:
-                pickle.dump(state, f)
-                #self.cbLog("debug", "saving state: " + str(json.dumps(state, indent=4)))
-                self.cbLog("debug", "saving state: " + str(state))
+            if nodeID is None:
+                self.journal.compact(wait)
+                self.logger.debug("client", "saved state, {} nodes", len(self.nodes))
+            else:
+                self.journal.record(nodeID)
         except Exception as ex:
             self.cbLog("warning", "Problem saving state. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
 
     def loadSaved(self):
         try:
-            if os.path.isfile(self.saveFile):
-                with open(self.saveFile, 'r') as f:
-                    state = pickle.load(f)
-                self.cbLog("debug", "Loaded saved state: " + str(json.dumps(state, indent=4)))
-                self.id2addr = state["id2addr"]
-                self.addr2id = state["addr2id"]
-                self.activeNodes = state["activeNodes"]
-                self.buttonState = state["buttonState"]
-                self.wakeupCount = state["wakeupCount"]
-                self.wakeups = state["wakeups"]
-                try:
-                    self.excludedNodes = state["exclduedNodes"]
-                except:
+            state, records = self.journal.load()
+            if state:
+                self.nodes.load(state)
+                if "excludedNodes" not in state:
                     self.cbLog("info", "No excludedNodes in saved state")
+            for nodeID, record in records:
+                self.nodes.applyRecord(nodeID, record)
+            self.cbLog("info", "Loaded saved state, {} nodes, {} journal records".format(len(self.nodes), len(records)))
         except Exception as ex:
             self.cbLog("warning", "Problem loading saved state. Exception. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
 
     def onStop(self):
-        self.save()
+        self.save(wait=True)
+        if self.trace:
+            self.trace.close()
 
     def reportRSSI(self, rssi):
         msg = {"id": self.id,
@@ -173,135 +218,181 @@ class App(CbApp):
 
     def onClientMessage(self, message):
         try:
-            self.cbLog("debug", "onClientMessage, message: " + str(json.dumps(message, indent=4)))
-            self.connected = True
+            self.logger.debug("client", "onClientMessage, message: {}", lazy(json.dumps, message, indent=4))
+            if not self.connected:
+                self.connected = True
+                for shard in self.shards:
+                    shard.txScheduler.kick()
             self.lastClientMessage = time.time()
             if "function" in message:
-                if message["function"] == "include_grant":
-                    try:
-                        nodeID = int(message["id"])
-                        addr = int(message["address"])
-                        self.cbLog("debug", "onClientMessage, include_grant. nodeID: {}, addr: {}".format(nodeID, addr))
-                        self.cbLog("debug", "{} added to active_nodes: {}".format(nodeID, self.activeNodes))
-                        if nodeID not in self.activeNodes:
-                            self.activeNodes.append(nodeID)
-                        if nodeID in self.excludedNodes:
-                            self.excludedNodes.remove(nodeID)
-                        self.id2addr[nodeID] = addr
-                        self.addr2id[addr] = nodeID
-                        self.nextWakeupTime[addr] = int(time.time() + 720)  # To pevent spurious exlude_reqs
-                        self.save()
-                        data = struct.pack(">IH", nodeID, self.id2addr[nodeID])
-                        msg = self.formatRadioMessage(GRANT_ADDRESS, "include_grant", 0, data)  # Wakeup = 0 after include_grant (stay awake 10s)
-                        # If everything happens too quickly, a button may not be ready for include_grant, so add a delay
-                        reactor.callLater(0.5, self.queueRadio, msg, self.id2addr[nodeID], "include_grant")
-                        self.cbLog("debug", "onClientMessage, adding {} to includeGrants".format(self.id2addr[nodeID]))
-                        self.includeGrants.append(self.id2addr[nodeID])
-                        if self.id2addr[nodeID] in self.requestBatteries:
-                            self.requestBatteries.remove(self.id2addr[nodeID])
-                    except Exception as ex:
-                        self.cbLog("warning", "onClientMessage, problem processing include_grant. Type: {}. Exception: {}".format(type(ex), ex.args))
-                elif message["function"] == "include_not":
-                    try:
-                        nodeID = int(message["id"])
-                        data = struct.pack(">I", nodeID)
-                        msg = self.formatRadioMessage(GRANT_ADDRESS, "include_not", 0, data)  # Wakeup = 0 after include_grant (stay awake 10s)
-                        self.queueRadio(msg, 0x00, "include_not")
-                        reactor.callLater(2, self.queueRadio, msg, 0x00, "include_not")
-                    except Exception as ex:
-                        self.cbLog("warning", "onClientMessage, problem processing include_not. Type: {}. Exception: {}".format(type(ex), ex.args))
-                elif message["function"] == "config":
-                    try:
-                        #self.cbLog("debug", "onClientMessage, message[node]: " + str(message["id"]))
-                        nodeID = int(message["id"])
-                        nodeAddr = self.id2addr[nodeID]
-                        if "name" in message["config"]:  # Update everything, so remove any config that's already waiting
-                            self.cbLog("debug", "onClientMessage, complete new config for: {}".format(nodeAddr))
-                            self.nodeConfig[nodeAddr] = message["config"]
-                        elif nodeAddr in self.nodeConfig:  # We already have some partial config
-                            self.cbLog("debug", "onClientMessage, new partial config for existing: {}".format(nodeAddr))
-                            for c in message["config"]:
-                                self.cbLog("debug", "onClientMessage, c in message[config]: {}".format(c))
-                                self.nodeConfig[nodeAddr][c] = message["config"][c]
-                        else:  # Partial config for a node we don't have any existing config for
-                            self.cbLog("debug", "onClientMessage, new partial config for new: {}".format(nodeAddr))
-                            self.nodeConfig[nodeAddr] = message["config"]
-                        if nodeID not in self.configuring:
-                            self.configuring.append(nodeID)  # Causes a start to be sent to node on complete config update
-                            # Because buttons don't send an alert on entering state zero after an auto-reset
-                            if "reassign" in message["config"]:
-                                self.buttonState[nodeAddr] = 0  # Needed to get a wakeup value that's not the default
-                                self.cbLog("debug", "Config message, not sending alert 0 because it's a reassign")
-                            elif "update" not in message["config"]:  # Don't send alert 0 if this is a display update
-                                self.alert0AfterStart.append(nodeAddr)  # Alert 0 will be sent to client after start has been ack'd
-                                self.buttonState[nodeAddr] = 0
-                                self.cbLog("debug", "onClientMessage, {} added to alter0AfterStart".format(self.alert0AfterStart))
-                        self.cbLog("debug", "onClentMessage, nodeConfig: " + str(json.dumps(self.nodeConfig, indent=4)))
-                    except Exception as ex:
-                        self.cbLog("warning", "onClientMessage, problem processing config. Type: {}. Exception: {}".format(type(ex), ex.args))
-                elif message["function"] == "send_battery":
-                    try:
-                        self.cbLog("debug", "onClientMessage, send_battery for {}".format(message["id"]))
-                        nodeAddr = self.id2addr[int(message["id"])]
-                        if nodeAddr not in self.requestBatteries:
-                            self.requestBatteries.append(nodeAddr)
-                            self.cbLog("debug", "onClientMessage, added {} to requestBatteries".format(nodeAddr))
-                        else:
-                            self.cbLog("debug", "onClientMessage, requestBatteries for {}, but already one in queue".format(nodeAddr))
-                    except Exception as ex:
-                        self.cbLog("warning", "onClientMessage, problem processing send_battery. Type: {}. Exception: {}".format(type(ex), ex.args))
-                elif message["function"] == "update_address":
-                    try:
-                        self.cbLog("debug", "update_address, id2addr before: {}".format(self.id2addr))
-                        nodeID = int(message["id"])
-                        addr = int(message["address"])
-                        self.id2addr[nodeID] = addr
-                        self.addr2id[addr] = nodeID
-                        self.cbLog("debug", "update_address, id2addr after: {}".format(self.id2addr))
-                        self.save()
-                    except Exception as ex:
-                        self.cbLog("warning", "onClientMessage, problem processing update_address. Type: {}. Exception: {}".format(type(ex), ex.args))
-                elif message["function"] == "remove_button":
-                    try:
-                        self.cbLog("info", "remove_button: {}".format(message["id"]))
-                        self.removeNodeMessages(message["id"])
-                        self.save()
-                    except Exception as ex:
-                        self.cbLog("warning", "onClientMessage, problem processing remove_button. Type: {}. Exception: {}".format(type(ex), ex.args))
-                elif message["function"] == "assign_node":
-                    try:
-                        self.cbLog("debug", "assign_node, node: {}, bridge: {}".format(message["id"], message["bid"]))
-                        self.cbLog("debug", "assign_node, SPUR_ADDRESS: {}, activeNodes: {}".format(SPUR_ADDRESS, self.activeNodes))
-                        nodeID = int(message["id"])
-                        if int(message["bid"][3:]) == SPUR_ADDRESS:
-                            if nodeID not in self.activeNodes:
-                                self.cbLog("info", "assign_node {} now active on this bridge".format(nodeID))
-                                self.activeNodes.append(nodeID)
-                                self.nextWakeupTime[self.id2addr[nodeID]] = time.time() + 86396  # Just in case config not received - just short of one day
-                                self.save()
-                            else:
-                                self.cbLog("info", "assign_node {} assigned to this bridge, but was already active on it".format(nodeID))
-                        else:
-                            if nodeID in self.activeNodes:
-                                self.activeNodes.remove(nodeID)
-                                self.removeNodeMessages(nodeID)
-                                if nodeID in self.excludedNodes:
-                                    self.excludedNodes.remove(nodeID)
-                                self.doingWakeup = False # In case we were doing this at the time (could be quite likely)
-                                self.cbLog("info", "{} deactivated this bridge and doingWakeup set to false".format(nodeID))
-                                self.save()
-                    except Exception as ex:
-                        self.cbLog("warning", "onClientMessage, problem processing assign_node. Type: {}. Exception: {}".format(type(ex), ex.args))
-                elif message["function"] == "reset":
-                    try:
-                        nodeAddr = self.id2addr[int(message["id"])]
-                        msg = self.formatRadioMessage(nodeAddr, "reset", 0)
-                        self.queueRadio(msg, nodeAddr, "reset")
-                    except Exception as ex:
-                        self.cbLog("warning", "onClientMessage, problem processing reset. Type: {}. Exception: {}".format(type(ex), ex.args))
+                if message["function"] == "batch":
+                    self.clientBatch(message)
+                else:
+                    self.clientCommand(message)
         except Exception as ex:
             self.cbLog("warning", "onClientMessage exception. Exception. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
 
+    def clientCommand(self, message):
+        """ Calls the handler for message's function. Returns "ok", "unknown" or "error". """
+        function = message.get("function")
+        handler = self.clientHandlers.get(function)
+        if handler is None:
+            self.logger.debug("client", "onClientMessage, unknown function: {}", function)
+            return "unknown"
+        try:
+            handler(message)
+            return "ok"
+        except Exception as ex:
+            self.cbLog("warning", "onClientMessage, problem processing {}. Type: {}. Exception: {}".format(function, type(ex), ex.args))
+            return "error"
+
+    def clientBatch(self, message):
+        """ Processes {"function": "batch", "messages": [...]} in one pass, writes the journal once
+            for all of them, and sends a batch_result with the result of each command in order.
+        """
+        commands = message.get("messages") or []
+        results = []
+        counts = {}
+        for m in commands:
+            if isinstance(m, dict) and m.get("function") != "batch":
+                result = self.clientCommand(m)
+            else:
+                result = "error"  # Not a command, or a nested batch
+                m = m if isinstance(m, dict) else {}
+            counts[result] = counts.get(result, 0) + 1
+            results.append({"function": m.get("function"), "id": m.get("id"), "result": result})
+        written = self.journal.flush()
+        self.metrics.inc("client_batches")
+        self.metrics.inc("client_batch_commands", len(commands))
+        self.logger.info("client", "batch of {} commands, {}, {} nodes journalled", len(commands), counts, written)
+        msg = {"function": "batch_result", "results": results, "counts": counts}
+        if "ref" in message:
+            msg["ref"] = message["ref"]
+        self.uplink.send(msg)
+
+    def onIncludeGrant(self, message):
+        nodeID = int(message["id"])
+        addr = int(message["address"])
+        self.logger.debug("client", "onClientMessage, include_grant. nodeID: {}, addr: {}", nodeID, addr)
+        self.logger.debug("client", "{} added to active nodes, {} active", nodeID, len(self.nodes.active))
+        self.nodes.add(nodeID, addr)
+        self.shards.assign(addr, self.shards.popInclude(nodeID))
+        self.nodes.active.add(nodeID)
+        self.nodes.excluded.discard(nodeID)
+        self.nextWakeupTime[addr] = int(time.time() + 720)  # To pevent spurious exlude_reqs
+        self.save(nodeID)
+        data = GRANT.pack(nodeID, addr)
+        msg = self.formatRadioMessage(GRANT_ADDRESS, "include_grant", 0, data)  # Wakeup = 0 after include_grant (stay awake 10s)
+        # If everything happens too quickly, a button may not be ready for include_grant, so add a delay
+        reactor.callLater(0.5, self.queueGrant, msg, addr, data)
+        self.logger.debug("client", "onClientMessage, adding {} to includeGrants", addr)
+        self.nodes.includeGrants.add(addr)
+        self.nodes.requestBatteries.discard(addr)
+
+    def onIncludeNot(self, message):
+        nodeID = int(message["id"])
+        data = NOT.pack(nodeID)
+        msg = self.formatRadioMessage(GRANT_ADDRESS, "include_not", 0, data)  # Wakeup = 0 after include_grant (stay awake 10s)
+        shard = self.shards.popInclude(nodeID)
+        self.queueRadio(msg, 0x00, "include_not", shard)["record"] = data  # The first copy may be batched
+        reactor.callLater(2, self.queueRadio, msg, 0x00, "include_not", shard)
+
+    def onConfig(self, message):
+        #self.cbLog("debug", "onClientMessage, message[node]: " + str(message["id"]))
+        nodeID = int(message["id"])
+        node = self.nodes.byID[nodeID]
+        nodeAddr = node.addr
+        if "name" in message["config"]:  # Update everything, so remove any config that's already waiting
+            self.logger.debug("client", "onClientMessage, complete new config for: {}", nodeAddr)
+            node.config = message["config"]
+        elif node.config is not None:  # We already have some partial config
+            self.logger.debug("client", "onClientMessage, new partial config for existing: {}", nodeAddr)
+            for c in message["config"]:
+                self.logger.debug("client", "onClientMessage, c in message[config]: {}", c)
+                node.config[c] = message["config"][c]
+        else:  # Partial config for a node we don't have any existing config for
+            self.logger.debug("client", "onClientMessage, new partial config for new: {}", nodeAddr)
+            node.config = message["config"]
+        for c in message["config"]:
+            if c[0] == "D":
+                self.screenCache.prepare(message["config"][c])  # Compiled before the button wakes up
+        if nodeID not in self.nodes.configuring:
+            self.nodes.configuring.add(nodeID)  # Causes a start to be sent to node on complete config update
+            # Because buttons don't send an alert on entering state zero after an auto-reset
+            if "reassign" in message["config"]:
+                node.buttonState = 0  # Needed to get a wakeup value that's not the default
+                self.logger.debug("client", "Config message, not sending alert 0 because it's a reassign")
+            elif "update" not in message["config"]:  # Don't send alert 0 if this is a display update
+                self.nodes.alert0AfterStart.add(nodeAddr)  # Alert 0 will be sent to client after start has been ack'd
+                node.buttonState = 0
+                self.logger.debug("client", "onClientMessage, {} added to alter0AfterStart", nodeAddr)
+        self.logger.debug("client", "onClentMessage, nodeConfig: {}", lazy(json.dumps, node.config, indent=4))
+
+    def queueGrant(self, msg, addr, record):
+        m = self.queueRadio(msg, addr, "include_grant")
+        m["record"] = record  # Sent instead of msg in a batched grant frame
+
+    def onSendBattery(self, message):
+        self.logger.debug("client", "onClientMessage, send_battery for {}", message["id"])
+        nodeAddr = self.nodes.addr(int(message["id"]))
+        if nodeAddr not in self.nodes.requestBatteries:
+            self.nodes.requestBatteries.add(nodeAddr)
+            self.logger.debug("client", "onClientMessage, added {} to requestBatteries", nodeAddr)
+        else:
+            self.logger.debug("client", "onClientMessage, requestBatteries for {}, but already one in queue", nodeAddr)
+
+    def onUpdateAddress(self, message):
+        nodeID = int(message["id"])
+        addr = int(message["address"])
+        self.logger.debug("client", "update_address, {}: {} to {}", nodeID, lazy(self.nodes.addr, nodeID) if nodeID in self.nodes else None, addr)
+        old = self.nodes.get(nodeID)
+        if old is not None and old.addr != addr:
+            oldAddr = old.addr
+            self.shards.remove(oldAddr)  # Assigned again when the button is heard at its new address
+            self.rssiCache.remove(oldAddr)
+            self.links.remove(oldAddr)
+            self.wakeupPlanner.forget(oldAddr)
+            deadline = self.nextWakeupTime.pop(oldAddr)
+            if deadline is not None:
+                self.nextWakeupTime[addr] = deadline
+        self.nodes.add(nodeID, addr)
+        self.save(nodeID)
+
+    def onRemoveButton(self, message):
+        self.logger.info("client", "remove_button: {}", message["id"])
+        self.removeNodeMessages(message["id"])
+
+    def onAssignNode(self, message):
+        self.logger.debug("client", "assign_node, node: {}, bridge: {}", message["id"], message["bid"])
+        self.logger.debug("client", "assign_node, SPUR_ADDRESS: {}, active nodes: {}", SPUR_ADDRESS, len(self.nodes.active))
+        nodeID = int(message["id"])
+        if int(message["bid"][3:]) == SPUR_ADDRESS:
+            if nodeID not in self.nodes.active:
+                node = self.nodes.revive(nodeID)  # Raises KeyError, before anything is changed, if the node is not known
+                self.logger.info("client", "assign_node {} now active on this bridge", nodeID)
+                self.nodes.active.add(nodeID)
+                self.nextWakeupTime[node.addr] = time.time() + 86396  # Just in case config not received - just short of one day
+                self.save(nodeID)
+            else:
+                self.logger.info("client", "assign_node {} assigned to this bridge, but was already active on it", nodeID)
+        else:
+            if nodeID in self.nodes.active:
+                self.removeNodeMessages(nodeID)
+                self.logger.info("client", "{} deactivated this bridge", nodeID)
+                self.save(nodeID)
+
+    def onReset(self, message):
+        nodeAddr = self.nodes.addr(int(message["id"]))
+        self.nodes.at(nodeAddr).shown = None  # Screens are lost on reset
+        msg = self.formatRadioMessage(nodeAddr, "reset", 0)
+        self.queueRadio(msg, nodeAddr, "reset")
+
+    def onGetMetrics(self, message):
+        self.uplink.send({"function": "metrics", "metrics": self.metricsReport()})
+
+    def onGetMemory(self, message):
+        self.uplink.send({"function": "memory", "memory": self.memory.report()})
+
     def sendConfig(self, nodeAddr):
         #self.cbLog("debug", "sendConfig, nodeAddr: " + str(nodeAddr) + ", nodeConfig: " + str(json.dumps(self.nodeConfig, indent=4)))
         #self.cbLog("debug", "sendConfig, type of nodeAddr: " + type(nodeAddr).__name__)
@@ -310,35 +401,39 @@ class App(CbApp):
         statesInConfig = False
         appValue = False
         appValueMessage = None
-        if nodeAddr not in self.includeGrants: # Only send configuring message if not part of include_grant process
+        node = self.nodes.at(nodeAddr)
+        if node is None or node.config is None:  # Node removed since sendConfig was scheduled
+            self.nodes.sendingConfig.discard(nodeAddr)
+            return
+        nodeConfig = node.config
+        if nodeAddr not in self.nodes.includeGrants: # Only send configuring message if not part of include_grant process
             #self.cbLog("debug", "sendConfig, sending configuring message to: {} ".format(nodeAddr))
             #msg = self.formatRadioMessage(nodeAddr, "configuring", 0, formatMessage)
             #self.queueRadio(msg, nodeAddr, "configuring")
             pass
         else:
-            self.includeGrants.remove(nodeAddr)
-        reassign = True if "reassign" in self.nodeConfig[nodeAddr] else False
-        self.cbLog("debug", "sendConfig, reassign: {}".format(reassign))
+            self.nodes.includeGrants.remove(nodeAddr)
+        reassign = True if "reassign" in nodeConfig else False
+        self.logger.debug("config", "sendConfig, reassign: {}", reassign)
         if reassign:
-            if PRESSED_WAKEUP > self.nodeConfig[nodeAddr]["reassign"]:
+            if PRESSED_WAKEUP > nodeConfig["reassign"]:
                 wakeup = time.time() + PRESSED_WAKEUP * GRACE_TIME_MULT
             else:
-                wakeup = time.time() + self.nodeConfig[nodeAddr]["reassign"] * GRACE_TIME_MULT # The max wakeup/delay for the button
+                wakeup = time.time() + nodeConfig["reassign"] * GRACE_TIME_MULT # The max wakeup/delay for the button
             self.nextWakeupTime[nodeAddr] = wakeup
-        for m in self.nodeConfig[nodeAddr]:
+            node.shown = None  # The button will be configured by another bridge
+        for m in nodeConfig:
             messageCount += 1
-            self.cbLog("debug", "in m loop, m: " + m)
-            aMessage = False
+            self.logger.debug("config", "in m loop, m: {}", m)
             if m[0] == "D":
-                formatMessage = struct.pack("cBcB", "S", int(m[1:]), "R", 0)
-                aMessage = True
+                formatMessage = self.screenCache.display(int(m[1:]), nodeConfig[m])
             elif m == "name":
                 line = "Spur button"
                 stringLength = len(line) + 1
                 formatString = "cBcBcBcBcB" + str(stringLength) + "sc"
                 formatMessage = struct.pack(formatString, "S", 22, "R", 0, "F", 2, "Y", 10, "C", stringLength, str(line), "\00")
-                line = self.nodeConfig[nodeAddr][m] 
-                self.cbLog("debug", "name: " + line)
+                line = nodeConfig[m] 
+                self.logger.debug("config", "name: {}", line)
                 stringLength = len(line) + 1
                 formatString = "cBcB" + str(stringLength) + "sc"
                 segment = struct.pack(formatString, "Y", 40, "C", stringLength, str(line), "\00")
@@ -350,9 +445,9 @@ class App(CbApp):
                 formatMessage += segment
             elif m[0] == "S":
                 statesInConfig = True
-                self.cbLog("debug", "statesInConfig")
-                s = self.nodeConfig[nodeAddr][m]
-                self.cbLog("debug", "nodeConfig before changing: " + str(json.dumps(s, indent=4)))
+                self.logger.debug("config", "statesInConfig")
+                s = nodeConfig[m]
+                self.logger.debug("config", "nodeConfig before changing: {}", lazy(json.dumps, s, indent=4))
                 if "delayValue" in s:
                     if s["delayValue"] < 4:
                         s["delayValue"] = 4  # To prevent accidental delays of a day
@@ -368,314 +463,238 @@ class App(CbApp):
                     "delayValue", "delayMS", "delayState", "appValue", "appState"):
                     if f not in s:
                         s[f] = 0xFF
-                #self.cbLog("debug", "nodeConfig before sending: " + str(json.dumps(self.nodeConfig[nodeAddr][m], indent=4)))
-                self.cbLog("debug", "nodeConfig before sending: " + str(json.dumps(s, indent=4)))
+                #self.cbLog("debug", "nodeConfig before sending: " + str(json.dumps(nodeConfig[m], indent=4)))
+                self.logger.debug("config", "nodeConfig before sending: {}", lazy(json.dumps, s, indent=4))
                 formatMessage = struct.pack("cBBBBBBBBBBBBBBBB", "M", s["state"], s["state"], s["alert"], s["DoubleLeft"], \
                     s["SingleLeft"], 0xFF, 0xFF, s["SingleRight"], s["DoubleRight"], s["appValue"], s["appState"], \
                     s["delayValue"], s["delayState"], s["delayMS"], 0xFF, 0xFF)
             elif m == "app_value":
                 appValue = True
-                appValueMessage = struct.pack("cB", "A", self.nodeConfig[nodeAddr][m])
-            if aMessage:
-                self.cbLog("debug", "sendConfig, aMessage")
-                display = base64.b64decode(self.nodeConfig[nodeAddr][m])
-                #display = self.nodeConfig[nodeAddr][m]
-                self.cbLog("debug", "sendConfig, display: {}".format(display))
-                lines = display.split("\n")
-                if "{{" in lines[0]:
-                    del(lines[0])  #Remove a "special" first line
-                firstSplit = None 
-                numLines = len(lines)
-                for l in lines:
-                    if "|" in l:
-                       self.cbLog("debug", "Line contains |")
-                       if firstSplit is None:
-                           firstSplit = lines.index(l)
-                       ll = l.decode("utf-8").encode("latin-1", "ignore")
-                       splitLine = ll.split("|")
-                       for s in (0, 1):
-                           splitLine[s] = splitLine[s].lstrip().rstrip()  # Removes whitespace
-                           self.cbLog("debug", "After whitespace removed: " + str(splitLine[s]))
-                           if len(splitLine[s]) > 0:
-                               if splitLine[s][0] == "*":
-                                   splitLine[s] = splitLine[s][1:]
-                                   f = 3
-                               else:
-                                   f = 2
-                           else:
-                               f = 2
-                           self.cbLog("debug", "sendConfig, font: {}, line: {}".format(f, ll))
-                           stringLength = len(splitLine[s]) + 1
-                           y_start =  Y_STARTS[numLines-1][lines.index(l)]
-                           self.cbLog("debug", "sendConfig, string: " + splitLine[s] + ", length: " + str(stringLength))
-                           self.cbLog("debug", "sendConfig, y_start: " + str(y_start))
-                           formatString = "cBcBcB" + str(stringLength) + "sc"
-                           if s == 0:
-                               x = "l"
-                           else:
-                               x = "r"
-                           segment = struct.pack(formatString, "F", f, "Y", y_start, x, stringLength, str(splitLine[s]), "\00")
-                           self.cbLog("debug", "segment: " + str(segment.encode("hex")))
-                           formatMessage += segment
-                    else:
-                        self.cbLog("debug", "sendConfig, line: " + str(l))
-                        if len(l) > 0:
-                            if l[0] == "*":
-                                f = 3
-                                ll = l[1:].decode("utf-8").encode("latin-1", "ignore")
-                            else:
-                                f = 2
-                                ll = l.decode("utf-8").encode("latin-1", "ignore")
-                        else:
-                            f = 2
-                            ll = l.decode("utf-8").encode("latin-1", "ignore")
-                        self.cbLog("debug", "sendConfig, font: {}, line: {}".format(f, ll))
-                        stringLength = len(ll) + 1
-                        y_start =  Y_STARTS[numLines-1][lines.index(l)]
-                        self.cbLog("debug", "sendConfig, y_start: " + str(y_start))
-                        formatString = "cBcBcB" + str(stringLength) + "sc"
-                        segment = struct.pack(formatString, "F", f, "Y", y_start, "C", stringLength, ll, "\00")
-                        formatMessage += segment
-                self.cbLog("debug", "sendConfig, firstSplit: " + str(firstSplit) + ", numLines: " + str(numLines))
-                if firstSplit == 0:
-                    segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 1, "B", 0x62, 0x5C, "X", 2, "Y", 2, "B", 0x60, 0x5A, \
-                                            "X", 0x65, "Y", 1, "B", 0x62, 0x5C, "X", 0x66, "Y", 2, "B", 0x60, 0x5A)  
-                    formatMessage += segment
-                elif numLines == 4:
-                    if firstSplit == 1:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x18, "B", 0x62, 0x48, "X", 2, "Y", 0x19, "B", 0x60, 0x46, \
-                                            "X", 0x65, "Y", 0x18, "B", 0x62, 0x48, "X", 0x66, "Y", 0x19, "B", 0x60, 0x46)  
-                    elif firstSplit == 2:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x2E, "B", 0x62, 0x30, "X", 2, "Y", 0x2F, "B", 0x60, 0x2E, \
-                                            "X", 0x65, "Y", 0x2E, "B", 0x62, 0x30, "X", 0x66, "Y", 0x2F, "B", 0x60, 0x2E)  
-                    elif firstSplit == 3:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x44, "B", 0x62, 0x18, "X", 2, "Y", 0x45, "B", 0x60, 0x16, \
-                                            "X", 0x65, "Y", 0x44, "B", 0x62, 0x18, "X", 0x66, "Y", 0x45, "B", 0x60, 0x16)  
-                    formatMessage += segment
-                elif numLines == 3:
-                    if firstSplit == 1:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x1E, "B", 0x62, 0x40, "X", 2, "Y", 0x1F, "B", 0x60, 0x3E, \
-                                            "X", 0x65, "Y", 0x1E, "B", 0x62, 0x40, "X", 0x66, "Y", 0x1F, "B", 0x60, 0x3E)  
-                    elif firstSplit == 2:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x44, "B", 0x62, 0x18, "X", 2, "Y", 0x45, "B", 0x60, 0x16, \
-                                            "X", 0x65, "Y", 0x44, "B", 0x62, 0x18, "X", 0x66, "Y", 0x45, "B", 0x60, 0x16)  
-                    formatMessage += segment
-                elif numLines == 2:
-                    if firstSplit == 1:
-                        segment = struct.pack("cBcBcBBcBcBcBBcBcBcBBcBcBcBB", "X", 1, "Y", 0x30, "B", 0x62, 0x2F, "X", 2, "Y", 0x31, "B", 0x60, 0x2D, \
-                                            "X", 0x65, "Y", 0x30, "B", 0x62, 0x2F, "X", 0x66, "Y", 0x31, "B", 0x60, 0x2D)  
-                    formatMessage += segment
-                segment = struct.pack("cc", "E", "S") 
-                formatMessage += segment
+                appValueMessage = struct.pack("cB", "A", nodeConfig[m])
             if not appValue:  # Ensures that app_value is sent last
                 if not reassign:
-                    self.cbLog("debug", "Sending to node: {}".format(formatMessage))
-                    self.cbLog("debug", "Sending to node: " + str(formatMessage.encode("hex")))
-                    wakeup = 0
-                    msg = self.formatRadioMessage(nodeAddr, "config", wakeup, formatMessage)
-                    self.queueRadio(msg, int(nodeAddr), "config")
+                    digest = hashlib.sha1(formatMessage).digest()
+                    if self.showing(node, m, digest) == digest:
+                        self.logger.debug("config", "{} unchanged on {}, not sending", m, nodeAddr)
+                        self.metrics.inc("config_unchanged")
+                        self.metrics.inc("config_bytes_saved", len(formatMessage))
+                    else:
+                        self.logger.debug("config", "Sending to node: {}", lazy(hexlify, formatMessage))
+                        wakeup = 0
+                        msg = self.formatRadioMessage(nodeAddr, "config", wakeup, formatMessage)
+                        queued = self.queueRadio(msg, int(nodeAddr), "config")
+                        queued["shows"] = (m, digest)
             else:
                 appValue = False
         if appValueMessage:
             try:
-                self.cbLog("debug", "Sending app_value to node: {}".format(appValueMessage))
-                self.cbLog("debug", "Sending app_value to node: " + str(appValueMessage.encode("hex")))
-                self.wakeupCount[nodeAddr] = 0
+                self.logger.debug("config", "Sending app_value to node: {}", lazy(hexlify, appValueMessage))
+                node.wakeupCount = 0
                 msg = self.formatRadioMessage(nodeAddr, "config", 30, appValueMessage)  # Wakeup after 30s when changing current screen
                 if not reassign:
                     self.queueRadio(msg, int(nodeAddr), "config")
             except Exception as ex:
                 self.cbLog("warning", "sendConfig, expection sending app_value. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
-        nodeID =  self.addr2id[nodeAddr]
+        nodeID = node.id
         try:
-            if nodeID in list(self.configuring):
-                self.cbLog("debug", "Removing nodeID " + str(nodeID) + " from " + str(self.configuring))
+            if nodeID in self.nodes.configuring:
+                self.logger.debug("config", "Removing nodeID {} from configuring", nodeID)
                 if not appValueMessage:
                     msg = self.formatRadioMessage(nodeAddr, "start", PRESSED_WAKEUP, formatMessage)
                     if not reassign:
                         self.queueRadio(msg, nodeAddr, "start")
-                self.configuring.remove(nodeID)
+                self.nodes.configuring.remove(nodeID)
         except Exception as ex:
-            self.cbLog("warning", "sendConfig, expection in removing from self.configuring. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
-        self.cbLog("debug", "sendConfig statesInConfig: {}".format(statesInConfig))
+            self.cbLog("warning", "sendConfig, expection in removing from configuring. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+        self.logger.debug("config", "sendConfig statesInConfig: {}, screenCache: {}", statesInConfig, lazy(self.screenCache.stats))
         if statesInConfig:
-            self.wakeupCount[nodeAddr] = 0
-            for m in self.nodeConfig[nodeAddr]:
+            node.wakeupCount = 0
+            for m in nodeConfig:
                 if m[0] == "S":
-                    if "wakeup" in self.nodeConfig[nodeAddr][m]:
-                        self.cbLog("debug", "sendConfig nodeConfig-alert: {}".format(self.nodeConfig[nodeAddr][m]["alert"]))
-                        self.cbLog("debug", "sendConfig nodeConfig-wakeup: {}".format(self.nodeConfig[nodeAddr][m]["wakeup"]))
-                        self.cbLog("debug", "sendConfig type of nodeAddr: {}".format(type(nodeAddr)))
-                        if nodeAddr not in self.wakeups:
-                            self.wakeups[nodeAddr] = {}
-                        self.wakeups[nodeAddr][self.nodeConfig[nodeAddr][m]["alert"]] = self.nodeConfig[nodeAddr][m]["wakeup"]
+                    if "wakeup" in nodeConfig[m]:
+                        self.logger.debug("config", "sendConfig nodeConfig-alert: {}", nodeConfig[m]["alert"])
+                        self.logger.debug("config", "sendConfig nodeConfig-wakeup: {}", nodeConfig[m]["wakeup"])
+                        self.logger.debug("config", "sendConfig type of nodeAddr: {}", type(nodeAddr))
+                        if node.wakeups is None:
+                            node.wakeups = {}
+                        node.wakeups[nodeConfig[m]["alert"]] = nodeConfig[m]["wakeup"]
                     else:
-                        if nodeAddr not in self.wakeups:
-                            self.wakeups[nodeAddr] = {}
-                        self.wakeups[nodeAddr][self.nodeConfig[nodeAddr][m]["alert"]] = [DEFAULT_WAKEUP_INTERVAL]
-            self.cbLog("debug", "sendConfig added to wakeups nodeAddr: {}, nodeID: {}".format(nodeAddr, nodeID))
-            self.cbLog("debug", "sendConfig wakeups: " + str(json.dumps(self.wakeups, indent=4)))
-            self.cbLog("debug", "sendConfig wakeupCount: " + str(json.dumps(self.wakeupCount, indent=4)))
-        del(self.nodeConfig[nodeAddr])
-        self.sendingConfig.remove(nodeAddr)
+                        if node.wakeups is None:
+                            node.wakeups = {}
+                        node.wakeups[nodeConfig[m]["alert"]] = [DEFAULT_WAKEUP_INTERVAL]
+            self.logger.debug("config", "sendConfig added to wakeups nodeAddr: {}, nodeID: {}", nodeAddr, nodeID)
+            self.logger.debug("config", "sendConfig wakeups: {}", lazy(json.dumps, node.wakeups, indent=4))
+            self.logger.debug("config", "sendConfig wakeupCount: {}", node.wakeupCount)
+            self.save(nodeID)
+        node.config = None
+        self.nodes.sendingConfig.discard(nodeAddr)
+
+    def showing(self, node, key, digest):
+        """ The digest of what node will show for config key once its queue is sent, or None if not known.
+            Queued frames for key that have not been sent are dropped, as they are superseded by digest.
+        """
+        radioQueue = self.shards.forAddr(node.addr).radioQueue
+        superseded = radioQueue.removeQueued(node.addr, lambda q: q.get("shows", (None,))[0] == key)
+        if superseded:
+            self.metrics.inc("config_superseded", len(superseded))
+            self.logger.debug("config", "{} on {} superseded, dropped {} queued", key, node.addr, len(superseded))
+        inFlight = radioQueue.inFlight.get(node.addr)
+        if inFlight is not None and inFlight.get("shows", (None,))[0] == key:
+            return inFlight["shows"][1]
+        return node.shown.get(key) if node.shown is not None else None
 
     def requestBattery(self, nodeAddr):
-        self.cbLog("info", "Battery/RSSI requested from {}".format(nodeAddr))
-        self.requestBatteries.remove(nodeAddr)
+        self.logger.info("radio", "Battery/RSSI requested from {}", nodeAddr)
+        self.nodes.requestBatteries.discard(nodeAddr)
         msg = self.formatRadioMessage(nodeAddr, "send_battery", self.setWakeup(nodeAddr))
         self.queueRadio(msg, nodeAddr, "send_battery")
 
-    def findRSSI(self, source):
-        self.findingRssiAddr = source
+    def sendRssiRequest(self, shard):
         msg= {
             "id": self.id,
             "request": "command",
             "command": "get_rssi"
         }
-        self.sendMessage(msg, self.adaptor)
+        self.sendMessage(msg, shard.adaptor)
 
-    def onRSSI(self, rssi):
-        self.cbLog("debug", "RSSI for {}: {}".format(self.findingRssiAddr, rssi))
-        if self.includeReqMessage:
-            try:
-                self.includeReqMessage["rssi"] = rssi
-                self.client.send(self.includeReqMessage)
-                #reactor.callLater(130, self.client.send, self.includeReqMessage)  # For testing
-                self.includeReqMessage = {}
-            except Exception as ex:
-                self.cbLog("warning", "onRSSI, problem with RSSI for includeReqMessage: Type: {}, exception: {}".format(type(ex), ex.args))
-                self.includeReqMessage = {}
-        elif self.doingWakeup:
-            self.doingWakeup = False
-            try:
-                nodeID = self.addr2id[self.findingRssiAddr]
-                msg = self.formatRadioMessage(self.findingRssiAddr, "ack", self.setWakeup(self.findingRssiAddr))
-                self.queueRadio(msg, self.findingRssiAddr, "ack")
-                msg = {
-                    "function": "woken_up",
-                    "source": nodeID,
-                    "time_stamp": int(time.time()),
-                    "rssi": rssi
-                }
-                self.cbLog("debug", "onRSSI, doingWakeup, sending message to client: {}".format(msg))
-                self.client.send(msg)
-            except Exception as ex:
-                self.cbLog("warning", "onRSSI, problem with doingWakeup: Type: {}, exception: {}".format(type(ex), ex.args))
+    def onRSSI(self, rssi, shard):
+        if not shard.rssiRequests.onResponse(rssi):
+            self.cbLog("warning", "onRSSI, RSSI {} received with no outstanding request".format(rssi))
+
+    def onIncludeReqRssi(self, rssi, includeReqMessage):
+        if rssi is None:  # The client has never been sent an rssi of None. The button will send include_req again
+            self.logger.debug("radio", "No RSSI for include_req from {}, not sending", includeReqMessage["include_req"])
+            return
+        try:
+            includeReqMessage["rssi"] = rssi
+            self.uplink.send(includeReqMessage)
+        except Exception as ex:
+            self.cbLog("warning", "onIncludeReqRssi, problem with RSSI for includeReqMessage: Type: {}, exception: {}".format(type(ex), ex.args))
+
+    def onWakeupRssi(self, rssi, source):
+        self.logger.debug("radio", "RSSI for woken_up from {}: {}", source, rssi)
+        if rssi is None:  # Only asked for when none was cached, and the client has never been sent an rssi of None
+            return
+        self.rssiCache.update(source, rssi)
+        if not self.nodes.activeAt(source):  # Node was deactivated while waiting for the RSSI
+            self.onRssiReport(rssi, source)
         else:
-            try:
-                msg = {
-                    "function": "rssi",
-                    "address": self.findingRssiAddr,
-                    "time_stamp": int(time.time()),
-                    "rssi": rssi
-                }
-                if self.findingRssiAddr in self.addr2id:
-                    msg["id"] = self.addr2id[self.findingRssiAddr]
-                self.cbLog("debug", "onRSSI, not doingWakeup, sending message to client: {}".format(msg))
-                reactor.callLater(3, self.client.send, msg)  # We want rssi messages to arrive at spur_clients after wakeups
-            except Exception as ex:
-                self.cbLog("warning", "onRSSI, problem processing RSSI: Type: {}, exception: {}".format(type(ex), ex.args))
-        self.findingRssiAddr = None
+            self.sendWokenUp(source, rssi)
 
-    def onRadioMessage(self, message):
-        self.cbLog("debug", "onRadioMessage, connected: {}".format(self.connected))
+    def sendWokenUp(self, source, rssi):
+        try:
+            msg = {
+                "function": "woken_up",
+                "source": self.nodes.id(source),
+                "time_stamp": int(time.time()),
+                "rssi": rssi
+            }
+            self.logger.debug("radio", "sendWokenUp, sending message to client: {}", msg)
+            self.uplink.send(msg)
+        except Exception as ex:
+            self.cbLog("warning", "sendWokenUp, problem with woken_up: Type: {}, exception: {}".format(type(ex), ex.args))
+
+    def onRssiReport(self, rssi, source):
+        if rssi is None:  # The adaptor did not answer in time
+            self.logger.debug("radio", "No RSSI for {}, not reporting", source)
+            return
+        self.rssiCache.update(source, rssi)
+        try:
+            msg = {
+                "function": "rssi",
+                "address": source,
+                "time_stamp": int(time.time()),
+                "rssi": rssi
+            }
+            node = self.nodes.at(source)
+            if node is not None:
+                msg["id"] = node.id
+            self.logger.debug("radio", "onRssiReport, sending message to client: {}", msg)
+            self.uplink.send(msg)  # Held back by the uplink until the node's next message is sent, so that it arrives after wakeups
+        except Exception as ex:
+            self.cbLog("warning", "onRssiReport, problem processing RSSI: Type: {}, exception: {}".format(type(ex), ex.args))
+
+    def onRadioMessage(self, message, shard=None):
+        """ shard is the shard of the adaptor that received message. """
+        self.logger.debug("radio", "onRadioMessage, connected: {}", self.connected)
+        if shard is None:
+            shard = self.shards.home
         if self.connected:
-            if len(message) < 6:
-                return
-            try:
-                destination = struct.unpack(">H", message[0:2])[0]
-            except Exception as ex:
-                self.cbLog("warning", "onRadioMessage. Malformed radio message. Type: {}, exception: {}".format(type(ex), ex.args))
+            frame = decodeFrame(message)
+            if frame is None:
                 return
-            self.cbLog("debug", "onRadioMessage, Rx: destination: " + str("{0:#0{1}X}".format(destination,6)))
-            source, hexFunction = struct.unpack(">HB", message[2:5])
-            try:
-                function = (key for key,value in FUNCTIONS.items() if value==hexFunction).next()
-            except:
-                function = "undefined"
-            self.cbLog("debug", "onRadioMessage, source: {}, function: {}".format(source, function))
+            self.logger.debug("radio", "onRadioMessage, Rx: destination: {0:#06X}", frame.destination)
+            source = frame.source
+            function = frame.function
+            self.logger.debug("radio", "onRadioMessage, source: {}, function: {}", source, function)
+            node = self.nodes.at(source)
             if function == "woken_up":
-                if source in self.addr2id:
-                    if self.addr2id[source] not in self.activeNodes:
-                        self.findRSSI(source)
-                else:
-                    self.findRSSI(source)
+                if not self.nodes.activeAt(source):
+                    shard.rssiRequests.request(self.onRssiReport, source)
             if function == "include_req":
-                self.cbLog("debug", "Rx: " + function + " from button: " + str("{0:#0{1}x}".format(source,6)))
-                length = struct.unpack(">b", message[9])[0]
-                if length == 14:
-                    payload = message[10:14]
-                    nodeID = struct.unpack(">I", payload)[0]
-                    version = 0
-                    rssi = 0
-                else:
-                    payload = message[10:16]
-                    (nodeID, version, rssi) = struct.unpack(">Ibb", payload)
-                hexPayload = payload.encode("hex")
-                self.cbLog("debug", "Rx: hexPayload: " + str(hexPayload) + ", length: " + str(len(payload)))
-                self.cbLog("debug", "Rx, include_req, nodeID: " + str(nodeID))
-                self.cbLog("debug", "removing all references to nodeID {}".format(nodeID))
+                self.logger.debug("radio", "Rx: {} from button: {:#06x}", function, source)
+                if frame.error:
+                    self.cbLog("warning", "onRadioMessage. Malformed include_req. Type: {}, exception: {}".format(type(frame.error), frame.error.args))
+                    return
+                nodeID = frame.nodeID
+                version = frame.version
+                self.logger.debug("radio", "Rx: hexPayload: {}, length: {}", lazy(frame.hexPayload), len(frame.payload))
+                self.logger.debug("radio", "Rx, include_req, nodeID: {}", nodeID)
+                self.logger.debug("radio", "removing all references to nodeID {}", nodeID)
                 self.removeNodeMessages(nodeID)
-                self.includeReqMessage = {
+                self.shards.heardInclude(nodeID, shard)
+                includeReqMessage = {
                     "function": "include_req",
                     "include_req": nodeID,
                     "version": version,
                     "time_stamp": int(time.time()),
                     "rssi": None
                 }
-                self.findRSSI(nodeID)
-            elif source in self.addr2id:
-                if self.addr2id[source] in self.activeNodes:
+                shard.rssiRequests.request(self.onIncludeReqRssi, includeReqMessage)
+            elif node is not None:
+                if node.id in self.nodes.active:
+                    node.lastSeen = time.time()
+                    self.onHeard(source, shard)
                     if function == "alert":
-                        length = struct.unpack(">b", message[9])[0]
-                        if length == 14:
-                            payload = message[10:14]
-                            try:
-                                (alertType, rssi, temperature) = struct.unpack(">Hbb", payload)
-                            except Exception as ex:
-                                alertType = 0xFFFF
-                                self.cbLog("warning", "Unknown alert type received. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
+                        alertType = frame.alertType
+                        if frame.temperature is not None:
+                            self.rssiCache.update(source, frame.rssi)
+                        if frame.error:
+                            self.cbLog("warning", "Unknown alert type received. Type: " + str(type(frame.error)) + "exception: " +  str(frame.error.args))
                         else:
-                            payload = message[10:12]
-                            try:
-                                alertType = struct.unpack(">H", payload)[0]
-                            except Exception as ex:
-                                alertType = 0xFFFF
-                                self.cbLog("warning", "Unknown alert type received. Type: " + str(type(ex)) + "exception: " +  str(ex.args))
-                        hexPayload = payload.encode("hex")
-                        self.cbLog("debug", "Rx: hexPayload: " + str(hexPayload) + ", length: " + str(len(payload)))
-                        self.cbLog("debug", "Rx, alert, type: {}".format(alertType))
-                        if source in self.lastAlertType:
-                            if alertType == self.lastAlertType[source]:
-                                self.cbLog("debug", "Tx, alertType {}, lastAlertType {}, not sending to client".format(alertType, self.lastAlertType[source]))
+                            self.logger.debug("radio", "Rx: hexPayload: {}, length: {}", lazy(frame.hexPayload), len(frame.payload))
+                        self.logger.debug("radio", "Rx, alert, type: {}", alertType)
+                        if node.lastAlertType is not None:
+                            if alertType == node.lastAlertType:
+                                self.logger.debug("radio", "Tx, alertType {}, lastAlertType {}, not sending to client", alertType, node.lastAlertType)
                                 sendAlert = False
                             else:
                                 sendAlert = True
                         else:
                             sendAlert = True
                         if sendAlert:
-                            self.lastAlertType[source] = alertType
-                            self.cbLog("debug", "Rx, added {} to lastAlertType - alertType {}".format(source, alertType))
+                            node.lastAlertType = alertType
+                            self.logger.debug("radio", "Rx, added {} to lastAlertType - alertType {}", source, alertType)
                             if (alertType & 0xFF00) == 0x0200:
                                 battery_level = ((alertType & 0xFF) * 0.235668)/10
                                 msg = {
                                     "function": "battery",
                                     "value": battery_level,
-                                    "source": self.addr2id[source]
+                                    "source": node.id
                                 }
-                                if length == 14:
-                                    msg["rssi"] = rssi
-                                    msg["temperature"] = temperature
+                                if frame.temperature is not None:
+                                    msg["rssi"] = frame.rssi
+                                    msg["temperature"] = frame.temperature
                             else:
-                                self.cbLog("debug", "onRadioMessage, resetting wakeupCount for {}, id: {}".format(source, self.addr2id[source]))
-                                self.buttonState[source] = alertType & 0xFF
-                                self.wakeupCount[source] = 0
+                                self.logger.debug("radio", "onRadioMessage, resetting wakeupCount for {}, id: {}", source, node.id)
+                                node.buttonState = alertType & 0xFF
+                                node.wakeupCount = 0
                                 msg = {
                                     "function": "alert",
                                     "type": alertType,
-                                    "source": self.addr2id[source]
+                                    "source": node.id
                                 }
-                            self.client.send(msg)
+                            self.uplink.send(msg)
                         # Uncomment appropriately to test nack
                         #self.cbLog("debug", "onRadioMessage, ackCount: {}".format(self.ackCount))
                         #if self.ackCount == 3 or self.ackCount == 6:
@@ -684,20 +703,28 @@ class App(CbApp):
                         #    self.queueRadio(msg, source, "nack")
                         #else:
                         if True:
+                            self.shards.forAddr(source).radioQueue.expedite(source, time.time())  # The button is listening now
                             msg = self.formatRadioMessage(source, "ack", self.setWakeup(source))
                             self.queueRadio(msg, source, "ack")
                         #self.ackCount += 1
                     elif function == "woken_up":
-                        self.cbLog("debug", "Rx, woken_up from id: {}".format(self.addr2id[source]))
-                        self.doingWakeup = True
-                        self.findRSSI(source)
+                        self.logger.debug("radio", "Rx, woken_up from id: {}", node.id)
+                        self.shards.forAddr(source).radioQueue.expedite(source, time.time())  # The button is listening now
+                        msg = self.formatRadioMessage(source, "ack", self.setWakeup(source))
+                        self.queueRadio(msg, source, "ack")
+                        rssi = self.rssiCache.get(source)
+                        if rssi is None:
+                            shard.rssiRequests.request(self.onWakeupRssi, source)
+                        else:
+                            self.sendWokenUp(source, rssi)
                     elif function == "ack":
                         self.onAck(source)
                     else:
                         self.cbLog("warning", "onRadioMessage, undefined message, source " + str(source) + ", function: " + function)
 
     def setWakeup(self, nodeAddr):
-        nodeID = self.addr2id[nodeAddr]
+        node = self.nodes.byAddr[nodeAddr]
+        nodeID = node.id
         """
         self.testCount += 1
         if (self.testCount > 15) and (self.testCount < 30):
@@ -705,42 +732,40 @@ class App(CbApp):
             return wakeup
         """
         wakeup = -1
-        self.cbLog("debug", "setWakeup, nodeAddr: {}, id: {}, buttonState: {}".format(nodeAddr, nodeID, self.buttonState))
-        self.cbLog("debug", "setWakeup, self.nodeConfig: " + str(json.dumps(self.nodeConfig, indent=4)) + ", self.configuring: " + str(self.configuring))
-        self.cbLog("debug", "setWakeup, requestBatteries: {}".format(self.requestBatteries))
-        self.cbLog("debug", "setWakeup, buttonState: {}".format(self.buttonState))
-        self.cbLog("debug", "setWakeup, wakeupCount: {}".format(self.wakeupCount))
+        self.logger.debug("radio", "setWakeup, nodeAddr: {}, id: {}, buttonState: {}", nodeAddr, nodeID, node.buttonState)
+        self.logger.debug("radio", "setWakeup, nodeConfig: {}, configuring: {}", lazy(json.dumps, node.config, indent=4), nodeID in self.nodes.configuring)
+        self.logger.debug("radio", "setWakeup, requestBattery: {}", nodeAddr in self.nodes.requestBatteries)
+        self.logger.debug("radio", "setWakeup, wakeupCount: {}", node.wakeupCount)
         wakeup0 = False
-        if (nodeAddr in self.nodeConfig):
-            if "reassign" not in self.nodeConfig[nodeAddr]:
+        if node.config is not None:
+            if "reassign" not in node.config:
                 wakeup0 = True  # Only set wakeup = 0 if this is not a reassign because config is not sent to button on a reassign
-        if wakeup0 or (nodeID in self.configuring) or (nodeAddr in self.requestBatteries):
+        if wakeup0 or (nodeID in self.nodes.configuring) or (nodeAddr in self.nodes.requestBatteries):
             wakeup = 0;
+            self.wakeupPlanner.forget(nodeAddr)
             self.nextWakeupTime[nodeAddr] = int(time.time() + 720)  # Time to allow before excluding when configuring
-            self.cbLog("debug", "setWakeup 0 (1) for {}, now: {}, next wakeup: {}".format(nodeID, time.time(), self.nextWakeupTime[nodeAddr]))
+            self.logger.debug("radio", "setWakeup 0 (1) for {}, now: {}, next wakeup: {}", nodeID, time.time(), self.nextWakeupTime[nodeAddr])
         else:
-            #self.cbLog("debug", "setWakeup, messageQueue (2): " + str(json.dumps(self.messageQueue, indent=4)))
-            for m in self.messageQueue:
-                if m["destination"] == nodeAddr:
-                    wakeup = 0;
-                    self.nextWakeupTime[nodeAddr] = int(time.time() + 720)  # Time to allow before excluding when messages in queue
-                    self.cbLog("debug", "setWakeup 0 (2) for {}, now: {}, next wakeup: {}".format(nodeID, time.time(), self.nextWakeupTime[nodeAddr]))
-                    break
+            if self.shards.forAddr(nodeAddr).radioQueue.hasPending(nodeAddr):
+                wakeup = 0;
+                self.wakeupPlanner.forget(nodeAddr)
+                self.nextWakeupTime[nodeAddr] = int(time.time() + 720)  # Time to allow before excluding when messages in queue
+                self.logger.debug("radio", "setWakeup 0 (2) for {}, now: {}, next wakeup: {}", nodeID, time.time(), self.nextWakeupTime[nodeAddr])
             if wakeup == -1:
                 try:
-                    if nodeAddr in self.buttonState:
-                        self.cbLog("debug", "setWakeup buttonState: {}, wakeupCount: {}".format(self.buttonState[nodeAddr], self.wakeupCount[nodeAddr]))
-                        self.cbLog("debug", "setWakeup, wakeups: {}".format(self.wakeups))
-                        wakeup = self.wakeups[nodeAddr][self.buttonState[nodeAddr]][self.wakeupCount[nodeAddr]]
+                    if node.buttonState is not None:
+                        self.logger.debug("radio", "setWakeup buttonState: {}, wakeupCount: {}", node.buttonState, node.wakeupCount)
+                        self.logger.debug("radio", "setWakeup, wakeups: {}", node.wakeups)
+                        wakeup = self.wakeupPlanner.plan(nodeAddr, time.time(), node.wakeups[node.buttonState][node.wakeupCount])
                         if wakeup < 300:
                             timeOut = 300  # Prevents problems with delays in sending, etc, for shorter wakeup times
                         else:
                             timeOut = wakeup
                         self.nextWakeupTime[nodeAddr] = int(time.time() + timeOut*2*GRACE_TIME_MULT)
-                        self.cbLog("debug", "setWakeup (-1) for {}, now: {}, next wakeup: {}".format(nodeID, time.time(), self.nextWakeupTime[nodeAddr]))
+                        self.logger.debug("radio", "setWakeup (-1) for {}, now: {}, next wakeup: {}", nodeID, time.time(), self.nextWakeupTime[nodeAddr])
                     else:
                         wakeup = 7200
-                        self.cbLog("info", "setWakeup, no buttonState for {}. Setting wakeup to 7200".format(nodeAddr))
+                        self.logger.info("radio", "setWakeup, no buttonState for {}. Setting wakeup to 7200", nodeAddr)
                 except Exception as ex:
                     self.cbLog("warning", "setWakeup, problem setting next wakeup for {}. Type: {}. Exception: {}".format(nodeAddr, type(ex), ex.args))
                     wakeup = 7200
@@ -749,197 +774,253 @@ class App(CbApp):
                     except Exception as ex:
                         self.cbLog("warning", "setWakeup, problem setting nextWakeupTime for {}. Type: {}. Exception: {}".format(nodeAddr, type(ex), ex.args))
                 try:
-                    if nodeAddr in self.buttonState:
-                        self.wakeupCount[nodeAddr] += 1
-                        if self.wakeupCount[nodeAddr] >=  len(self.wakeups[nodeAddr][self.buttonState[nodeAddr]]):
-                            self.wakeupCount[nodeAddr] = len(self.wakeups[nodeAddr][self.buttonState[nodeAddr]]) - 1
+                    if node.buttonState is not None:
+                        node.wakeupCount += 1
+                        if node.wakeupCount >= len(node.wakeups[node.buttonState]):
+                            node.wakeupCount = len(node.wakeups[node.buttonState]) - 1
                 except Exception as ex:
                     self.cbLog("warning", "setWakeup, problem incrementing wakeup for {}. Type: {}. Exception: {}".format(nodeAddr, type(ex), ex.args))
-        if (nodeAddr in self.nodeConfig) and (nodeAddr not in self.sendingConfig):
+        if (node.config is not None) and (nodeAddr not in self.nodes.sendingConfig):
             reactor.callLater(3, self.sendConfig, nodeAddr)  # Delay of 3 gives time for node to update screen and turn on radio
-            self.sendingConfig.append(nodeAddr)
+            self.nodes.sendingConfig.add(nodeAddr)
         return wakeup
 
     def onAck(self, source):
         """ If there is no more data to send, we need to send an ack with a normal wakeup 
             time to ensure that the node goes to sleep.
         """
-        self.cbLog("debug", "onAck, source: {}".format(source))
+        self.logger.debug("radio", "onAck, source: {}", source)
         #self.cbLog("debug", "onAck, source: " + str("{0:#0{1}x}".format(source,6)))
-        #self.cbLog("debug", "onAck, messageQueue: " + str(json.dumps(self.messageQueue, indent=4)))
-        #self.cbLog("debug", "onAck, source: " + str(source) + ", self.sentTo: " + str(self.sentTo))
-        if source in self.sentTo:
-            moreToCome = False
-            for m in list(self.messageQueue):
-                if m["destination"] == source:
-                    if m["attempt"] > 0:
-                        #self.cbLog("debug", "onAck, function: {}, alert0AfterStart: {}".format(m["function"], self.alert0AfterStart))
-                        if m["function"] == "start":
-                            if source in self.alert0AfterStart:
-                                msg = {
-                                    "function": "alert",
-                                    "type": 0,
-                                    "source": self.addr2id[source]
-                                }
-                                self.client.send(msg)
-                                self.alert0AfterStart.remove(source)
-                                self.cbLog("debug", "onAck, start message acknowledged, sending alert 0 to client")
-                        self.cbLog("debug", "onAck, removing message: " + m["function"] + " for: " + str(source) + ", id:" + str(self.addr2id[source]))
-                        self.messageQueue.remove(m)
-                        self.sentTo.remove(source)
-                    else:
-                        moreToCome = True
-            if not moreToCome and (self.addr2id[source] not in self.configuring):
+        shard = self.shards.forAddr(source)
+        if shard.radioQueue.isInFlight(source):
+            m, moreToCome = shard.radioQueue.acknowledge(source)
+            self.links.onAck(source, time.time() - m["sentTime"], m["attempt"])
+            self.metrics.inc("delivered." + m["function"])
+            self.metrics.observe("delivery_latency." + m["function"], time.time() - m["queuedTime"])
+            self.metrics.observe("attempts." + m["function"], m["attempt"], ATTEMPT_BUCKETS)
+            if m["function"] == "include_grant":
+                self.grantBatcher.onAck(m)
+            if "shows" in m:
+                node = self.nodes.at(source)
+                if node is not None:
+                    if node.shown is None:
+                        node.shown = {}
+                    key, digest = m["shows"]
+                    node.shown[key] = digest
+            if m["function"] == "start":
+                if source in self.nodes.alert0AfterStart:
+                    msg = {
+                        "function": "alert",
+                        "type": 0,
+                        "source": self.nodes.id(source)
+                    }
+                    self.uplink.send(msg)
+                    self.nodes.alert0AfterStart.remove(source)
+                    self.logger.debug("radio", "onAck, start message acknowledged, sending alert 0 to client")
+            self.logger.debug("radio", "onAck, removing message: {} for: {}, id:{}", m["function"], source, self.nodes.id(source))
+            if not moreToCome and (self.nodes.id(source) not in self.nodes.configuring):
                 msg = self.formatRadioMessage(source, "ack", PRESSED_WAKEUP)  # Shorter wakeup immediately after config
                 self.queueRadio(msg, source, "ack")
+            else:
+                shard.txScheduler.kick()
         else:
             self.cbLog("warning", "onAck, received ack from node that does not correspond to a sent message: " + str(source))
 
-    def beacon(self):
-        if self.beaconCalled == self.beaconInterval:
-            self.sendQueued(True)
-            self.beaconCalled = 0
-            self.beaconInterval = random.randrange(10, 14, 2)
-            #self.cbLog("debug", "beaconInterval: {}".format(self.beaconInterval))
-        else:
-            self.beaconCalled += 1
-            self.sendQueued(False)
-        reactor.callLater(0.5, self.beacon)
+    def nextTxDue(self, shard):
+        if not self.connected:
+            return None  # Kicked again when connected
+        return shard.radioQueue.nextDue()
 
     def monitor(self):
         now = time.time()
-        self.cbLog("debug", "monitor, nextWakeupTimes: {}, activeNodes: {}".format(self.nextWakeupTime, self.activeNodes))
-        for m in self.activeNodes:
+        if self.monitorDue is not None:
+            self.metrics.observe("reactor_lag", now - self.monitorDue, LAG_BUCKETS)
+        expired = self.nextWakeupTime.expired(now)
+        self.wakeupPlanner.prune(now)
+        self.logger.debug("monitor", "monitor, {} nextWakeupTimes, {} expired", len(self.nextWakeupTime), len(expired))
+        self.logger.debug("monitor", "monitor, uplink: {}", lazy(self.uplink.stats))
+        excludes = []
+        for n, deadline in expired:
             try:
-                n = self.id2addr[m]
-                if n in list(self.nextWakeupTime):
-                    if (now > self.nextWakeupTime[n]):
-                        self.cbLog("debug", "monitor, excluding {}, {}, nexWakeupTime: {}, time diff: {}".format(m, n, self.nextWakeupTime[n], \
-                            now-self.nextWakeupTime[n]))
-                        self.cbLog("debug", "monitor, activeNodes: {}".format(self.activeNodes))
-                        if m not in self.excludedNodes:
-                            msg = {
-                                "function": "exclude_req",
-                                "source": self.addr2id[n]
-                            }
-                            self.client.send(msg)
-                            self.excludedNodes.append(m)
-                            del self.nextWakeupTime[n]
+                node = self.nodes.at(n)
+                if (node is not None) and (node.addr == n) and (node.id in self.nodes.active) and (node.id not in self.nodes.excluded):
+                    self.logger.debug("monitor", "monitor, excluding {}, {}, nexWakeupTime: {}, time diff: {}", node.id, n, deadline, now-deadline)
+                    excludes.append({
+                        "function": "exclude_req",
+                        "source": node.id
+                    })
+                    self.nodes.excluded.add(node.id)
             except Exception as ex:
-                self.cbLog("warning", "monitor, problem with node {}. Type: {}, exception: {}".format(m, type(ex), ex.args))
+                self.cbLog("warning", "monitor, problem with node {}. Type: {}, exception: {}".format(n, type(ex), ex.args))
+        self.uplink.sendAll(excludes)  # Nodes that expired in the same interval are flushed together, in one batch if batching is on
+        self.metrics.inc("exclude_req", len(excludes))
         if now - self.lastClientMessage > CHECK_INTERVAL + 120:
             self.connected = False
             self.cbLog("warning", "monitor, not heard from client within check interval, disconnecting")
+        self.scheduleMonitor()
+
+    def onHeard(self, source, shard):
+        """ Moves source to shard, with its queued messages, if its own shard is overloaded. """
+        old = self.shards.heard(source, shard)
+        if old is not None:
+            old.radioQueue.transfer(source, shard.radioQueue)
+            shard.txScheduler.kick()
+            self.metrics.inc("shard_moves")
+            self.logger.debug("radio", "{} moved from shard {} to {}", source, old.index, shard.index)
+
+    def evict(self):
+        """ Forgets all but the addresses of nodes not active here for too long, and RSSI readings too old to use. """
+        try:
+            stale = self.nodes.stale(time.time(), config.get("inactive_node_ttl", INACTIVE_NODE_TTL), \
+                                     config.get("max_inactive_nodes", MAX_INACTIVE_NODES))
+            for nodeID in stale:
+                self.removeNodeMessages(nodeID, keepAddress=True)
+            self.metrics.inc("evicted_nodes", len(stale))
+            pruned = self.rssiCache.prune()
+            if stale:
+                self.cbLog("info", "Forgot {} nodes not active on this bridge, {} remain, {} dormant".format(len(stale), len(self.nodes), \
+                                                                                                          len(self.nodes.dormant)))
+            self.logger.debug("monitor", "evict, {} nodes, {} rssi readings", len(stale), pruned)
+        except Exception as ex:
+            self.cbLog("warning", "Problem evicting stale nodes. Type: " + str(type(ex)) + ", exception: " +  str(ex.args))
+        reactor.callLater(EVICT_INTERVAL, self.evict)
+
+    def onTickLag(self, lag, beacon):
+        self.metrics.observe("beacon_lag" if beacon else "tick_lag", lag, LAG_BUCKETS)
+
+    def scheduleMonitor(self):
+        self.monitorDue = time.time() + MONITOR_INTERVAL
         reactor.callLater(MONITOR_INTERVAL, self.monitor)
 
-    def removeNodeMessages(self, nodeID):
+    def metricsReport(self):
+        """ Counters, histograms and gauges, plus the nodes with the most queued messages and the longest waits to send. """
+        report = self.metrics.snapshot()
+        pending = []
+        for shard in self.shards:
+            pending.extend(shard.radioQueue.pending.items())
+        deepest = sorted(pending, key=lambda p: p[1], reverse=True)[:10]
+        report["queue_depth_by_node"] = dict((str(self.nodes.id(addr) if self.nodes.at(addr) else addr), n) for addr, n in deepest)
+        report["longest_waits_by_node"] = dict((str(self.nodes.id(addr) if self.nodes.at(addr) else addr), {"mean": mean, "max": longest}) \
+                                               for addr, mean, longest in self.links.longestWaits(10))
+        report["uplink"] = self.uplink.stats()
+        return report
+
+    def removeNodeMessages(self, nodeID, keepAddress=False):
         #Remove all queued messages and reference to a node if we get a new include_req
         try:
-            self.cbLog("debug", "removeNodeMessages, nodeID: {}".format(nodeID))
-            self.cbLog("debug", "removeNodeMessages, messageQueue: {}".format(self.messageQueue))
-            if nodeID in self.id2addr:
-                addr = self.id2addr[nodeID]
-                for m in list(self.messageQueue):
-                    if m["destination"] == addr:
-                        self.messageQueue.remove(m)
-                        self.cbLog("debug", "removeNodeMessages: " + str(nodeID) + ", removed: " + m["function"])
-                if addr in self.sendingConfig:
-                    del self.sendingConfig[addr]
-                if addr in self.nodeConfig:
-                    del self.nodeConfig[addr]
-                if addr in self.buttonState:
-                    del self.buttonState[addr]
-                if addr in self.sentTo:
-                    self.sentTo.remove(addr)
-                    self.cbLog("debug", "removeNodeMessages,removed from sentTo: {}".format(nodeID))
-                if addr in self.addr2id:
-                    del self.addr2id[addr]
-                if addr in self.wakeupCount:
-                    del self.wakeupCount[addr]
-                del self.id2addr[nodeID]
-            if nodeID in self.activeNodes:
-                self.activeNodes.remove(nodeID)
-            if nodeID in self.excludedNodes:
-                self.excludedNodes.remove(nodeID)
-            if nodeID in self.configuring:
-                self.configuring.remove(nodeID)
+            self.logger.debug("radio", "removeNodeMessages, nodeID: {}", nodeID)
+            node = self.nodes.remove(nodeID, keepAddress)
+            if node is not None:
+                for m in self.shards.forAddr(node.addr).radioQueue.removeDestination(node.addr):
+                    self.logger.debug("radio", "removeNodeMessages: {}, removed: {}", nodeID, m["function"])
+                self.shards.remove(node.addr)
+                self.rssiCache.remove(node.addr)
+                self.links.remove(node.addr)
+                self.wakeupPlanner.forget(node.addr)
+                self.nextWakeupTime.pop(node.addr)
+            self.save(nodeID)
         except Exception as ex:
             self.cbLog("warning", "removeNodeMessages, cannot remove messages for {}. Type: {}, exception: {}".format(nodeID, type(ex), ex.args))
 
-    def sendQueued(self, beacon):
+    def sendQueued(self, shard, beacon):
         """
+        Sends one tick's worth of frames from shard's queue through its adaptor.
         In frames where a beacon is sent, don't send anything else apart from acks.
         """
         if not self.connected:
             return
-        if self.findingRssiAddr:
-            return
+        radioQueue = shard.radioQueue
         now = time.time()
+        acks = radioQueue.fireOnceMessages()  # Only one ack per node in a frame
         sentLength = 0
-        removed = False  # Stops sending more messages if node has just been removed
-        sentAck = []
-        for m in list(self.messageQueue):
-            #self.cbLog("debug", "sendQueued: {}, {}, sentTo: {}".format(m["destination"], m["function"], self.sentTo))
-            if (sentLength < 60) and not removed:   # Send max of 60 bytes in a frame if more than one message sent
-                if ((m["function"] == "ack") and (m["destination"] not in sentAck)) or (m["function"] == "include_not"):
-                    self.cbLog("debug", "sendQueued: Tx: " + m["function"] + " to " + str(m["destination"]))
-                    self.sendMessage(m["message"], self.adaptor)
-                    self.messageQueue.remove(m)  # Only send ack and include_not once
-                    sentAck.append(m["destination"])
-                    sentLength += m["message"]["length"]
-                    if m["destination"] in self.requestBatteries:  # Wait until an ack has been sent before requesting battery
-                        self.requestBattery(m["destination"])
-                elif (m["destination"] not in self.sentTo) and (m["destination"] not in sentAck) and not beacon:
-                    self.sendMessage(m["message"], self.adaptor)
-                    self.sentTo.append(m["destination"])
-                    m["sentTime"] = now
-                    m["attempt"] = 1
-                    self.cbLog("debug", "sendQueued: Tx: " + m["function"] + " to " + str(m["destination"]) + ", attempt " + str(m["attempt"]))
-                    sentLength += m["message"]["length"]
-                elif (now - m["sentTime"] > 9) and (m["destination"] not in sentAck) and (m["attempt"] > 0) and not beacon:
-                    if m["attempt"] > FAILS_BEFORE_REMOVE:
-                        self.sentTo.remove(m["destination"])
-                        self.removeNodeMessages(self.addr2id[m["destination"]])
-                        removed = True
-                        self.cbLog("debug", "sendQueued: No ack, removed: " + m["function"] + ", for " + str(m["destination"]))
-                    else:
-                        self.sendMessage(m["message"], self.adaptor)
-                        m["sentTime"] = now
-                        m["attempt"] += 1
-                        self.cbLog("debug", "sendQueued: Tx: " + m["function"] + " to " + str(m["destination"]) + ", attempt " + str(m["attempt"]))
-                        sentLength += m["message"]["length"]
-        if beacon and (sentLength == 0):
+        sentAck = set()
+        msg, nots, acks = self.grantBatcher.takeNots(acks)
+        if msg is not None:
+            self.sendMessage(msg, shard.adaptor)
+            for m in nots:
+                radioQueue.discard(m)
+            sentLength += msg["length"]
+        for m in packFrame(acks, FRAME_BUDGET, sentLength):
+            self.logger.debug("radio", "sendQueued: Tx: {} to {}", m["function"], m["destination"])
+            self.sendMessage(m["message"], shard.adaptor)
+            radioQueue.discard(m)  # Only send ack and include_not once
+            sentAck.add(m["destination"])
+            sentLength += m["message"]["length"]
+            if m["destination"] in self.nodes.requestBatteries:  # Wait until an ack has been sent before requesting battery
+                self.requestBattery(m["destination"])
+        if beacon:
+            self.sendBeacon(shard, sentLength)
+            return
+        if sentLength >= FRAME_BUDGET:
+            self.countTick(sentLength)
+            return
+        due = []
+        while True:
+            m = radioQueue.popDue(now)
+            if m is None:
+                break
+            if m["attempt"] > FAILS_BEFORE_REMOVE:
+                self.metrics.inc("removed_no_ack")
+                self.links.onDrop(m["destination"])
+                node = self.nodes.at(m["destination"])
+                if node is not None:
+                    self.removeNodeMessages(node.id)
+                else:
+                    radioQueue.removeDestination(m["destination"])
+                self.logger.debug("radio", "sendQueued: No ack, removed: {}, for {}", m["function"], m["destination"])
+            else:
+                due.append(m)
+        candidates = [m for m in due + radioQueue.readyMessages() if m["destination"] not in sentAck]
+        msg, grants, candidates = self.grantBatcher.takeGrants(candidates, sentLength)
+        if msg is not None:
+            self.sendMessage(msg, shard.adaptor)
+            for m in grants:
+                self.markSent(radioQueue, m, now)
+            sentLength += msg["length"]
+        for m in packFrame(candidates, FRAME_BUDGET, sentLength):
+            self.sendMessage(m["message"], shard.adaptor)
+            self.markSent(radioQueue, m, now)
+            sentLength += m["message"]["length"]
+        for m in due:
+            if m["sentTime"] != now:
+                radioQueue.defer(m)
+        self.countTick(sentLength)
+
+    def markSent(self, radioQueue, m, now):
+        if m["attempt"] == 0:
+            self.metrics.observe("queue_wait", now - m["readyTime"])
+            self.links.onWait(m["destination"], now - m["readyTime"])
+        timeout = self.links.timeout(m["destination"], m["attempt"] + 1)
+        radioQueue.markSent(m, now, timeout)
+        self.links.onSend(m["destination"], m["attempt"])
+        self.metrics.observe("retry_timeout", timeout)
+        if m["attempt"] > 1:
+            self.metrics.inc("retransmissions")
+        self.logger.debug("radio", "sendQueued: Tx: {} to {}, attempt {}", m["function"], m["destination"], m["attempt"])
+
+    def countTick(self, sentLength):
+        if sentLength:
+            self.metrics.inc("frames_data")
+            self.metrics.observe("tick_bytes", sentLength, BYTE_BUCKETS)
+
+    def sendBeacon(self, shard, sentLength):
+        if sentLength == 0:
             msg = self.formatRadioMessage(0xBBBB, "beacon", 0)
-            self.sendMessage(msg, self.adaptor)
+            self.sendMessage(msg, shard.adaptor)
+            self.metrics.inc("frames_beacon")
+            self.metrics.observe("tick_bytes", msg["length"], BYTE_BUCKETS)
+        else:
+            self.countTick(sentLength)
 
     def formatRadioMessage(self, destination, function, wakeupInterval, data = None):
         try:
-            timeStamp = 0x00000000
-            if function != "beacon":
-                length = 4
-            else:
-                length = 10
-            if data:
-                length += len(data)
-                #self.cbLog("debug", "data length: " + str(length))
-            m = ""
-            m += struct.pack(">H", destination)
-            m += struct.pack(">H", SPUR_ADDRESS)
+            m = encodeFrame(destination, SPUR_ADDRESS, function, wakeupInterval, data)
             if function != "beacon":
-                m+= struct.pack("B", FUNCTIONS[function])
-                m+= struct.pack("B", length)
-                m+= struct.pack("I", timeStamp)
-                m+= struct.pack(">H", wakeupInterval)
-                self.cbLog("debug", "formatRadioMessage, wakeupInterval: " +  str(wakeupInterval))
-            #self.cbLog("debug", "length: " +  str(length))
-            if data:
-                m += data
-            length = len(m)
-            hexPayload = m.encode("hex")
-            self.cbLog("debug", "formatRadioMessage, message: " + str(hexPayload))
+                self.logger.debug("radio", "formatRadioMessage, wakeupInterval: {}", wakeupInterval)
+            self.logger.debug("radio", "formatRadioMessage, message: {}", lazy(hexlify, m))
             msg= {
                 "id": self.id,
-                "length": length,
+                "length": len(m),
                 "request": "command",
                 "data": base64.b64encode(m)
             }
@@ -947,26 +1028,31 @@ class App(CbApp):
         except Exception as ex:
             self.cbLog("warning", "Problem formatting message. Exception: " + str(type(ex)) + ", " + str(ex.args))
 
-    def queueRadio(self, msg, destination, function):
-        self.cbLog("debug", "queueRadio, queuing {} for {}".format(function, destination))
-        toQueue = {
-            "message": msg,
-            "destination": destination,
-            "function": function,
-            "attempt": 0,
-            "sentTime": 0
-        }
-        self.messageQueue.append(toQueue)
+    def queueRadio(self, msg, destination, function, shard=None):
+        """ Queues on the shard that destination is assigned to, unless a shard is given. """
+        self.logger.debug("radio", "queueRadio, queuing {} for {}", function, destination)
+        if shard is None:
+            shard = self.shards.forAddr(destination)
+        m = shard.radioQueue.push(msg, destination, function)
+        m["queuedTime"] = time.time()
+        self.metrics.inc("queued." + function)
+        shard.txScheduler.kick()
+        return m
 
     def onAdaptorService(self, message):
         #self.cbLog("debug", "onAdaptorService, message: " + str(message))
         for p in message["service"]:
             if p["characteristic"] == "spur":
+                shard = self.shards.byAdaptor.get(message["id"])
+                if shard is None:  # An adaptor that is already bound keeps its shard and channel
+                    shard = self.shards.unbound() or self.addShard()
+                    self.shards.bind(shard, message["id"])
+                self.cbLog("info", "Adaptor {} is shard {} on channel {}".format(message["id"], shard.index, shard.channel))
                 req = {"id": self.id,
                        "request": "service",
                        "service": [
                                    {"characteristic": "spur",
-                                    "channel": 6,
+                                    "channel": shard.channel,
                                     "interval": 0
                                    },
                                    {"characteristic": "rssi",
@@ -975,19 +1061,30 @@ class App(CbApp):
                                   ]
                       }
                 self.sendMessage(req, message["id"])
-                self.adaptor = message["id"]
-        self.setState("running")
-        if not self.beaconRunning:
-            self.beaconRunning = True
-            reactor.callLater(BEACON_START_DELAY, self.beacon)
-        reactor.callLater(MONITOR_INTERVAL, self.monitor)
+                shard.txScheduler.start(BEACON_START_DELAY)
+        if self.monitorDue is None:
+            self.setState("running")
+            self.scheduleMonitor()
+            reactor.callLater(EVICT_INTERVAL, self.evict)
 
     def onAdaptorData(self, message):
         #self.cbLog("debug", "onAdaptorData, message: " + str(message))
+        shard = self.shards.forAdaptor(message["id"])
         if message["characteristic"] == "spur":
-            self.onRadioMessage(base64.b64decode(message["data"]))
+            frame = base64.b64decode(message["data"])
+            if self.shards.duplicate(frame, shard):
+                self.metrics.inc("duplicate_frames")
+                self.onDuplicateFrame(frame, shard)
+            else:
+                self.onRadioMessage(frame, shard)
         elif message["characteristic"] == "rssi":
-            self.onRSSI(message["data"])
+            self.onRSSI(message["data"], shard)
+
+    def onDuplicateFrame(self, message, shard):
+        """ A frame that another adaptor has already received tells us that shard can reach the button too. """
+        frame = decodeFrame(message)
+        if frame is not None and frame.function != "include_req" and self.nodes.activeAt(frame.source):
+            self.onHeard(frame.source, shard)
 
     def readLocalConfig(self):
         global config
@@ -1002,12 +1099,21 @@ class App(CbApp):
 
     def onConfigureMessage(self, managerConfig):
         #self.readLocalConfig()
+        if config.get("trace_file") and not self.trace:
+            self.startTrace(config["trace_file"], managerConfig)
         self.client = CbClient(self.id, CID, 3)
         self.client.onClientMessage = self.onClientMessage
         self.client.sendMessage = self.sendMessage
         self.client.cbLog = self.cbLog
+        if self.trace:
+            self.client.send = self.trace.wrap(CLIENT_OUT, self.client.send)
+        self.uplink = Uplink(self.client.send, reactor.callLater, config.get("uplink_batch_size", UPLINK_BATCH_SIZE), \
+                             config.get("uplink_latency", UPLINK_LATENCY))
         self.saveFile = CB_CONFIG_DIR + self.id + ".savestate"
+        self.journal = StateJournal(self.saveFile, reactor.callLater, self.nodes.state, self.nodes.record, run=self.workers.run)
         self.loadSaved()
+        if self.trace:
+            self.trace.write(STATE, (self.nodes.state(), dict(config, random_seed=self.seed)))
         reactor.callLater(CHECK_START_DELAY, self.checkConnected)
         self.cbLog("info", "CID: {}".format(CID))
         self.setState("starting")
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# spur_bench.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Microbenchmarks for the App entry points that run on the reactor thread.
+
+Each benchmark builds a fleet of the given size with a fixed seed, using the
+stand-ins from spur_sim, and then times individual calls of one entry point.
+Work done to set up each call is not timed. For each benchmark and fleet
+size the report gives calls per second, p50 and p99 latency and the memory
+allocated per call: peak bytes traced by tracemalloc where it is available,
+otherwise the net number of GC-tracked objects created per call.
+
+Results are compared with the baselines in spur_bench.json, which are kept
+per Python version. A benchmark whose calls per second and median call rate
+both drop by more than the tolerance fails, and the exit status is 1.
+Baselines are only meaningful on the machine they were recorded on; record
+new ones with --save.
+
+Usage:
+    python spur_bench.py
+    python spur_bench.py --sizes 10,1000,50000 --only sendQueued,monitor
+    python spur_bench.py --save
+"""
+
+import os
+import gc
+import sys
+import copy
+import json
+import struct
+import random
+import base64
+import argparse
+import spur_sim
+from spur_scheduler import TX_SPACING
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spur_bench.json")
+SIZES         = (10, 1000, 10000, 50000)
+TOLERANCE     = 0.5                     # Fractional drop that counts as a regression; run to run noise on a shared machine reaches 40%
+FIRST_NODE_ID = 100000
+FIRST_ADDR    = 0x0100
+NUM_SCREENS   = 32
+CLIENT_BATCH  = 100                     # Commands in each batch for clientBatch
+WORDS         = ("Press", "for", "service", "Coffee", "Tea", "Room", "Reception", "Thank", "you", "Cancel", \
+                 "Request", "sent", "Left", "Right", "Call", "open", "24", "hours", "Bar", "Towels")
+
+def realisticScreens(count, rnd):
+    """ Displays of 1 to 4 lines, some split into left and right halves and some boxed. """
+    screens = []
+    for n in range(count):
+        lines = []
+        for l in range(rnd.randint(1, 4)):
+            text = " ".join(rnd.choice(WORDS) for w in range(rnd.randint(1, 3)))
+            if rnd.random() < 0.3:
+                text = text + "|" + rnd.choice(WORDS)
+            if rnd.random() < 0.3:
+                text = "*" + text
+            lines.append(text)
+        screens.append(base64.b64encode("\n".join(lines).encode("ascii")).decode("ascii"))
+    return screens
+
+def radioFrame(source, function, payload=b""):
+    """ A frame as the adaptor passes it to onRadioMessage. """
+    return struct.pack(">HHB", spur_sim.BRIDGE_ADDRESS, source, spur_sim.FUNCTIONS[function]) + b"\0" * 4 + \
+        struct.pack(">b", 10 + len(payload)) + payload
+
+class Fleet(object):
+    """ An App with size included, active nodes, and no radio or client traffic leaving it. """
+    def __init__(self, size, seed=1):
+        self.rnd = random.Random(seed)
+        self.sim = spur_sim.Simulation(buttons=0, seed=seed, screens=realisticScreens(NUM_SCREENS, self.rnd))
+        self.app = self.sim.app
+        self.app.connected = True
+        self.app.sendMessage = lambda msg, destination: None
+        self.app.uplink.clientSend = lambda msg: None
+        self.size = size
+        self.ids = [FIRST_NODE_ID + n for n in range(size)]
+        self.addrs = [FIRST_ADDR + n for n in range(size)]
+        now = self.sim.clock.now
+        for nodeID, addr in zip(self.ids, self.addrs):
+            node = self.app.nodes.add(nodeID, addr)
+            self.app.nodes.active.add(nodeID)
+            node.buttonState = self.rnd.randint(0, 2)
+            node.wakeupCount = 0
+            node.wakeups = dict((s, [300, 900, 1800, 3600]) for s in range(3))
+            self.app.nextWakeupTime[addr] = int(now + self.rnd.uniform(60, 7200 * self.sim.appModule.GRACE_TIME_MULT))
+
+    def close(self):
+        self.sim.close()
+
+    def config(self, nodeID):
+        return copy.deepcopy(self.sim.cloud.buttonConfig(nodeID))
+
+    def addr(self):
+        return self.rnd.choice(self.addrs)
+
+def benchFormatRadioMessage(fleet):
+    payload = b"M" + b"\x01" * 16
+    def call(i):
+        fleet.app.formatRadioMessage(fleet.addrs[i % fleet.size], "config", 0, payload)
+    return call, None
+
+def benchOnRadioMessage(fleet):
+    frames = []
+    for i in range(1024):
+        source = fleet.addr()
+        if i % 4 == 0:
+            frames.append(radioFrame(source, "woken_up"))
+        else:
+            frames.append(radioFrame(source, "alert", struct.pack(">Hbb", fleet.rnd.randint(0, 2), -70, 20)))
+    fleet.app.rssiCache.update = lambda addr, rssi: None
+    for addr in fleet.addrs:
+        fleet.app.rssiCache.entries[addr] = [-70.0, fleet.sim.clock.now]
+    def call(i):
+        fleet.app.onRadioMessage(frames[i % len(frames)])
+    def prepare(i):
+        if i % 1024 == 0:
+            home = fleet.app.shards.home
+            home.radioQueue = home.radioQueue.__class__()
+    return call, prepare
+
+def benchSendConfig(fleet):
+    state = {}
+    def prepare(i):
+        app = fleet.app
+        if "addr" in state:
+            app.shards.home.radioQueue.removeDestination(state["addr"])
+        addr = fleet.addrs[i % fleet.size]
+        state["addr"] = addr
+        node = app.nodes.at(addr)
+        node.config = fleet.config(node.id)
+        app.nodes.configuring.add(node.id)
+        app.nodes.sendingConfig.add(addr)
+    def call(i):
+        fleet.app.sendConfig(state["addr"])
+    return call, prepare
+
+def benchSetWakeup(fleet):
+    def call(i):
+        fleet.app.setWakeup(fleet.addrs[i % fleet.size])
+    return call, None
+
+def benchSendQueued(fleet):
+    app = fleet.app
+    shard = app.shards.home
+    payload = b"M" + b"\x01" * 16
+    for addr in fleet.addrs:
+        shard.radioQueue.push(app.formatRadioMessage(addr, "config", 0, payload), addr, "config")
+        if fleet.rnd.random() < 0.1:
+            shard.radioQueue.push(app.formatRadioMessage(addr, "ack", 0), addr, "ack")
+    def prepare(i):
+        fleet.sim.clock.now += TX_SPACING
+    def call(i):
+        app.sendQueued(shard, i % 12 == 11)
+    return call, prepare
+
+def benchMonitor(fleet):
+    def prepare(i):
+        fleet.sim.clock.now += fleet.sim.appModule.MONITOR_INTERVAL
+        fleet.app.lastClientMessage = fleet.sim.clock.now
+    def call(i):
+        fleet.app.monitor()
+    return call, prepare
+
+def benchClientBatch(fleet):
+    state = {}
+    def prepare(i):
+        ids = [fleet.ids[(i * CLIENT_BATCH + n) % fleet.size] for n in range(CLIENT_BATCH)]
+        state["message"] = {"function": "batch", "messages": [{"function": "config", "id": nodeID, \
+                            "config": fleet.config(nodeID)} for nodeID in ids]}
+        fleet.app.nodes.configuring.difference_update(ids)
+    def call(i):
+        fleet.app.onClientMessage(state["message"])
+    return call, prepare
+
+def benchSave(fleet):
+    def call(i):
+        fleet.app.save()
+    return call, None
+
+def benchLoadSaved(fleet):
+    fleet.app.save()
+    def call(i):
+        fleet.app.loadSaved()
+    return call, None
+
+BENCHMARKS = (
+    # name, setup, calls for a fleet of 1000 nodes, whether calls scale down with fleet size
+    ("formatRadioMessage", benchFormatRadioMessage, 20000, False),
+    ("onRadioMessage", benchOnRadioMessage, 10000, False),
+    ("sendConfig", benchSendConfig, 500, False),
+    ("setWakeup", benchSetWakeup, 20000, False),
+    ("sendQueued", benchSendQueued, 2000, False),
+    ("monitor", benchMonitor, 500, True),
+    ("clientBatch", benchClientBatch, 200, False),
+    ("save", benchSave, 20, True),
+    ("loadSaved", benchLoadSaved, 20, True)
+)
+
+def numCalls(calls, scaled, size):
+    if scaled:
+        calls = calls * 1000 // max(size, 1000)
+    return max(calls, 3)
+
+def measure(call, prepare, calls):
+    """ Returns per-call times in seconds. """
+    times = []
+    clock = spur_sim.wallClock
+    gc.collect()
+    for i in range(calls):
+        if prepare is not None:
+            prepare(i)
+        start = clock()
+        call(i)
+        times.append(clock() - start)
+    return times
+
+def measureAllocations(call, prepare, calls):
+    """ Peak bytes allocated per call, or net GC-tracked objects created per call. """
+    total = 0
+    if tracemalloc is not None:
+        tracemalloc.start()
+        for i in range(calls):
+            if prepare is not None:
+                prepare(i)
+            tracemalloc.reset_peak() if hasattr(tracemalloc, "reset_peak") else tracemalloc.clear_traces()
+            current = tracemalloc.get_traced_memory()[0]
+            call(i)
+            total += tracemalloc.get_traced_memory()[1] - current
+        tracemalloc.stop()
+        return "alloc_peak_bytes", total // calls
+    gc.collect()
+    gc.disable()
+    try:
+        for i in range(calls):
+            if prepare is not None:
+                prepare(i)
+            before = gc.get_count()[0]
+            call(i)
+            total += gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return "gc_objects", float(total) / calls
+
+def run(names, sizes, seed=1):
+    results = {}
+    for name, setup, calls, scaled in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for size in sizes:
+            key = "{}@{}".format(name, size)
+            n = numCalls(calls, scaled, size)
+            fleet = Fleet(size, seed)
+            call, prepare = setup(fleet)
+            times = measure(call, prepare, n)
+            warnings = fleet.app.simLogs.get("warning", 0)
+            fleet.close()
+            fleet = Fleet(size, seed)
+            call, prepare = setup(fleet)
+            allocKey, alloc = measureAllocations(call, prepare, min(n, 200))
+            fleet.close()
+            results[key] = {
+                "calls": n,
+                "ops_per_sec": n / sum(times) if sum(times) else 0,
+                "p50_us": spur_sim.percentile(times, 0.5) * 1e6,
+                "p99_us": spur_sim.percentile(times, 0.99) * 1e6,
+                allocKey: alloc,
+                "warnings": warnings
+            }
+            sys.stderr.write("{:28} {:>12.1f} ops/s  p99 {:>10.1f} us  {}\n".format(key, results[key]["ops_per_sec"], \
+                             results[key]["p99_us"], "{} warnings".format(warnings) if warnings else ""))
+    return results
+
+def pythonKey():
+    return "python{}.{}".format(*sys.version_info[:2])
+
+def loadBaselines():
+    if not os.path.isfile(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+def compare(results, baseline, tolerance):
+    """ Returns a list of regressions. A benchmark has regressed if both its calls per second and
+        its median call rate are worse than the baseline by more than tolerance, so that a few
+        slow calls on a busy machine, or timer resolution on very short calls, do not fail it alone.
+    """
+    regressions = []
+    for key, r in sorted(results.items()):
+        b = baseline.get(key)
+        if b is None:
+            continue
+        ratio = r["ops_per_sec"] / b["ops_per_sec"] if b["ops_per_sec"] else 1
+        medianRatio = b["p50_us"] / r["p50_us"] if r["p50_us"] else 1
+        r["vs_baseline"] = ratio
+        if ratio < 1 - tolerance and medianRatio < 1 - tolerance:
+            regressions.append("{}: {:.0f} ops/s, baseline {:.0f} ops/s ({:.0%}), median {:.0%} of baseline".format( \
+                               key, r["ops_per_sec"], b["ops_per_sec"], ratio, medianRatio))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the Spur app's reactor-thread entry points")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES), help="comma separated fleet sizes")
+    parser.add_argument("--only", default="", help="comma separated benchmark names")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--save", action="store_true", help="store the results as the baselines for this Python version")
+    args = parser.parse_args(argv)
+    names = [n for n in args.only.split(",") if n]
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    results = run(names, sizes, args.seed)
+    baselines = loadBaselines()
+    if args.save:
+        baselines.setdefault(pythonKey(), {}).update(results)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+        regressions = []
+    else:
+        regressions = compare(results, baselines.get(pythonKey(), {}), args.tolerance)
+    sys.stdout.write(json.dumps(results, indent=4, sort_keys=True) + "\n")
+    for r in regressions:
+        sys.stderr.write("REGRESSION " + r + "\n")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# spur_codec.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Encoding and decoding of Spur radio frames.
+
+Transmitted frames:
+Bytes 0-1:  destination
+Bytes 2-3:  source (bridge address)
+Byte 4:     function
+Byte 5:     length (4 + length of data)
+Bytes 6-9:  timestamp (always 0)
+Bytes 10-11: wakeup interval
+Bytes 12-:  data
+Beacons are only destination and source.
+
+Received frames have destination, source and function in bytes 0-4,
+a length byte at byte 9 and the payload from byte 10.
+"""
+
+import struct
+from binascii import hexlify
+
+FUNCTIONS = {
+    "include_req": 0x00,
+    "s_include_req": 0x01,
+    "include_grant": 0x02,
+    "reinclude": 0x04,
+    "config": 0x05,
+    "send_battery": 0x06,
+    "alert": 0x09,
+    "woken_up": 0x07,
+    "ack": 0x08,
+    "beacon": 0x0A,
+    "start": 0x0B,
+    "nack": 0x0C,
+    "include_not": 0x0D,
+    "configuring": 0x0E,
+    "reset": 0xFF
+}
+FUNCTION_NAMES = dict((value, key) for key, value in FUNCTIONS.items())
+
+HEADER            = struct.Struct(">HHBBIH")
+BEACON_HEADER     = struct.Struct(">HH")
+RX_HEADER         = struct.Struct(">HHB")
+RX_LENGTH         = struct.Struct(">b")
+INCLUDE_REQ       = struct.Struct(">Ibb")   # nodeID, version, rssi
+INCLUDE_REQ_SHORT = struct.Struct(">I")     # nodeID only
+ALERT             = struct.Struct(">Hbb")   # alertType, rssi, temperature
+ALERT_SHORT       = struct.Struct(">H")     # alertType only
+LENGTH_OFFSET     = 9
+PAYLOAD_START     = 10
+MIN_RX_LENGTH     = 6
+LONG_PAYLOAD      = 14                      # Value of the length byte when rssi & temperature are included
+
+class RadioFrame(object):
+    """ A received frame. payload is a memoryview onto the received data. """
+    __slots__ = ("destination", "source", "function", "length", "payload", "nodeID", "version", "rssi",
+                 "alertType", "temperature", "error")
+
+    def __init__(self, destination, source, function):
+        self.destination = destination
+        self.source      = source
+        self.function    = function
+        self.length      = None
+        self.payload     = None
+        self.nodeID      = None
+        self.version     = 0
+        self.rssi        = None
+        self.alertType   = None
+        self.temperature = None
+        self.error       = None
+
+    def hexPayload(self):
+        if self.payload is None:
+            return ""
+        return hexlify(self.payload.tobytes())
+
+def encodeFrame(destination, source, function, wakeupInterval, data=None):
+    if function == "beacon":
+        frame = BEACON_HEADER.pack(destination, source)
+    else:
+        length = 4 + len(data) if data else 4
+        frame = HEADER.pack(destination, source, FUNCTIONS[function], length, 0, wakeupInterval)
+    if data:
+        frame += data
+    return frame
+
+def encodeFrames(frames):
+    """ frames is an iterable of (destination, source, function, wakeupInterval, data) tuples. """
+    return [encodeFrame(*f) for f in frames]
+
+def decodeFrame(message):
+    """ Returns a RadioFrame, or None if message is too short to be a frame.
+        Problems with the payload are reported in the error attribute of the frame.
+    """
+    if len(message) < MIN_RX_LENGTH:
+        return None
+    view = memoryview(message)
+    destination, source, hexFunction = RX_HEADER.unpack_from(view)
+    frame = RadioFrame(destination, source, FUNCTION_NAMES.get(hexFunction, "undefined"))
+    if frame.function == "include_req":
+        try:
+            frame.length = RX_LENGTH.unpack_from(view, LENGTH_OFFSET)[0]
+            if frame.length == LONG_PAYLOAD:
+                frame.payload = view[PAYLOAD_START:PAYLOAD_START + INCLUDE_REQ_SHORT.size]
+                frame.nodeID = INCLUDE_REQ_SHORT.unpack_from(view, PAYLOAD_START)[0]
+                frame.rssi = 0
+            else:
+                frame.payload = view[PAYLOAD_START:PAYLOAD_START + INCLUDE_REQ.size]
+                frame.nodeID, frame.version, frame.rssi = INCLUDE_REQ.unpack_from(view, PAYLOAD_START)
+        except struct.error as ex:
+            frame.error = ex
+    elif frame.function == "alert":
+        try:
+            frame.length = RX_LENGTH.unpack_from(view, LENGTH_OFFSET)[0]
+            if frame.length == LONG_PAYLOAD:
+                frame.payload = view[PAYLOAD_START:PAYLOAD_START + ALERT.size]
+                frame.alertType, frame.rssi, frame.temperature = ALERT.unpack_from(view, PAYLOAD_START)
+            else:
+                frame.payload = view[PAYLOAD_START:PAYLOAD_START + ALERT_SHORT.size]
+                frame.alertType = ALERT_SHORT.unpack_from(view, PAYLOAD_START)[0]
+        except struct.error as ex:
+            frame.alertType = 0xFFFF
+            frame.error = ex
+    return frame
+
+def decodeFrames(messages):
+    return [decodeFrame(m) for m in messages]
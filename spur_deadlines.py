@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# spur_deadlines.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Deadlines by which each node should next have been heard from.
+
+Used like a dict of address: deadline, but also keeps a heap so that the
+deadlines that have passed can be found without looking at every node.
+Heap entries are not removed when a deadline is changed or deleted; they are
+dropped when they reach the top of the heap and no longer match.
+"""
+
+import heapq
+
+class Deadlines(object):
+    def __init__(self):
+        self.times = {}
+        self.heap  = []
+
+    def __len__(self):
+        return len(self.times)
+
+    def __contains__(self, key):
+        return key in self.times
+
+    def __iter__(self):
+        return iter(self.times)
+
+    def __getitem__(self, key):
+        return self.times[key]
+
+    def __setitem__(self, key, deadline):
+        self.times[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if len(self.heap) > 2 * len(self.times) + 64:
+            self.rebuild()
+
+    def __delitem__(self, key):
+        del self.times[key]
+
+    def get(self, key, default=None):
+        return self.times.get(key, default)
+
+    def pop(self, key, default=None):
+        return self.times.pop(key, default)
+
+    def earliest(self):
+        """ Returns the earliest deadline, or None if there are none. """
+        while self.heap and self.times.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def expired(self, now):
+        """ Removes and returns (key, deadline) for every deadline before now, earliest first. """
+        expired = []
+        while self.heap and self.heap[0][0] < now:
+            deadline, key = heapq.heappop(self.heap)
+            if self.times.get(key) == deadline:
+                del self.times[key]
+                expired.append((key, deadline))
+        return expired
+
+    def rebuild(self):
+        """ Drops stale heap entries. Called when they outnumber the live ones. """
+        self.heap = [(deadline, key) for key, deadline in self.times.items()]
+        heapq.heapify(self.heap)
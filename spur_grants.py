@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# spur_grants.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Batching of include_grants and include_nots into one broadcast frame.
+
+Each include_grant is queued for the node's new address like any other
+message, so it is retried and acknowledged per node. With batching on,
+the grants ready on a transmit tick are sent in one frame to GRANT_ADDRESS
+whose data is a list of GRANT records (node ID, address), as many as fit in
+the frame budget, instead of one frame each. A button that finds its node
+ID in record k of the frame acks after k * GRANT_ACK_SLOT seconds, so that
+the acks do not collide.
+
+Buttons that only read the first record still ack a grant that comes
+first. A grant that has been sent batched fallbackAttempts times without an
+ack is no longer batched, so from then on it is sent on its own frame.
+
+include_nots are not acked. The first copy of each is batched in the same
+way, with NOT records (node ID), and the copy repeated two seconds later
+is sent on its own.
+"""
+
+import struct
+from spur_codec import HEADER
+
+GRANT_ADDRESS     = 0xBB00
+GRANT             = struct.Struct(">IH")    # node ID, address
+NOT               = struct.Struct(">I")     # node ID
+GRANT_ACK_SLOT    = 0.05                    # Time between acks from the buttons in one grant frame, seconds
+FALLBACK_ATTEMPTS = 2                       # Batched sends of a grant before it is sent on its own
+
+class GrantBatcher(object):
+    def __init__(self, formatMessage, budget, enabled=False, fallbackAttempts=FALLBACK_ATTEMPTS):
+        self.formatMessage    = formatMessage   # formatMessage(destination, function, wakeup, data), as App.formatRadioMessage
+        self.budget           = budget
+        self.enabled          = enabled
+        self.fallbackAttempts = fallbackAttempts
+        self.frames           = 0
+        self.records          = 0
+        self.ackedBatched     = 0       # Grants acked after being sent only batched
+        self.ackedFallback    = 0       # Grants acked after being sent on their own
+
+    def batchable(self, m):
+        if "record" not in m:
+            return False
+        if m["function"] == "include_grant":
+            return m["attempt"] < self.fallbackAttempts
+        return True
+
+    def take(self, candidates, function, record, used=0):
+        """ Chooses the candidates of function to send in one frame with used bytes already in the tick.
+            Returns (message, chosen, the other candidates), with message None if fewer than two can go together.
+        """
+        if not self.enabled:
+            return None, [], candidates
+        room = (self.budget - used - HEADER.size) // record.size
+        chosen = [m for m in candidates if m["function"] == function and self.batchable(m)][:room]
+        if len(chosen) < 2:
+            return None, [], candidates
+        seqs = set(m["seq"] for m in chosen)
+        msg = self.formatMessage(GRANT_ADDRESS, function, 0, b"".join(m["record"] for m in chosen))  # Wakeup = 0 (stay awake 10s)
+        for m in chosen:
+            m["batched"] = m.get("batched", 0) + 1
+        self.frames += 1
+        self.records += len(chosen)
+        return msg, chosen, [m for m in candidates if m["seq"] not in seqs]
+
+    def takeGrants(self, candidates, used=0):
+        return self.take(candidates, "include_grant", GRANT, used)
+
+    def takeNots(self, candidates, used=0):
+        return self.take(candidates, "include_not", NOT, used)
+
+    def onAck(self, m):
+        if m.get("batched"):
+            if m["attempt"] > m["batched"]:
+                self.ackedFallback += 1
+            else:
+                self.ackedBatched += 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "frames": self.frames,
+            "records": self.records,
+            "mean_records_per_frame": float(self.records) / self.frames if self.frames else None,
+            "acked_batched": self.ackedBatched,
+            "acked_after_fallback": self.ackedFallback
+        }
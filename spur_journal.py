@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# spur_journal.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Persistence of the Spur app state as a snapshot plus an append-only journal.
+
+Nodes that have changed are marked and, flushDelay seconds later, the
+current record of every marked node is appended to the journal in one write. When the journal holds more than
+compactRecords records, a new snapshot is written and the journal truncated.
+On start, the snapshot is loaded and the journal replayed on top of it.
+
+Each snapshot has a generation, one more than the last, saved in the state
+as journalGeneration, and each record appended to the journal is stamped with
+the generation of the snapshot it follows. load() only replays records of
+the snapshot's generation, so that if the app stops after a new snapshot is
+written but before the old journal is removed, the old records, which the
+snapshot already holds, are not replayed over it. Snapshots and journals
+from before generations were kept are generation 0.
+
+Given run (Workers.run), the records and state are taken on the reactor
+thread and pickled and written in a worker thread, one write at a time and
+in the order they were made. compact(wait=True) writes in line, for use on
+stop; writes queued before it are then skipped, as the snapshot holds
+everything they would have written. load() always reads in line, as it is
+only used on start, before any adaptor or the client is connected.
+"""
+
+import os
+import pickle
+import threading
+from collections import OrderedDict, deque
+
+FLUSH_DELAY     = 2                     # Seconds to coalesce node changes before writing them
+COMPACT_RECORDS = 500                   # Write a new snapshot when the journal has this many records
+
+class StateJournal(object):
+    def __init__(self, path, callLater, getState, getRecord, flushDelay=FLUSH_DELAY, compactRecords=COMPACT_RECORDS, run=None):
+        self.path           = path
+        self.journalPath    = path + ".journal"
+        self.callLater      = callLater
+        self.getState       = getState      # Returns the complete state, for compaction
+        self.getRecord      = getRecord     # Returns the record for a node ID, or None if the node has been removed
+        self.flushDelay     = flushDelay
+        self.compactRecords = compactRecords
+        self.pending        = OrderedDict() # node IDs changed since the last flush
+        self.flushPending   = False
+        self.records        = 0             # Records in the journal since the last snapshot
+        self.generation     = 0             # Generation of the last snapshot
+        self.run            = run           # Runs a function in a worker thread and returns a Deferred, or None to write in line
+        self.writes         = deque()       # (sequence, function, args) waiting for the write in progress
+        self.writing        = False
+        self.sequence       = 0             # Sequence number of the last write made
+        self.written        = 0             # Sequence number of the last write done, changed with lock held
+        self.lock           = threading.Lock()
+
+    def record(self, nodeID):
+        self.pending[nodeID] = True
+        if not self.flushPending:
+            self.flushPending = True
+            self.callLater(self.flushDelay, self.flush)
+
+    def flush(self):
+        self.flushPending = False
+        if not self.pending:
+            return 0
+        records = [(nodeID, self.getRecord(nodeID)) for nodeID in self.pending]
+        self.pending.clear()
+        self.write(self.appendRecords, self.generation, records)
+        self.records += len(records)
+        if self.records >= self.compactRecords:
+            self.compact()
+        return len(records)
+
+    def compact(self, wait=False):
+        """ Writes a complete snapshot and truncates the journal. """
+        self.pending.clear()
+        self.records = 0
+        self.generation += 1
+        state = self.getState()
+        state["journalGeneration"] = self.generation
+        if wait:
+            self.writes.clear()
+            self.sequence += 1
+            self.locked(self.sequence, self.writeSnapshot, (state,))
+        else:
+            self.write(self.writeSnapshot, state)
+
+    def write(self, func, *args):
+        self.sequence += 1
+        if self.run is None:
+            self.locked(self.sequence, func, args)
+        else:
+            self.writes.append((self.sequence, func, args))
+            if not self.writing:
+                self.nextWrite()
+
+    def nextWrite(self, result=None):
+        if not self.writes:
+            self.writing = False
+            return
+        self.writing = True
+        sequence, func, args = self.writes.popleft()
+        self.run(self.locked, sequence, func, args).addCallbacks(self.nextWrite, self.nextWrite)
+
+    def locked(self, sequence, func, args):
+        with self.lock:
+            if sequence < self.written:
+                return
+            func(*args)
+            self.written = sequence
+
+    def appendRecords(self, generation, records):
+        with open(self.journalPath, "ab") as f:
+            for nodeID, record in records:
+                pickle.dump((generation, nodeID, record), f, pickle.HIGHEST_PROTOCOL)
+
+    def writeSnapshot(self, state):
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, self.path)
+        if os.path.isfile(self.journalPath):
+            os.remove(self.journalPath)
+
+    def load(self):
+        """ Returns the snapshot (or None) and a list of (node ID, record) from the journal.
+            Reading the journal stops at the first record that cannot be read, which is
+            where a write was interrupted. Records from before the snapshot are skipped.
+        """
+        state = None
+        records = []
+        if os.path.isfile(self.path):
+            with open(self.path, "rb") as f:
+                state = pickle.load(f)
+        self.generation = state.get("journalGeneration", 0) if state else 0
+        if os.path.isfile(self.journalPath):
+            with open(self.journalPath, "rb") as f:
+                while True:
+                    try:
+                        r = pickle.load(f)
+                    except Exception:  # EOFError at the end of the journal, anything else is a partial write
+                        break
+                    if len(r) == 2:
+                        r = (0,) + tuple(r)
+                    if r[0] == self.generation:
+                        records.append(r[1:])
+        self.records = len(records)
+        return state, records
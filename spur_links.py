@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# spur_links.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Per-node link estimates and retransmission timeouts.
+
+The round trip time from sending a message to receiving its ack is smoothed
+per node in the same way as TCP (RFC 6298): srtt and rttvar are updated from
+each sample and the timeout is srtt + 4 * rttvar, clamped to MIN_RTO and
+MAX_RTO. Following Karn's rule, only messages acked on their first attempt
+give a sample, since an ack for a resent message cannot be matched to one
+transmission.
+
+The loss rate per node is a moving average of the fraction of transmissions
+that were not acked. Each retry of a message waits BACKOFF + loss times
+longer than the one before, so retries to nodes with bad links are spread
+out more. Until a node has a sample, the timeout is INITIAL_RTO, and a node
+whose RSSI is below WEAK_RSSI is treated as having a loss rate of WEAK_LOSS.
+"""
+
+INITIAL_RTO = 9                         # Timeout before a node has an RTT sample, seconds (the old fixed retry interval)
+MIN_RTO     = 2                         # Allows for the transmit spacing and button processing time, seconds
+MAX_RTO     = 60                        # seconds
+BACKOFF     = 1.5                       # Multiplier per retry, increased by the loss rate
+RTT_ALPHA   = 0.125                     # Gain for srtt
+RTT_BETA    = 0.25                      # Gain for rttvar
+LOSS_ALPHA  = 0.2                       # Gain for the loss rate
+WEAK_RSSI   = -90                       # dBm
+WEAK_LOSS   = 0.5                       # Loss rate assumed for a weak node with no history
+
+class Link(object):
+    __slots__ = ("srtt", "rttvar", "loss", "samples", "sent", "retries", "acked", "dropped", "waits", "waitTotal", "maxWait")
+
+    def __init__(self):
+        self.srtt      = None
+        self.rttvar    = None
+        self.loss      = None
+        self.samples   = 0
+        self.sent      = 0
+        self.retries   = 0
+        self.acked     = 0
+        self.dropped   = 0
+        self.waits     = 0              # Messages sent for the first time
+        self.waitTotal = 0.0            # Time they waited at the head of the node's queue, seconds
+        self.maxWait   = 0.0
+
+class LinkEstimator(object):
+    def __init__(self, rssi=None):
+        self.rssi  = rssi               # Returns the last known RSSI for an address, or None
+        self.links = {}                 # address: Link
+
+    def __len__(self):
+        return len(self.links)
+
+    def link(self, addr):
+        l = self.links.get(addr)
+        if l is None:
+            l = self.links[addr] = Link()
+        return l
+
+    def rto(self, addr):
+        l = self.links.get(addr)
+        if l is None or l.srtt is None:
+            return INITIAL_RTO
+        return min(MAX_RTO, max(MIN_RTO, l.srtt + 4 * l.rttvar))
+
+    def lossRate(self, addr):
+        l = self.links.get(addr)
+        if l is not None and l.loss is not None:
+            return l.loss
+        rssi = self.rssi(addr) if self.rssi else None
+        if rssi is not None and rssi < WEAK_RSSI:
+            return WEAK_LOSS
+        return 0.0
+
+    def timeout(self, addr, attempt):
+        """ Time to wait for an ack to the attempt'th transmission of a message, starting at 1. """
+        return min(MAX_RTO, self.rto(addr) * (BACKOFF + self.lossRate(addr)) ** (attempt - 1))
+
+    def onSend(self, addr, attempt):
+        l = self.link(addr)
+        l.sent += 1
+        if attempt > 1:
+            l.retries += 1
+
+    def onWait(self, addr, wait):
+        """ A message was sent for the first time, wait seconds after it could have been. """
+        l = self.link(addr)
+        l.waits += 1
+        l.waitTotal += wait
+        l.maxWait = max(l.maxWait, wait)
+
+    def longestWaits(self, n):
+        """ (address, mean wait, max wait) for the n nodes with the longest waits. """
+        worst = sorted((l.maxWait, addr) for addr, l in self.links.items() if l.waits)[-n:]
+        return [(addr, self.links[addr].waitTotal / self.links[addr].waits, maxWait) for maxWait, addr in reversed(worst)]
+
+    def onAck(self, addr, rtt, attempts):
+        """ rtt is the time since the last transmission; attempts is how many transmissions it took. """
+        l = self.link(addr)
+        l.acked += 1
+        if attempts == 1:
+            if l.srtt is None:
+                l.srtt = rtt
+                l.rttvar = rtt / 2.0
+            else:
+                l.rttvar += RTT_BETA * (abs(l.srtt - rtt) - l.rttvar)
+                l.srtt += RTT_ALPHA * (rtt - l.srtt)
+            l.samples += 1
+        self.updateLoss(l, (attempts - 1.0) / attempts)
+
+    def onDrop(self, addr):
+        """ A message was given up on. """
+        l = self.link(addr)
+        l.dropped += 1
+        self.updateLoss(l, 1.0)
+
+    def updateLoss(self, l, lost):
+        if l.loss is None:
+            l.loss = lost
+        else:
+            l.loss += LOSS_ALPHA * (lost - l.loss)
+
+    def remove(self, addr):
+        self.links.pop(addr, None)
+
+    def stats(self):
+        links = list(self.links.values())
+        sampled = [l for l in links if l.srtt is not None]
+        return {
+            "nodes": len(links),
+            "sent": sum(l.sent for l in links),
+            "retries": sum(l.retries for l in links),
+            "acked": sum(l.acked for l in links),
+            "dropped": sum(l.dropped for l in links),
+            "mean_srtt": sum(l.srtt for l in sampled) / len(sampled) if sampled else None,
+            "mean_rto": sum(self.rto(a) for a in self.links) / len(links) if links else None,
+            "mean_loss": sum(l.loss or 0 for l in links) / len(links) if links else None,
+            "mean_wait": sum(l.waitTotal for l in links) / max(1, sum(l.waits for l in links))
+        }
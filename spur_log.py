@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# spur_log.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Level-gated logging for the Spur app.
+
+Messages are given as a format string and arguments, and are only formatted
+if the level is enabled for the subsystem. Arguments that are expensive to
+produce can be wrapped in lazy(), which defers the call until the message is
+formatted. Repetitive lines are rate limited per format string.
+
+Levels are given by name, or as numbers as in the logging module, which is
+how cbconfig gives CB_LOGGING_LEVEL.
+"""
+
+import time
+
+LEVELS = {
+    "debug": 10,
+    "info": 20,
+    "warning": 30,
+    "error": 40
+}
+SUBSYSTEMS       = ("radio", "config", "client", "monitor")
+DEFAULT_LEVEL    = "info"
+RATE_LIMIT_LINES = 20                   # Max number of lines with the same format string ...
+RATE_LIMIT_TIME  = 10                   # ... in this many seconds
+
+def levelNumber(level, default):
+    """ The threshold for a level name or number, or default if it is neither. """
+    if isinstance(level, int):
+        return level
+    return LEVELS.get(str(level).lower(), default)
+
+class lazy(object):
+    """ Calls func(*args, **kwargs) only when the message it is part of is formatted. """
+    __slots__ = ("func", "args", "kwargs")
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __format__(self, spec):
+        return format(self.func(*self.args, **self.kwargs), spec)
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+class Logger(object):
+    def __init__(self, cbLog, level=DEFAULT_LEVEL, levels=None, rateLimit=(RATE_LIMIT_LINES, RATE_LIMIT_TIME), clock=time.time):
+        self.cbLog     = cbLog
+        self.clock     = clock
+        self.rateLimit = rateLimit
+        self.windows   = {}             # format string: [window start, lines in window, lines suppressed]
+        self.setLevels(level, levels)
+
+    def setLevels(self, level, levels=None):
+        """ level applies to every subsystem unless overridden in levels, a dict of subsystem: level. """
+        default = levelNumber(level, LEVELS["info"])
+        self.thresholds = dict((s, default) for s in SUBSYSTEMS)
+        if levels:
+            for s, l in levels.items():
+                self.thresholds[s] = levelNumber(l, default)
+
+    def enabled(self, subsystem, level):
+        return LEVELS[level] >= self.thresholds.get(subsystem, LEVELS["info"])
+
+    def log(self, subsystem, level, fmt, *args):
+        if LEVELS[level] < self.thresholds.get(subsystem, LEVELS["info"]):
+            return
+        if self.rateLimit:
+            now = self.clock()
+            window = self.windows.get(fmt)
+            if window is None or now - window[0] > self.rateLimit[1]:
+                if window and window[2]:
+                    self.cbLog(level, "{} similar lines suppressed: {}".format(window[2], fmt))
+                window = self.windows[fmt] = [now, 0, 0]
+            window[1] += 1
+            if window[1] > self.rateLimit[0]:
+                window[2] += 1
+                return
+        self.cbLog(level, fmt.format(*args) if args else fmt)
+
+    def debug(self, subsystem, fmt, *args):
+        self.log(subsystem, "debug", fmt, *args)
+
+    def info(self, subsystem, fmt, *args):
+        self.log(subsystem, "info", fmt, *args)
+
+    def warning(self, subsystem, fmt, *args):
+        self.log(subsystem, "warning", fmt, *args)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# spur_memory.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Accounting of the memory held in the Spur app's per-node structures.
+
+Each structure is registered with a function that returns it. entries()
+only takes the length of each, so it is cheap enough to be a gauge.
+report() also estimates the bytes each holds with sys.getsizeof: the
+container itself plus what it holds, followed into dicts, lists, tuples,
+sets, deques and objects with __slots__ or a __dict__. For a large
+structure, sample of its entries are measured and the total scaled up from
+them, so a report does not walk the whole fleet. A structure registered
+with deep False, such as an index whose values are counted elsewhere, is
+measured as the container only.
+
+The figures are estimates: small ints and strings that Python shares are
+counted wherever they appear.
+"""
+
+import sys
+from collections import OrderedDict, deque
+from itertools import islice
+
+SAMPLE = 200                            # Entries measured per structure in a report
+
+def deepSize(obj, seen):
+    """ Bytes used by obj and everything it refers to that is not in seen. """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += deepSize(k, seen) + deepSize(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for v in obj:
+            size += deepSize(v, seen)
+    elif hasattr(obj, "__slots__"):
+        for name in obj.__slots__:
+            if hasattr(obj, name):
+                size += deepSize(getattr(obj, name), seen)
+    elif hasattr(obj, "__dict__"):
+        size += deepSize(obj.__dict__, seen)
+    return size
+
+def estimate(container, sample=SAMPLE):
+    """ Bytes used by container and its entries, measuring at most sample entries and scaling up. """
+    size = sys.getsizeof(container)
+    seen = set([id(container)])
+    measured = 0
+    count = 0
+    for item in islice(container, sample):
+        measured += deepSize(item, seen)
+        if isinstance(container, dict):
+            measured += deepSize(container[item], seen)
+        count += 1
+    if count:
+        size += measured * len(container) // count
+    return size
+
+class MemoryAccount(object):
+    def __init__(self, sample=SAMPLE):
+        self.sample     = sample
+        self.structures = OrderedDict() # name: (function returning the structure, deep)
+
+    def add(self, name, get, deep=True):
+        self.structures[name] = (get, deep)
+
+    def entries(self):
+        return dict((name, len(get())) for name, (get, deep) in self.structures.items())
+
+    def report(self):
+        structures = {}
+        total = 0
+        for name, (get, deep) in self.structures.items():
+            s = get()
+            size = estimate(s, self.sample) if deep else sys.getsizeof(s)
+            structures[name] = {"entries": len(s), "bytes": size}
+            total += size
+        return {"structures": structures, "total_bytes": total}
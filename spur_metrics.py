@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# spur_metrics.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Counters and histograms kept by the Spur app.
+
+Histograms have fixed bucket bounds, so observing a value is a bisect and an
+increment and memory does not grow with the number of observations.
+Percentiles are estimated as the upper bound of the bucket they fall in.
+snapshot() returns everything as a JSON-serialisable dict.
+"""
+
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600)   # seconds
+ATTEMPT_BUCKETS = tuple(range(1, 11))
+BYTE_BUCKETS    = (0, 8, 16, 24, 32, 40, 48, 56, 64, 96, 128, 256)
+LAG_BUCKETS     = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)                # seconds
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # The last bucket is for values above the highest bound
+        self.count  = 0
+        self.sum    = 0.0
+        self.max    = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        target = p * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": dict((str(b), c) for b, c in zip(self.bounds + ("inf",), self.counts) if c)
+        }
+
+class Metrics(object):
+    def __init__(self, clock=time.time):
+        self.clock      = clock
+        self.started    = clock()
+        self.counters   = {}            # name: count
+        self.histograms = {}            # name: Histogram
+        self.gauges     = {}            # name: function returning the current value
+
+    def inc(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value, bounds=LATENCY_BUCKETS):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram(bounds)
+        h.observe(value)
+
+    def gauge(self, name, func):
+        """ func is called when a snapshot is taken. """
+        self.gauges[name] = func
+
+    def snapshot(self):
+        uptime = self.clock() - self.started
+        return {
+            "uptime": uptime,
+            "counters": dict(self.counters),
+            "rates_per_hour": dict((k, v * 3600.0 / uptime) for k, v in self.counters.items()) if uptime > 0 else {},
+            "histograms": dict((k, h.snapshot()) for k, h in self.histograms.items()),
+            "gauges": dict((k, f()) for k, f in self.gauges.items())
+        }
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# spur_nodes.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Table of the buttons known to the Spur app.
+
+Each node is one Node record, indexed by node ID and by radio address.
+Status flags are sets: active, excluded and configuring hold node IDs, and
+requestBatteries, alert0AfterStart, includeGrants and sendingConfig hold
+addresses, because they belong to exchanges with the button over the radio.
+remove() takes a node out of the indexes and every flag in one go.
+
+shown is not saved: after a restart the first config for each screen is sent
+in full. Nor is lastSeen, the time a node was last heard from or given an
+address, which is the time of loading for nodes in the saved state. stale()
+uses it to find the nodes not active on this bridge that have been gone long
+enough to be forgotten. remove(keepAddress=True) forgets such a node but
+keeps its address in dormant, which is saved, so that the client can still
+assign it to this bridge: revive() makes it a node again.
+
+state() and load() convert to and from the snapshot format used before the
+table existed (id2addr, addr2id, activeNodes, ...), so saved state can be
+read by either. That format holds a placeholder node 0 at address 0, which
+the app before the table used when including buttons. state() writes it and
+load() skips it, so that it is never taken for a button. Both copy the
+wakeups of each node, which sendConfig changes in place, so that they can be
+pickled in a worker thread.
+"""
+
+import time
+
+PLACEHOLDER_ID   = 0                    # id2addr and addr2id entry kept for the app before the table
+PLACEHOLDER_ADDR = 0
+
+class Node(object):
+    __slots__ = ("id", "addr", "buttonState", "wakeupCount", "wakeups", "lastAlertType", "config", "shown", "lastSeen")
+
+    def __init__(self, nodeID, addr, lastSeen=None):
+        self.id            = nodeID
+        self.addr          = addr
+        self.lastSeen      = lastSeen   # Time last heard from or given an address
+        self.buttonState   = None
+        self.wakeupCount   = None
+        self.wakeups       = None       # button state: list of wakeup intervals
+        self.lastAlertType = None
+        self.config        = None       # Config from the client waiting to be sent to the button
+        self.shown         = None       # config key: digest of the last payload the button acked for it
+
+class NodeTable(object):
+    ID_FLAGS   = ("active", "excluded", "configuring")
+    ADDR_FLAGS = ("requestBatteries", "alert0AfterStart", "includeGrants", "sendingConfig")
+
+    def __init__(self, clock=time.time):
+        self.clock            = clock
+        self.byID             = {}
+        self.byAddr           = {}
+        self.active           = set()
+        self.excluded         = set()
+        self.configuring      = set()
+        self.requestBatteries = set()
+        self.alert0AfterStart = set()
+        self.includeGrants    = set()
+        self.sendingConfig    = set()
+        self.dormant          = {}      # node ID: address, of nodes forgotten while not active on this bridge
+
+    def __len__(self):
+        return len(self.byID)
+
+    def __contains__(self, nodeID):
+        return nodeID in self.byID
+
+    def __iter__(self):
+        return iter(list(self.byID.values()))
+
+    def get(self, nodeID):
+        return self.byID.get(nodeID)
+
+    def at(self, addr):
+        """ The node with radio address addr, or None. """
+        return self.byAddr.get(addr)
+
+    def activeAt(self, addr):
+        """ True if addr belongs to a node that is active on this bridge. """
+        node = self.byAddr.get(addr)
+        return node is not None and node.id in self.active
+
+    def addr(self, nodeID):
+        """ Raises KeyError if nodeID is not known. """
+        return self.byID[nodeID].addr
+
+    def id(self, addr):
+        """ Raises KeyError if no node has address addr. """
+        return self.byAddr[addr].id
+
+    def add(self, nodeID, addr):
+        """ Adds a node, or gives an existing node a new address. Returns the node. """
+        node = self.byID.get(nodeID)
+        if node is None:
+            self.dormant.pop(nodeID, None)
+            node = self.byID[nodeID] = Node(nodeID, addr, self.clock())
+        elif node.addr != addr:
+            node.lastSeen = self.clock()
+            if self.byAddr.get(node.addr) is node:
+                del self.byAddr[node.addr]
+            for flag in self.ADDR_FLAGS:
+                s = getattr(self, flag)
+                if node.addr in s:
+                    s.discard(node.addr)
+                    s.add(addr)
+            node.addr = addr
+        self.byAddr[addr] = node
+        return node
+
+    def remove(self, nodeID, keepAddress=False):
+        """ Removes a node and clears all its flags. Returns the node, or None if it was not known.
+            With keepAddress, the node's address is kept in dormant.
+        """
+        for flag in self.ID_FLAGS:
+            getattr(self, flag).discard(nodeID)
+        self.dormant.pop(nodeID, None)
+        node = self.byID.pop(nodeID, None)
+        if node is not None:
+            if self.byAddr.get(node.addr) is node:
+                del self.byAddr[node.addr]
+            for flag in self.ADDR_FLAGS:
+                getattr(self, flag).discard(node.addr)
+            if keepAddress:
+                self.dormant[nodeID] = node.addr
+        return node
+
+    def revive(self, nodeID):
+        """ The node for nodeID, made again from its address if it is dormant. Raises KeyError if nodeID is not known. """
+        node = self.byID.get(nodeID)
+        if node is None:
+            node = self.add(nodeID, self.dormant[nodeID])
+        return node
+
+    def stale(self, now, inactiveTTL, maxInactive):
+        """ The IDs of nodes not active on this bridge to forget: those that have not been seen for
+            inactiveTTL seconds, and the least recently seen beyond maxInactive of them.
+        """
+        stale = []
+        inactive = []
+        for node in self.byID.values():
+            if node.id not in self.active:
+                if now - node.lastSeen > inactiveTTL:
+                    stale.append(node.id)
+                else:
+                    inactive.append((node.lastSeen, node.id))
+        if len(inactive) > maxInactive:
+            inactive.sort()
+            stale.extend(nodeID for lastSeen, nodeID in inactive[:len(inactive) - maxInactive])
+        return stale
+
+    def state(self):
+        nodes = list(self.byID.values())
+        id2addr = {PLACEHOLDER_ID: PLACEHOLDER_ADDR}
+        id2addr.update((n.id, n.addr) for n in nodes)
+        addr2id = {PLACEHOLDER_ADDR: PLACEHOLDER_ID}
+        addr2id.update((addr, n.id) for addr, n in self.byAddr.items())
+        return {
+            "id2addr": id2addr,
+            "addr2id": addr2id,
+            "activeNodes": list(self.active),
+            "excludedNodes": list(self.excluded),
+            "buttonState": dict((n.addr, n.buttonState) for n in nodes if n.buttonState is not None),
+            "wakeupCount": dict((n.addr, n.wakeupCount) for n in nodes if n.wakeupCount is not None),
+            "wakeups": dict((n.addr, dict(n.wakeups)) for n in nodes if n.wakeups is not None),
+            "dormantNodes": dict(self.dormant)
+        }
+
+    def load(self, state):
+        self.__init__(self.clock)
+        now = self.clock()
+        for nodeID, addr in state["id2addr"].items():
+            if nodeID != PLACEHOLDER_ID:
+                self.byID[nodeID] = self.byAddr[addr] = Node(nodeID, addr, now)
+        self.active.update(state["activeNodes"])
+        self.excluded.update(state.get("excludedNodes", []))
+        self.active.discard(PLACEHOLDER_ID)
+        self.excluded.discard(PLACEHOLDER_ID)
+        self.dormant.update(state.get("dormantNodes", {}))
+        for k in ("buttonState", "wakeupCount", "wakeups"):
+            for addr, value in state[k].items():
+                if addr in self.byAddr:
+                    setattr(self.byAddr[addr], k, value)
+
+    def record(self, nodeID):
+        """ The journal record for a node, or None if it has been removed. """
+        node = self.byID.get(nodeID)
+        if node is None:
+            if nodeID in self.dormant:
+                return {"addr": self.dormant[nodeID], "dormant": True}
+            return None
+        return {
+            "addr": node.addr,
+            "active": nodeID in self.active,
+            "excluded": nodeID in self.excluded,
+            "buttonState": node.buttonState,
+            "wakeupCount": node.wakeupCount,
+            "wakeups": dict(node.wakeups) if node.wakeups is not None else None
+        }
+
+    def applyRecord(self, nodeID, record):
+        self.remove(nodeID)
+        if record is None:
+            return
+        if record.get("dormant"):
+            self.dormant[nodeID] = record["addr"]
+            return
+        node = self.add(nodeID, record["addr"])
+        if record["active"]:
+            self.active.add(nodeID)
+        if record["excluded"]:
+            self.excluded.add(nodeID)
+        node.buttonState = record["buttonState"]
+        node.wakeupCount = record["wakeupCount"]
+        node.wakeups = record["wakeups"]
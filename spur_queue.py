@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# spur_queue.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Radio message queue for the Spur app.
+
+Messages are held in a FIFO per destination. Only the message at the head of
+a destination's FIFO can be in flight (sent and waiting for an ack). Acks and
+include_nots are never acknowledged by buttons, so they are kept separately
+and sent once. Indexes are kept so that the work done on each transmit tick
+is proportional to the number of messages that are actually due.
+
+Each message has a priority class. Destinations whose head message is ready
+to send are indexed by the class of that message, and packFrame chooses
+which of the candidates for a tick to send, highest class first.
+
+Within a class, destinations take turns by deficit round robin. A
+destination joining the back of the ready list is given quantum bytes of
+credit, and each message sent to it uses its length. When a message is
+acked and the next one for the same destination has enough credit left,
+the destination keeps its turn and is offered ahead of the ready list, as
+the button is known to be awake. Otherwise it goes to the back with more
+credit. One destination per class has the turn at a time, and while it
+waits for an ack the ready list is served. A burst for one node is
+therefore sent while the button is listening, but no node takes more than
+quantum bytes per turn or holds up more than one other destination's place.
+"""
+
+import heapq
+import time
+from collections import deque, OrderedDict
+from itertools import islice
+
+FIRE_ONCE_FUNCTIONS = ("ack", "include_not")
+RETRY_INTERVAL      = 9                 # Resend a message if it has not been acked after this many seconds, unless markSent is given a timeout
+PRIORITIES          = {
+    "ack": 0,
+    "include_not": 0,
+    "include_grant": 1,
+    "start": 1,
+    "config": 2,
+    "send_battery": 3
+}
+DEFAULT_PRIORITY    = 2
+NUM_PRIORITIES      = 4
+MAX_CANDIDATES      = 16                # Max messages of one class considered for a frame
+QUANTUM             = 600               # Bytes a destination may be sent per turn, about one complete config
+
+def priority(function):
+    return PRIORITIES.get(function, DEFAULT_PRIORITY)
+
+def fillBudget(messages, budget):
+    """ Returns the subset of messages whose total length is largest without exceeding budget.
+        Where there is a choice, messages earlier in the list are preferred.
+    """
+    reach = {0: []}         # total length: indexes of the messages making it up
+    for i, m in enumerate(messages):
+        length = m["message"]["length"]
+        for total in sorted(reach, reverse=True):
+            newTotal = total + length
+            if newTotal <= budget and newTotal not in reach:
+                reach[newTotal] = reach[total] + [i]
+    return [messages[i] for i in reach[max(reach)]]
+
+def packFrame(messages, budget, used=0):
+    """ Chooses which of messages to send in a frame that already has used bytes in it.
+        Classes are filled in priority order. If the first message of the highest class
+        is bigger than the whole budget it could never fit, so it is sent on its own.
+    """
+    byClass = [[] for p in range(NUM_PRIORITIES)]
+    full = 0
+    for m in messages:
+        group = byClass[priority(m["function"])]
+        if len(group) < MAX_CANDIDATES:  # Only the first MAX_CANDIDATES of a class are considered
+            group.append(m)
+            if len(group) == MAX_CANDIDATES:
+                full += 1
+                if full == NUM_PRIORITIES:
+                    break
+    chosen = []
+    for group in byClass:
+        if not group:
+            continue
+        if not chosen and group[0]["message"]["length"] > budget:
+            return [group[0]]
+        fill = fillBudget(group, budget - used)
+        chosen.extend(fill)
+        used += sum(m["message"]["length"] for m in fill)
+        if used >= budget:
+            break
+    return chosen
+
+class RadioQueue(object):
+    def __init__(self, retryInterval=RETRY_INTERVAL, clock=time.time, quantum=QUANTUM):
+        self.retryInterval = retryInterval
+        self.clock         = clock
+        self.quantum       = quantum
+        self.fifos         = {}             # destination: deque of messages that need an ack
+        self.fireOnce      = OrderedDict()  # seq: ack or include_not message, in queue order
+        self.pending       = {}             # destination: number of queued messages of any type
+        self.inFlight      = {}             # destination: message sent and waiting for an ack
+        self.ready         = [OrderedDict() for p in range(NUM_PRIORITIES)]  # per class, destinations whose head has not been sent
+        self.inTurn        = [None] * NUM_PRIORITIES  # per class, the destination whose turn it is, or None
+        self.deficit       = {}             # destination: bytes it may still be sent this turn
+        self.retryHeap     = []             # (due time, seq, destination)
+        self.seq           = 0
+
+    def __len__(self):
+        return len(self.fireOnce) + sum(len(f) for f in self.fifos.values())
+
+    def push(self, msg, destination, function):
+        self.seq += 1
+        toQueue = {
+            "message": msg,
+            "destination": destination,
+            "function": function,
+            "attempt": 0,
+            "sentTime": 0,
+            "retryTime": None,
+            "seq": self.seq
+        }
+        self.pending[destination] = self.pending.get(destination, 0) + 1
+        if function in FIRE_ONCE_FUNCTIONS:
+            self.fireOnce[self.seq] = toQueue
+        else:
+            if destination not in self.fifos:
+                self.fifos[destination] = deque()
+            self.fifos[destination].append(toQueue)
+            if len(self.fifos[destination]) == 1:
+                self.setReady(toQueue)
+        return toQueue
+
+    def setReady(self, m, continuing=False):
+        """ continuing is set when the previous message for the destination has just been acked. """
+        destination = m["destination"]
+        p = priority(m["function"])
+        m["readyTime"] = self.clock()  # For the time it waits to be sent
+        deficit = self.deficit.get(destination, 0)
+        if continuing and self.inTurn[p] is None and deficit >= m["message"]["length"]:
+            self.inTurn[p] = destination
+        else:
+            self.deficit[destination] = deficit + self.quantum
+            self.ready[p][destination] = True
+
+    def clearReady(self, m):
+        self.ready[priority(m["function"])].pop(m["destination"], None)
+
+    def endTurn(self, destination):
+        for p, d in enumerate(self.inTurn):
+            if d == destination:
+                self.inTurn[p] = None
+
+    def hasPending(self, destination):
+        return destination in self.pending
+
+    def isInFlight(self, destination):
+        return destination in self.inFlight
+
+    def fireOnceMessages(self, limit=MAX_CANDIDATES):
+        """ Up to limit acks and include_nots in queue order, with at most one ack per destination.
+            The queue is walked only as far as needed, so a long queue costs no more per tick than
+            a short one. A list is returned so that messages can be discarded while iterating.
+        """
+        messages = []
+        ackDestinations = set()
+        for seq in self.fireOnce:
+            m = self.fireOnce[seq]
+            if m["function"] == "ack":
+                if m["destination"] in ackDestinations:
+                    continue
+                ackDestinations.add(m["destination"])
+            messages.append(m)
+            if len(messages) == limit:
+                break
+        return messages
+
+    def discard(self, m):
+        """ Removes an ack or include_not once it has been sent. """
+        if self.fireOnce.pop(m["seq"], None) is not None:
+            self.decPending(m["destination"])
+
+    def readyMessages(self, limit=MAX_CANDIDATES):
+        """ Up to limit head messages per class that have not yet been sent, highest class first.
+            Within a class, the destination whose turn it is comes first, then the ready list in order.
+        """
+        messages = []
+        for p, ready in enumerate(self.ready):
+            d = self.inTurn[p]
+            if d is not None and d not in self.inFlight:
+                messages.append(self.fifos[d][0])
+            messages.extend(self.fifos[d][0] for d in islice(ready, limit))
+        return messages
+
+    def markSent(self, m, now, timeout=None):
+        """ The message is due to be resent timeout seconds from now if it has not been acked. """
+        destination = m["destination"]
+        m["sentTime"] = now
+        m["retryTime"] = now + (self.retryInterval if timeout is None else timeout)
+        m["attempt"] += 1
+        if m["attempt"] == 1:
+            self.deficit[destination] = self.deficit.get(destination, 0) - m["message"]["length"]
+        self.clearReady(m)
+        self.inFlight[destination] = m
+        heapq.heappush(self.retryHeap, (m["retryTime"], m["seq"], destination))
+
+    def popDue(self, now):
+        """ Returns the next in-flight message whose retry time has passed, or None.
+            Heap entries for messages that have since been acked or resent are dropped here.
+        """
+        while self.retryHeap and self.retryHeap[0][0] <= now:
+            due, seq, destination = heapq.heappop(self.retryHeap)
+            m = self.inFlight.get(destination)
+            if m is not None and m["seq"] == seq and m["retryTime"] == due:
+                return m
+        return None
+
+    def nextDue(self):
+        """ Returns 0 if there are messages that can be sent now, otherwise the time of the next retry, or None. """
+        if self.fireOnce or any(self.ready) or any(d is not None and d not in self.inFlight for d in self.inTurn):
+            return 0
+        while self.retryHeap:
+            due, seq, destination = self.retryHeap[0]
+            m = self.inFlight.get(destination)
+            if m is not None and m["seq"] == seq and m["retryTime"] == due:
+                return due
+            heapq.heappop(self.retryHeap)
+        return None
+
+    def defer(self, m):
+        """ Puts a message returned by popDue back so that it is due again on the next tick. """
+        heapq.heappush(self.retryHeap, (m["retryTime"], m["seq"], m["destination"]))
+
+    def expedite(self, destination, now):
+        """ Makes the in-flight message for destination due now, if there is one. """
+        m = self.inFlight.get(destination)
+        if m is not None and m["retryTime"] > now:
+            m["retryTime"] = now
+            heapq.heappush(self.retryHeap, (now, m["seq"], destination))
+
+    def acknowledge(self, destination):
+        """ Removes the in-flight message for destination.
+            Returns the message (or None) and whether anything else is queued for destination.
+        """
+        m = self.inFlight.pop(destination, None)
+        if m is not None:
+            fifo = self.fifos[destination]
+            fifo.popleft()
+            self.endTurn(destination)  # Taken again by setReady if it has credit left
+            if fifo:
+                self.setReady(fifo[0], True)
+            else:
+                del self.fifos[destination]
+                self.deficit.pop(destination, None)
+            self.decPending(destination)
+        return m, destination in self.pending
+
+    def removeDestination(self, destination):
+        """ Removes every message for destination. Returns the removed messages. """
+        removed = []
+        if destination in self.fifos:
+            self.clearReady(self.fifos[destination][0])
+            removed.extend(self.fifos.pop(destination))
+        self.deficit.pop(destination, None)
+        self.endTurn(destination)
+        if destination in self.pending:
+            for seq, m in list(self.fireOnce.items()):
+                if m["destination"] == destination:
+                    removed.append(self.fireOnce.pop(seq))
+        self.inFlight.pop(destination, None)
+        self.pending.pop(destination, None)
+        return removed
+
+    def removeQueued(self, destination, test):
+        """ Removes the messages for destination that need an ack, have not been sent and
+            for which test(message) is true. Returns the removed messages.
+        """
+        fifo = self.fifos.get(destination)
+        if not fifo:
+            return []
+        inFlight = self.inFlight.get(destination)
+        removed = [m for m in fifo if m is not inFlight and test(m)]
+        if not removed:
+            return removed
+        head = fifo[0]
+        for m in removed:
+            fifo.remove(m)
+            self.decPending(destination)
+        if head in removed:
+            self.clearReady(head)
+            self.endTurn(destination)
+            if fifo:
+                self.setReady(fifo[0])
+        if not fifo:
+            del self.fifos[destination]
+            self.deficit.pop(destination, None)
+        return removed
+
+    def transfer(self, destination, other):
+        """ Moves every message for destination to queue other, keeping attempts, retry times and in-flight state. """
+        inFlight = self.inFlight.get(destination)
+        for m in self.removeDestination(destination):
+            other.adopt(m, m is inFlight)
+
+    def adopt(self, m, inFlight=False):
+        destination = m["destination"]
+        self.seq += 1
+        m["seq"] = self.seq
+        self.pending[destination] = self.pending.get(destination, 0) + 1
+        if m["function"] in FIRE_ONCE_FUNCTIONS:
+            self.fireOnce[self.seq] = m
+            return
+        if destination not in self.fifos:
+            self.fifos[destination] = deque()
+        self.fifos[destination].append(m)
+        if inFlight:
+            self.inFlight[destination] = m
+            heapq.heappush(self.retryHeap, (m["retryTime"], m["seq"], destination))
+        elif len(self.fifos[destination]) == 1:
+            self.setReady(m)
+
+    def decPending(self, destination):
+        self.pending[destination] -= 1
+        if self.pending[destination] == 0:
+            del self.pending[destination]
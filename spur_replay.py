@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# spur_replay.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Replays a trace recorded by the Spur app (config "trace_file", or
+spur_sim.py --trace) against the app in this tree.
+
+A fresh App is started under the simulator's stand-ins, from the node table
+and config in the trace, and each recorded input is given to it at the time
+it was recorded, on a virtual clock. By default this runs as fast as
+possible; --speed 1 runs in real time, --speed 10 ten times faster.
+
+What the app sends is compared with what was recorded up to the end of the
+trace. Radio frames are compared per destination as sequences of function,
+wakeup and payload, and client messages per node as sequences of functions.
+Beacons are only counted. The app's random choices are seeded from the
+trace, so a replay of a trace from the same build matches it, except where
+production timing differs from the recorded call times. The report includes the app's metrics, so throughput and latency
+can be compared between builds by replaying the same trace in each:
+
+    python spur_replay.py incident.trace
+    python spur_replay.py incident.trace --speed 1
+"""
+
+import argparse
+import base64
+import json
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import time
+from binascii import hexlify
+import spur_sim
+from spur_sim import VirtualClock, installStandIns, wallClock, APP_ID, TX_HEADER, FUNCTION_NAMES
+from spur_trace import readTrace, INPUTS, OUTPUTS, KIND_NAMES, STATE, ADAPTOR_OUT, CLIENT_OUT
+
+SHOW_DIFFERENCES = 10                   # Destinations whose differences are shown in the report
+SHOW_CONTEXT     = 5                    # Entries shown from where two sequences differ
+
+def describe(kind, args):
+    """ Yields (destination, entry) for an output, with destination None for beacons. """
+    if kind == ADAPTOR_OUT:
+        msg, adaptor = args
+        if "data" in msg:
+            frame = base64.b64decode(msg["data"])
+            if len(frame) < TX_HEADER.size:
+                yield None, "beacon"
+            else:
+                destination, source, function, length, timeStamp, wakeup = TX_HEADER.unpack_from(frame)
+                yield "radio {}".format(destination), "{} {} {}".format(FUNCTION_NAMES.get(function, function), wakeup, \
+                                                                        hexlify(frame[TX_HEADER.size:]))
+        else:
+            yield "adaptor {}".format(adaptor), msg.get("command", msg.get("request"))
+    else:
+        msg = args[0]
+        for m in msg["messages"] if msg.get("function") == "batch" else [msg]:
+            node = m.get("source", m.get("include_req", m.get("id")))
+            yield "client {}".format(node), m.get("function", m.get("status"))
+
+class Outputs(object):
+    def __init__(self):
+        self.counts    = {}             # kind name: {function: count}
+        self.sequences = {}             # destination: [entry, ...]
+
+    def add(self, kind, args):
+        counts = self.counts.setdefault(KIND_NAMES[kind], {})
+        for destination, entry in describe(kind, args):
+            function = entry.split(" ", 1)[0]
+            counts[function] = counts.get(function, 0) + 1
+            if destination is not None:
+                self.sequences.setdefault(destination, []).append(entry)
+
+    def compare(self, other):
+        """ Returns (destinations compared, differences) between self (recorded) and other (replayed). """
+        differences = []
+        destinations = sorted(set(self.sequences) | set(other.sequences))
+        for d in destinations:
+            a = self.sequences.get(d, [])
+            b = other.sequences.get(d, [])
+            if a != b:
+                at = next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+                differences.append({
+                    "to": d,
+                    "at": at,
+                    "recorded_length": len(a),
+                    "replayed_length": len(b),
+                    "recorded": a[at:at + SHOW_CONTEXT],
+                    "replayed": b[at:at + SHOW_CONTEXT]
+                })
+        return len(destinations), differences
+
+class AdaptorSink(object):
+    def __init__(self, replay, adaptorID):
+        self.replay = replay
+        self.id     = adaptorID
+
+    def fromApp(self, msg):
+        self.replay.replayed.add(ADAPTOR_OUT, (msg, self.id))
+
+class AdaptorSinks(object):
+    """ Stands in for the simulator's adaptorsByID, for whatever adaptor IDs the trace has. """
+    def __init__(self, replay):
+        self.replay = replay
+
+    def get(self, adaptorID):
+        return AdaptorSink(self.replay, adaptorID)
+
+class CloudSink(object):
+    def __init__(self, replay):
+        self.replay = replay
+
+    def fromApp(self, msg):
+        self.replay.replayed.add(CLIENT_OUT, (msg,))
+
+class Replay(object):
+    """ Takes the place of spur_sim.Simulation for the stand-ins. """
+    def __init__(self, path, seed=1, verbose=False, showWarnings=False):
+        spur_sim.Simulation.current = self
+        random.seed(seed)
+        self.path            = path
+        self.verbose         = verbose
+        self.showWarnings    = showWarnings
+        self.managerMessages = []
+        self.adaptorsByID    = AdaptorSinks(self)
+        self.cloud           = CloudSink(self)
+        self.recorded        = Outputs()
+        self.replayed        = Outputs()
+        self.inputs          = {}       # kind name: count
+        self.records         = readTrace(path)
+        self.fed             = False
+        self.end             = None
+        start, state, config = self.scan()
+        self.clock           = VirtualClock(start)
+        self.startTime       = start
+        self.configDir       = tempfile.mkdtemp(prefix="spur_replay_") + "/"
+        installStandIns(self.configDir)
+        import spur_app_a
+        spur_app_a.CB_CONFIG_DIR = self.configDir
+        spur_app_a.config.update(config)
+        spur_app_a.config["trace_file"] = None
+        if state is not None:
+            with open(self.configDir + APP_ID + ".savestate", "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        self.methods         = dict((kind, name) for name, kind in INPUTS.items())
+        self.app             = spur_app_a.App(["spur_replay"])
+        if verbose:
+            self.app.logger.setLevels("debug")
+
+    def scan(self):
+        """ The time of the first record, and the node table and config from the trace. """
+        start = None
+        for t, kind, args in readTrace(self.path):
+            if start is None:
+                start = t
+            if kind == STATE:
+                return start, args[0], args[1]
+        return start or 0.0, None, {}
+
+    def feed(self):
+        """ Schedules the next input, taking recorded outputs on the way. """
+        for t, kind, args in self.records:
+            self.end = t
+            if kind in OUTPUTS:
+                self.recorded.add(kind, args)
+            elif kind in self.methods:
+                self.clock.callLater(t - self.clock.now, self.deliver, kind, args)
+                return
+        self.fed = True
+
+    def deliver(self, kind, args):
+        name = self.methods[kind]
+        self.inputs[KIND_NAMES[kind]] = self.inputs.get(KIND_NAMES[kind], 0) + 1
+        getattr(self.app, name)(*args)
+        self.feed()
+
+    def run(self, speed=0):
+        """ speed is virtual seconds per wall second, or 0 for as fast as possible. """
+        self.feed()
+        wallStart = wallClock()
+        while self.clock.events and not (self.fed and self.clock.now >= self.end):
+            until = self.clock.events[0].time
+            if self.fed:
+                until = min(until, self.end)
+            if speed:
+                delay = (until - self.startTime) / speed - (wallClock() - wallStart)
+                if delay > 0:
+                    time.sleep(delay)
+            self.clock.runUntil(until)
+        return wallClock() - wallStart
+
+    def close(self):
+        """ Removes the app's config directory. """
+        shutil.rmtree(self.configDir, ignore_errors=True)
+
+    def report(self, wallSeconds):
+        compared, differences = self.recorded.compare(self.replayed)
+        inputs = sum(self.inputs.values())
+        return {
+            "trace": self.path,
+            "inputs": self.inputs,
+            "simulated_seconds": self.clock.now - self.startTime,
+            "wall_seconds": wallSeconds,
+            "inputs_per_wall_second": inputs / wallSeconds if wallSeconds > 0 else None,
+            "recorded": self.recorded.counts,
+            "replayed": self.replayed.counts,
+            "destinations_compared": compared,
+            "destinations_differing": len(differences),
+            "differences": differences[:SHOW_DIFFERENCES],
+            "app_logs": self.app.simLogs,
+            "metrics": self.app.metricsReport()
+        }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay a recorded Spur app trace against this build")
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=0, help="virtual seconds per wall second, 0 for as fast as possible")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="print every App log line")
+    parser.add_argument("--warnings", action="store_true", help="print App warnings")
+    args = parser.parse_args(argv)
+    replay = Replay(args.trace, args.seed, verbose=args.verbose, showWarnings=args.warnings)
+    wallSeconds = replay.run(args.speed)
+    report = replay.report(wallSeconds)
+    replay.close()
+    sys.stdout.write(json.dumps(report, indent=4, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# spur_rssi.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Outstanding get_rssi requests to the LPRS adaptor.
+
+The adaptor's rssi responses carry no reference to the request, but it
+answers requests in the order they were made, so responses are matched to
+the oldest outstanding request. Each request has its own callback and
+timeout. A request that times out has its callback called with rssi None.
+The adaptor may still answer it, so the next response is taken to be that
+late answer and discarded, not matched to the request after it. A timed out
+request that has not been answered within another timeout is taken never to
+be answered, so that a lost response does not put the matching out for good.
+
+RssiCache keeps a smoothed RSSI per node address, so that a recent value can
+be used without asking the adaptor.
+"""
+
+import time
+from collections import deque
+
+RSSI_TIMEOUT   = 2                      # Seconds to wait for the adaptor to answer a get_rssi
+RSSI_CACHE_TTL = 3600                   # Cached RSSI values older than this are not used, seconds
+RSSI_SMOOTHING = 0.25                   # Weight given to a new reading in the smoothed value
+
+class RssiRequests(object):
+    def __init__(self, sendRequest, callLater, timeout=RSSI_TIMEOUT):
+        self.sendRequest = sendRequest  # Sends one get_rssi command to the adaptor
+        self.callLater   = callLater
+        self.timeout     = timeout
+        self.outstanding = deque()      # [callback, args, timer]
+        self.late        = deque()      # Requests that timed out and may still be answered, oldest first
+        self.timeouts    = 0
+        self.discarded   = 0            # Late responses discarded
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def request(self, callback, *args):
+        """ Asks the adaptor for the RSSI and calls callback(rssi, *args) with the answer. """
+        r = [callback, args, None]
+        r[2] = self.callLater(self.timeout, self.onTimeout, r)
+        self.outstanding.append(r)
+        self.sendRequest()
+
+    def onResponse(self, rssi):
+        """ Returns False if there was no outstanding request for the response. """
+        if self.late:
+            self.late.popleft()
+            self.discarded += 1
+            return True
+        if not self.outstanding:
+            return False
+        callback, args, timer = self.outstanding.popleft()
+        if timer is not None:
+            timer.cancel()
+        callback(rssi, *args)
+        return True
+
+    def onTimeout(self, r):
+        try:
+            self.outstanding.remove(r)
+        except ValueError:
+            return
+        self.timeouts += 1
+        self.late.append(r)
+        self.callLater(self.timeout, self.forgetLate, r)
+        r[0](None, *r[1])
+
+    def forgetLate(self, r):
+        try:
+            self.late.remove(r)
+        except ValueError:
+            pass
+
+class RssiCache(object):
+    def __init__(self, ttl=RSSI_CACHE_TTL, smoothing=RSSI_SMOOTHING, clock=time.time):
+        self.ttl       = ttl
+        self.smoothing = smoothing
+        self.clock     = clock
+        self.entries   = {}             # address: [smoothed rssi, time of last reading]
+        self.hits      = 0
+        self.misses    = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, addr, rssi):
+        try:
+            rssi = float(rssi)
+        except (TypeError, ValueError):
+            return
+        now = self.clock()
+        entry = self.entries.get(addr)
+        if entry is None or now - entry[1] > self.ttl:
+            self.entries[addr] = [rssi, now]
+        else:
+            entry[0] += self.smoothing * (rssi - entry[0])
+            entry[1] = now
+
+    def get(self, addr):
+        """ Returns the smoothed RSSI for addr, or None if there is no recent reading. """
+        entry = self.entries.get(addr)
+        if entry is None or self.clock() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return int(round(entry[0]))
+
+    def peek(self, addr):
+        """ As get, but not counted as a hit or miss. """
+        entry = self.entries.get(addr)
+        if entry is None or self.clock() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def remove(self, addr):
+        self.entries.pop(addr, None)
+
+    def prune(self):
+        """ Drops readings older than the TTL. Returns how many were dropped. """
+        now = self.clock()
+        old = [addr for addr, entry in self.entries.items() if now - entry[1] > self.ttl]
+        for addr in old:
+            del self.entries[addr]
+        return len(old)
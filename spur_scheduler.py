@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# spur_scheduler.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Transmit scheduling for the Spur app.
+
+Instead of polling the radio queue every TX_SPACING seconds, a transmit tick
+is only scheduled when there is something to do: work has been queued
+(kick), a retry falls due, or a beacon slot is reached. Ticks are never
+closer together than TX_SPACING, so the adaptor sees the same frame rate as
+before under load.
+
+If given lag, each tick calls lag(seconds, beacon) with how late it ran:
+for a beacon, the time since the beacon was due, and otherwise the time
+since the tick was due. Anything else keeping the reactor busy shows up
+here first.
+"""
+
+import random
+import time
+
+TX_SPACING = 0.5                        # Minimum time between transmit ticks, seconds
+FIRST_BEACON_SLOTS = 6                  # Beacon slots, in units of TX_SPACING, before the first beacon
+
+def beaconSlots(rng=random):
+    """ Randomised number of TX_SPACING slots between beacons. """
+    return rng.randrange(10, 14, 2)
+
+class TxScheduler(object):
+    def __init__(self, callLater, send, nextDue, spacing=TX_SPACING, clock=time.time, lag=None, rng=random):
+        """ send(beacon) transmits one tick's worth of frames.
+            nextDue() returns the time at which more work is due, 0 if work is ready now, or None.
+        """
+        self.callLater  = callLater
+        self.send       = send
+        self.nextDue    = nextDue
+        self.spacing    = spacing
+        self.clock      = clock
+        self.lag        = lag
+        self.rng        = rng           # Source of beacon slots, so that a replay can make the same choices
+        self.running    = False
+        self.call       = None
+        self.callTime   = None
+        self.callDue    = None          # When the scheduled tick should run, which is now if callTime had passed
+        self.lastTx     = 0
+        self.nextBeacon = None
+        self.ticks      = 0
+
+    def start(self, delay):
+        if self.running:
+            return
+        self.running = True
+        now = self.clock()
+        self.nextBeacon = now + delay + FIRST_BEACON_SLOTS * self.spacing
+        self.schedule(now + delay)
+
+    def schedule(self, when):
+        """ Makes sure there is a tick at or before when. """
+        if self.call is not None and self.callTime <= when:
+            return
+        if self.call is not None:
+            self.call.cancel()
+        now = self.clock()
+        self.callTime = when
+        self.callDue = max(when, now)
+        self.call = self.callLater(max(0, when - now), self.tick)
+
+    def kick(self):
+        """ Called when work is queued. """
+        if self.running:
+            self.schedule(max(self.clock(), self.lastTx + self.spacing))
+
+    def tick(self):
+        self.call = None
+        now = self.clock()
+        beacon = now >= self.nextBeacon
+        self.ticks += 1
+        if self.lag is not None:
+            self.lag(now - (self.nextBeacon if beacon else self.callDue), beacon)
+        self.send(beacon)
+        self.lastTx = now
+        if beacon:
+            self.nextBeacon = now + (beaconSlots(self.rng) + 1) * self.spacing
+        when = self.nextBeacon
+        due = self.nextDue()
+        if due is not None:
+            when = min(when, max(due, now + self.spacing))
+        self.schedule(when)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# spur_screens.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Compilation of button display screens into config message payloads.
+
+Displays arrive from the client as base64 encoded text, one line per screen
+line. A "|" splits a line into left and right halves, which are drawn with
+boxes around them, and a leading "*" selects the large font. Compiled
+screens are cached by a hash of the display text, so the same screen sent
+to many buttons is only laid out once.
+
+Given run (Workers.run), prepare() compiles a display in a worker thread
+when its config arrives from the client, and the result is put in the cache
+on the reactor thread. By the time the button wakes and sendConfig asks for
+the display it is usually cached; if not, display() compiles it in line.
+"""
+
+import base64
+import hashlib
+import struct
+from functools import partial
+from collections import OrderedDict
+
+SCREEN_CACHE_SIZE = 256                 # Maximum number of compiled screens kept
+
+Y_STARTS = (
+    (38, 0, 0 ,0, 0),
+    (18, 56, 0, 0, 0),
+    (4, 34, 64, 0, 0),
+    (4, 26, 48, 70, 0),
+    (0, 20, 40, 60, 80)
+);
+
+SCREEN_HEADER = struct.Struct("cBcB")
+LINE_HEADER   = struct.Struct("cBcBcB")
+BOXES         = struct.Struct("cBcBcBBcBcBcBBcBcBcBBcBcBcBB")
+END           = struct.pack("cc", "E", "S")
+
+def box(y1, h1, y2, h2):
+    return BOXES.pack("X", 1, "Y", y1, "B", 0x62, h1, "X", 2, "Y", y2, "B", 0x60, h2, \
+                      "X", 0x65, "Y", y1, "B", 0x62, h1, "X", 0x66, "Y", y2, "B", 0x60, h2)
+
+# Boxes drawn around split lines, indexed by (number of lines, first line that is split).
+# If the first line is split, the box is the same whatever the number of lines.
+FIRST_LINE_BOXES = box(1, 0x5C, 2, 0x5A)
+BOX_SEGMENTS = {
+    (4, 1): box(0x18, 0x48, 0x19, 0x46),
+    (4, 2): box(0x2E, 0x30, 0x2F, 0x2E),
+    (4, 3): box(0x44, 0x18, 0x45, 0x16),
+    (3, 1): box(0x1E, 0x40, 0x1F, 0x3E),
+    (3, 2): box(0x44, 0x18, 0x45, 0x16),
+    (2, 1): box(0x30, 0x2F, 0x31, 0x2D)
+}
+
+def font(text):
+    """ Returns the font and text with any large font marker removed. """
+    if len(text) > 0 and text[0] == "*":
+        return 3, text[1:]
+    return 2, text
+
+def lineSegment(f, y_start, x, text):
+    """ The string is sent null padded to its length field, followed by a null. """
+    return LINE_HEADER.pack("F", f, "Y", y_start, x, len(text) + 1) + text + "\00\00"
+
+def compileDisplay(display):
+    """ Returns the segments for a base64 encoded display, without the screen header. """
+    lines = base64.b64decode(display).split("\n")
+    if "{{" in lines[0]:
+        del(lines[0])  #Remove a "special" first line
+    numLines = len(lines)
+    yStarts = Y_STARTS[numLines-1]
+    firstSplit = None
+    segments = []
+    for i, l in enumerate(lines):
+        ll = l.decode("utf-8").encode("latin-1", "ignore")
+        if "|" in l:
+            if firstSplit is None:
+                firstSplit = i
+            splitLine = ll.split("|")
+            for s, x in ((0, "l"), (1, "r")):
+                f, text = font(splitLine[s].strip())
+                segments.append(lineSegment(f, yStarts[i], x, text))
+        else:
+            f, text = font(ll)
+            segments.append(lineSegment(f, yStarts[i], "C", text))
+    if firstSplit == 0:
+        segments.append(FIRST_LINE_BOXES)
+    elif (numLines, firstSplit) in BOX_SEGMENTS:
+        segments.append(BOX_SEGMENTS[(numLines, firstSplit)])
+    segments.append(END)
+    return "".join(segments)
+
+class ScreenCache(object):
+    """ LRU cache of compiled displays, keyed by a hash of the display text. """
+    def __init__(self, maxEntries=SCREEN_CACHE_SIZE, run=None):
+        self.maxEntries = maxEntries
+        self.run        = run           # Runs a function in a worker thread and returns a Deferred, or None
+        self.screens    = OrderedDict()
+        self.compiling  = set()         # keys of displays being compiled in a worker thread
+        self.hits       = 0
+        self.misses     = 0
+        self.prepared   = 0
+
+    def __len__(self):
+        return len(self.screens)
+
+    def display(self, screen, display):
+        """ Returns the complete config payload for showing display as screen number screen. """
+        key = hashlib.sha1(display).digest()
+        body = self.screens.pop(key, None)
+        if body is None:
+            self.misses += 1
+            body = compileDisplay(display)
+        else:
+            self.hits += 1
+        self.store(key, body)
+        return SCREEN_HEADER.pack("S", screen, "R", 0) + body
+
+    def prepare(self, display):
+        """ Starts compiling display in a worker thread if it is not cached. """
+        if self.run is None:
+            return
+        key = hashlib.sha1(display).digest()
+        if key in self.screens or key in self.compiling:
+            return
+        self.compiling.add(key)
+        self.run(compileDisplay, display).addCallbacks(partial(self.prepareDone, key), partial(self.prepareFailed, key))
+
+    def prepareDone(self, key, body):
+        self.compiling.discard(key)
+        if key not in self.screens:
+            self.store(key, body)
+            self.prepared += 1
+
+    def prepareFailed(self, key, failure):
+        self.compiling.discard(key)  # display() will compile it in line and report the problem
+
+    def store(self, key, body):
+        if len(self.screens) >= self.maxEntries:
+            self.screens.popitem(last=False)
+        self.screens[key] = body
+
+    def stats(self):
+        return {"entries": len(self.screens), "hits": self.hits, "misses": self.misses, "prepared": self.prepared}
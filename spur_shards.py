@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# spur_shards.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Sharding of the button fleet across spur adaptors.
+
+Each shard is one spur adaptor on one radio channel, with its own radio
+queue, transmit scheduler (and so its own beacons) and RSSI requests. The
+channels to use are listed in config "channels"; adaptors are given them in
+turn, so with more adaptors than channels some share a channel.
+
+A node belongs to the shard that first hears it. Buttons cannot be told to
+change channel, so a node on its own channel stays on that shard. Adaptors
+on the same channel all hear a node in range of them. When a node whose
+shard is overloaded is heard by a shard with much less queued, heard()
+moves it there. This happens as the node's frame arrives, when the button is
+known to be listening, so the new shard can send to it straight away.
+
+The first shard exists before any adaptor has been found, so that messages
+queued early have somewhere to go, and is bound to the first spur adaptor.
+A frame received by two adaptors on the same channel arrives twice, and
+duplicate() recognises the second copy.
+"""
+
+import time
+from collections import deque, OrderedDict
+
+DEFAULT_CHANNEL  = 6
+SHARD_OVERLOAD   = 40                   # A shard with messages queued for more nodes than this...
+REBALANCE_FACTOR = 2                    # ...and this many times as many as another shard that hears one of its nodes sheds it
+DUPLICATE_WINDOW = 0.2                  # Copies of a frame from different adaptors within this time are duplicates, seconds
+MAX_INCLUDES     = 1000                 # include_reqs remembered while waiting for the client to answer them
+
+class Shard(object):
+    def __init__(self, index, channel):
+        self.index        = index
+        self.channel      = channel
+        self.adaptor      = None        # Adaptor ID, None until an adaptor is bound
+        self.radioQueue   = None
+        self.txScheduler  = None
+        self.rssiRequests = None
+        self.addrs        = set()       # Addresses of the nodes assigned to this shard
+
+    def load(self):
+        """ The number of nodes with messages queued. """
+        return len(self.radioQueue.pending)
+
+    def stats(self):
+        return {
+            "adaptor": self.adaptor,
+            "channel": self.channel,
+            "nodes": len(self.addrs),
+            "queue_depth": len(self.radioQueue),
+            "queued_nodes": len(self.radioQueue.pending),
+            "ticks": self.txScheduler.ticks
+        }
+
+class ShardTable(object):
+    def __init__(self, channels=None, overload=SHARD_OVERLOAD, clock=time.time):
+        self.channels   = channels or [DEFAULT_CHANNEL]
+        self.overload   = overload
+        self.clock      = clock
+        self.shards     = []
+        self.byAdaptor  = {}            # adaptor ID: Shard
+        self.byAddr     = {}            # address: Shard the node is assigned to
+        self.includes   = OrderedDict() # node ID: Shard that received its last include_req, oldest first
+        self.recent     = {}            # frame: (time, Shard) for frames received in the last DUPLICATE_WINDOW
+        self.recentList = deque()       # (time, frame) in order of arrival
+        self.moves      = 0
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    @property
+    def home(self):
+        return self.shards[0]
+
+    def add(self):
+        """ Adds a shard on the next channel. The caller gives it a queue, scheduler and RSSI requests. """
+        shard = Shard(len(self.shards), self.channels[len(self.shards) % len(self.channels)])
+        self.shards.append(shard)
+        return shard
+
+    def unbound(self):
+        """ The first shard without an adaptor, or None. """
+        for shard in self.shards:
+            if shard.adaptor is None:
+                return shard
+        return None
+
+    def bind(self, shard, adaptor):
+        shard.adaptor = adaptor
+        self.byAdaptor[adaptor] = shard
+
+    def forAdaptor(self, adaptor):
+        return self.byAdaptor.get(adaptor, self.home)
+
+    def forAddr(self, addr):
+        """ The shard a node is assigned to, or the home shard if it has not been heard. """
+        return self.byAddr.get(addr, self.home)
+
+    def assign(self, addr, shard):
+        old = self.byAddr.get(addr)
+        if old is shard:
+            return
+        if old is not None:
+            old.addrs.discard(addr)
+        self.byAddr[addr] = shard
+        shard.addrs.add(addr)
+
+    def heard(self, addr, shard):
+        """ Called when shard receives a frame from addr. Returns the shard addr was moved from, or None.
+            The caller moves the queued messages.
+        """
+        assigned = self.byAddr.get(addr)
+        if assigned is None:
+            self.assign(addr, shard)
+        elif assigned is not shard:
+            load = assigned.load()
+            if load > self.overload and load > REBALANCE_FACTOR * shard.load():
+                self.assign(addr, shard)
+                self.moves += 1
+                return assigned
+        return None
+
+    def heardInclude(self, nodeID, shard):
+        """ Only the latest MAX_INCLUDES are kept, as the client does not answer every include_req. """
+        self.includes.pop(nodeID, None)
+        self.includes[nodeID] = shard
+        if len(self.includes) > MAX_INCLUDES:
+            self.includes.popitem(last=False)
+
+    def popInclude(self, nodeID):
+        """ The shard that heard nodeID's include_req, which should send the reply. """
+        return self.includes.pop(nodeID, self.home)
+
+    def remove(self, addr):
+        shard = self.byAddr.pop(addr, None)
+        if shard is not None:
+            shard.addrs.discard(addr)
+
+    def duplicate(self, frame, shard):
+        """ True if frame is a copy of one already received by another shard. """
+        if len(self.shards) < 2:
+            return False
+        now = self.clock()
+        while self.recentList and now - self.recentList[0][0] > DUPLICATE_WINDOW:
+            t, f = self.recentList.popleft()
+            if f in self.recent and self.recent[f][0] == t:
+                del self.recent[f]
+        seen = self.recent.get(frame)
+        if seen is not None and seen[1] is not shard:
+            return True
+        self.recent[frame] = (now, shard)
+        self.recentList.append((now, frame))
+        return False
+
+    def stats(self):
+        return {"shards": [s.stats() for s in self.shards], "moves": self.moves}
@@ -0,0 +1,695 @@
+#!/usr/bin/env python
+# spur_sim.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Local fleet simulator for the Spur app.
+
+Runs App in-process with stand-ins for cbcommslib, cbconfig and the Twisted
+reactor, under a virtual clock that also replaces time.time. The stand-in
+LPRS adaptor carries frames between App and a fleet of simulated buttons,
+with random loss and collisions between button transmissions. The stand-in
+cloud client grants inclusion and sends config to new buttons. With
+--update-interval it also resends complete configs with one screen changed,
+as the portal does when a screen is edited. With --cloud-batch it sends
+everything due within CLOUD_DELAY as one batch message, as the portal does
+for a site rollout.
+
+Usage:
+    python spur_sim.py --buttons 200 --hours 168 --loss 0.05
+
+Simulated buttons:
+- send include_req until they are granted an address, then ack the grant
+- ack every data message (config, start, send_battery, ...) addressed to them
+- obey the wakeup interval in each frame: 0 keeps them awake for
+  AWAKE_TIMEOUT seconds, otherwise they sleep for 2 * wakeup seconds and
+  then send woken_up
+- are pressed at random, sending an alert that is retried if not acked
+- read every record of a batched include_grant (--batch-grants), and ack
+  after a delay that depends on the record's position, except for the
+  fraction given by --old-firmware, which only read the first record
+- are spread over --channels radio channels and are heard by, and hear,
+  every adaptor on their channel; --adaptors sets the number of adaptors,
+  which the app gives channels in turn
+"""
+
+import sys
+import time
+import types
+import heapq
+import random
+import struct
+import base64
+import argparse
+import tempfile
+import shutil
+import json
+import logging
+
+AWAKE_TIMEOUT    = 10                   # Time a button stays awake after a wakeup of 0, seconds
+IDLE_SLEEP       = 60                   # Time a button sleeps if it hears nothing while awake, seconds
+RESPONSE_JITTER  = 0.05                 # Buttons answer after a random delay of up to this, seconds
+ACK_TIMEOUT      = 3                    # Time a button waits for an ack before retrying, seconds
+BUTTON_RETRIES   = 3                    # Times a button retries an alert or woken_up
+REJOIN_WAKEUPS   = 5                    # Unacked woken_ups after which a button asks to be included again
+INCLUDE_RETRY    = 30                   # Time between include_reqs from an unincluded button, seconds
+BYTE_TIME        = 0.0002               # Airtime per byte, seconds
+ADAPTOR_DELAY    = 0.02                 # Adaptor processing time, seconds
+CLOUD_DELAY      = 0.2                  # Round trip to the cloud client, seconds
+POWER_ON_SPREAD  = 60                   # Buttons are switched on at random within this time, seconds
+COMMISSION_SPREAD = 10                  # The same for a box of buttons being commissioned, seconds
+COMMISSION_LIMIT = 7200                 # Longest a commissioning run is simulated for, seconds
+GRANT_ACK_SLOT   = 0.05                 # Buttons granted in record k of a grant frame ack after k of these, seconds
+GRANT_ADDRESS    = 0xBB00
+BEACON_ADDRESS   = 0xBBBB
+BRIDGE_ADDRESS   = 42
+BRIDGE_ID        = "BID42"
+FIRST_CHANNEL    = 6
+APP_ID           = "AID1"
+FUNCTIONS = {
+    "include_req": 0x00,
+    "include_grant": 0x02,
+    "config": 0x05,
+    "send_battery": 0x06,
+    "woken_up": 0x07,
+    "ack": 0x08,
+    "alert": 0x09,
+    "start": 0x0B,
+    "nack": 0x0C,
+    "include_not": 0x0D,
+    "reset": 0xFF
+}
+FUNCTION_NAMES = dict((value, key) for key, value in FUNCTIONS.items())
+TX_HEADER = struct.Struct(">HHBBIH")    # As sent by the bridge
+
+wallClock = time.time                   # time.time is replaced by the virtual clock once the stand-ins are installed
+
+def mean(values):
+    """ The mean of values, or None if any is None. """
+    if not values or any(v is None for v in values):
+        return None
+    return float(sum(values)) / len(values)
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class DelayedCall(object):
+    def __init__(self, clock, when, seq, func, args, kwargs):
+        self.clock     = clock
+        self.time      = when
+        self.seq       = seq
+        self.func      = func
+        self.args      = args
+        self.kwargs    = kwargs
+        self.cancelled = False
+        self.called    = False
+
+    def __lt__(self, other):
+        return (self.time, self.seq) < (other.time, other.seq)
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock(object):
+    """ Stands in for time.time and reactor.callLater. """
+    def __init__(self, start=1500000000.0):
+        self.now    = start
+        self.events = []
+        self.seq    = 0
+        self.calls  = 0
+
+    def time(self):
+        return self.now
+
+    def callLater(self, delay, func, *args, **kwargs):
+        self.seq += 1
+        call = DelayedCall(self, self.now + max(0, delay), self.seq, func, args, kwargs)
+        heapq.heappush(self.events, call)
+        return call
+
+    def runUntil(self, until):
+        while self.events and self.events[0].time <= until:
+            call = heapq.heappop(self.events)
+            if call.cancelled:
+                continue
+            self.now = call.time
+            call.called = True
+            self.calls += 1
+            call.func(*call.args, **call.kwargs)
+        self.now = until
+
+class SimClient(object):
+    """ Stands in for cbcommslib.CbClient. """
+    def __init__(self, aid, cid, keepalive):
+        self.aid = aid
+        self.cid = cid
+
+    def send(self, msg):
+        Simulation.current.cloud.fromApp(msg)
+
+    def receive(self, message):
+        self.onClientMessage(message)
+
+class SimCbApp(object):
+    """ Stands in for cbcommslib.CbApp. """
+    def __init__(self, argv):
+        self.id = APP_ID
+        self.simLogs = {}
+
+    def cbLog(self, level, msg):
+        self.simLogs[level] = self.simLogs.get(level, 0) + 1
+        sim = Simulation.current
+        if sim.verbose or (level in ("warning", "error") and sim.showWarnings):
+            sys.stdout.write("{:12.2f} {:8} {}\n".format(sim.clock.now - sim.startTime, level, msg))
+
+    def sendMessage(self, msg, dest):
+        adaptor = Simulation.current.adaptorsByID.get(dest)
+        if adaptor is not None:
+            adaptor.fromApp(msg)
+
+    def sendManagerMessage(self, msg):
+        Simulation.current.managerMessages.append(msg)
+
+class SimReactor(types.ModuleType):
+    def callLater(self, delay, func, *args, **kwargs):
+        return Simulation.current.clock.callLater(delay, func, *args, **kwargs)
+
+class SimFailure(object):
+    def __init__(self, ex):
+        self.type  = type(ex)
+        self.value = ex
+
+class SimDeferred(object):
+    """ Stands in for an already fired twisted Deferred. """
+    def __init__(self, result=None, failure=None):
+        self.result  = result
+        self.failure = failure
+
+    def addCallbacks(self, callback, errback):
+        try:
+            if self.failure is None:
+                self.result = callback(self.result)
+            else:
+                self.result = errback(self.failure)
+            self.failure = self.result if isinstance(self.result, SimFailure) else None
+        except Exception as ex:
+            self.failure = SimFailure(ex)
+        return self
+
+class SimThreads(types.ModuleType):
+    def deferToThread(self, func, *args, **kwargs):
+        """ Runs func straight away, as if a worker thread had finished it before the reactor looked again. """
+        try:
+            return SimDeferred(func(*args, **kwargs))
+        except Exception as ex:
+            return SimDeferred(failure=SimFailure(ex))
+
+def installStandIns(configDir):
+    """ Makes App importable without cbcommslib, cbconfig or Twisted, and replaces time.time.
+        Work given to worker threads is done in line.
+    """
+    cbcommslib = types.ModuleType("cbcommslib")
+    cbcommslib.CbApp = SimCbApp
+    cbcommslib.CbClient = SimClient
+    cbconfig = types.ModuleType("cbconfig")
+    cbconfig.CB_BID = BRIDGE_ID
+    cbconfig.CB_CONFIG_DIR = configDir
+    cbconfig.CB_LOGGING_LEVEL = logging.INFO
+    cbconfig.configFile = configDir + "spur_app.config"
+    reactor = SimReactor("twisted.internet.reactor")
+    twisted = types.ModuleType("twisted")
+    internet = types.ModuleType("twisted.internet")
+    twisted.internet = internet
+    internet.reactor = reactor
+    internet.threads = SimThreads("twisted.internet.threads")
+    for name, module in (("cbcommslib", cbcommslib), ("cbconfig", cbconfig), ("twisted", twisted), \
+                         ("twisted.internet", internet), ("twisted.internet.reactor", reactor), \
+                         ("twisted.internet.threads", internet.threads)):
+        sys.modules[name] = module
+    time.time = lambda: Simulation.current.clock.now
+
+class SimButton(object):
+    def __init__(self, sim, nodeID, pressInterval, oldFirmware=False):
+        self.sim           = sim
+        self.id            = nodeID
+        self.addr          = None
+        self.oldFirmware   = oldFirmware    # Only reads the first record of an include_grant
+        self.includeReqAt  = None       # Time the first include_req was sent
+        self.includedAt    = None
+        self.startedAt     = None       # Time the first start was received
+        self.channel       = FIRST_CHANNEL
+        self.awake         = True
+        self.pressInterval = pressInterval
+        self.state         = 0
+        self.timer         = None
+        self.waitingFor    = None       # (function, time first sent) of a frame waiting for an ack
+        self.unacked       = 0          # woken_ups in a row that were not acked
+        self.rssi          = random.randint(-95, -40)
+        self.stats         = {"alerts": 0, "woken_up": 0, "include_reqs": 0, "retries": 0, "acked": 0, \
+                              "data_received": 0, "lost_alerts": 0, "rejoins": 0}
+        self.ackLatency    = []
+
+    def setTimer(self, delay, func, *args):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.sim.clock.callLater(delay, func, *args)
+
+    def start(self, delay):
+        self.setTimer(delay, self.sendIncludeReq)
+        if self.pressInterval:
+            self.sim.clock.callLater(delay + random.expovariate(1.0 / self.pressInterval), self.press)
+
+    def transmit(self, function, payload="", delay=0):
+        source = self.addr if self.addr is not None else 0
+        frame = struct.pack(">HHB", BRIDGE_ADDRESS, source, FUNCTIONS[function]) + "\0" * 4 + \
+                struct.pack(">b", 10 + len(payload)) + payload
+        delay += random.random() * RESPONSE_JITTER
+        for adaptor in self.sim.adaptors:
+            if adaptor.channel == self.channel:
+                self.sim.clock.callLater(delay, adaptor.fromButton, self, frame)
+
+    def sendIncludeReq(self):
+        if self.addr is not None:
+            return
+        self.awake = True
+        self.stats["include_reqs"] += 1
+        if self.includeReqAt is None:
+            self.includeReqAt = self.sim.clock.now
+        self.transmit("include_req", struct.pack(">Ibb", self.id, 1, self.rssi))
+        self.setTimer(INCLUDE_RETRY * (0.5 + random.random()), self.sendIncludeReq)
+
+    def sendWaiting(self, function, payload="", attempt=0, firstSent=None):
+        """ Sends a frame that the bridge should ack, retrying if it does not. """
+        if attempt > BUTTON_RETRIES:
+            if function == "alert":
+                self.stats["lost_alerts"] += 1
+            self.waitingFor = None
+            if function == "woken_up":
+                self.unacked += 1
+                if self.unacked >= REJOIN_WAKEUPS:
+                    self.rejoin()
+                    return
+            self.sleep(IDLE_SLEEP)
+            return
+        if attempt > 0:
+            self.stats["retries"] += 1
+        self.awake = True
+        firstSent = self.sim.clock.now if firstSent is None else firstSent
+        self.waitingFor = (function, firstSent)
+        self.transmit(function, payload)
+        self.setTimer(ACK_TIMEOUT, self.sendWaiting, function, payload, attempt + 1, firstSent)
+
+    def rejoin(self):
+        """ Forgets the address and asks to be included again. """
+        self.stats["rejoins"] += 1
+        self.sim.buttonsByAddr.pop(self.addr, None)
+        self.addr = None
+        self.unacked = 0
+        self.setTimer(1, self.sendIncludeReq)
+
+    def press(self):
+        if self.addr is not None:
+            self.state = 1 if self.state != 1 else 2
+            self.stats["alerts"] += 1
+            self.sendWaiting("alert", struct.pack(">Hbb", self.state, self.rssi, 20))
+        self.sim.clock.callLater(random.expovariate(1.0 / self.pressInterval), self.press)
+
+    def wake(self):
+        self.stats["woken_up"] += 1
+        self.sendWaiting("woken_up")
+
+    def sleep(self, seconds):
+        self.awake = False
+        self.setTimer(seconds, self.wake)
+
+    def applyWakeup(self, wakeup):
+        if wakeup == 0:
+            self.awake = True
+            self.setTimer(AWAKE_TIMEOUT, self.sleep, IDLE_SLEEP)
+        else:
+            self.sleep(wakeup * 2)
+
+    def receive(self, destination, function, wakeup, data):
+        if not self.awake:
+            return
+        if function == "include_grant":
+            records = 1 if self.oldFirmware else len(data) // 6
+            for k in range(records):
+                nodeID, addr = struct.unpack_from(">IH", data, k * 6)
+                if nodeID == self.id and self.addr in (None, addr):  # A repeated grant means the ack was lost
+                    self.addr = addr
+                    if self.includedAt is None:
+                        self.includedAt = self.sim.clock.now
+                    self.sim.buttonsByAddr[addr] = self
+                    self.transmit("ack", delay=k * GRANT_ACK_SLOT)
+                    self.applyWakeup(wakeup)
+        elif function == "include_not":
+            records = 1 if self.oldFirmware else len(data) // 4
+            if self.id in struct.unpack(">{}I".format(records), data[:records * 4]):
+                self.setTimer(INCLUDE_RETRY * 10, self.sendIncludeReq)
+        elif destination == self.addr:
+            if function in ("ack", "nack"):
+                self.unacked = 0
+                if self.waitingFor is not None:
+                    self.stats["acked"] += 1
+                    self.ackLatency.append(self.sim.clock.now - self.waitingFor[1])
+                    self.waitingFor = None
+                self.applyWakeup(wakeup)
+            else:
+                self.stats["data_received"] += 1
+                if function == "start" and self.startedAt is None:
+                    self.startedAt = self.sim.clock.now
+                self.transmit("ack")
+                if function == "send_battery":
+                    self.sendWaiting("alert", struct.pack(">Hbb", 0x0200 | 120, self.rssi, 20))
+                elif function == "reset":
+                    self.rejoin()
+                else:
+                    self.applyWakeup(wakeup)
+
+class SimAdaptor(object):
+    """ Stands in for an LPRS adaptor and what it can hear of its radio channel. """
+    def __init__(self, sim, adaptorID, loss):
+        self.sim        = sim
+        self.id         = adaptorID
+        self.channel    = None          # Set by the app's service request
+        self.loss       = loss
+        self.inAir      = []            # [end of transmission, collided] for button frames
+        self.lastRssi   = 0
+        self.stats      = {"tx_frames": 0, "tx_bytes": 0, "beacons": 0, "rx_frames": 0, "rx_bytes": 0, \
+                           "lost": 0, "collisions": 0, "rssi_requests": 0, "peak_heard_per_10s": 0, \
+                           "grant_frames": 0, "grant_bytes": 0}
+        self.window     = [None, 0]     # 10 second window, button frames heard in it
+
+    def fromApp(self, msg):
+        if msg.get("request") == "service":
+            for s in msg["service"]:
+                if s["characteristic"] == "spur":
+                    self.channel = s["channel"]
+        elif msg.get("request") == "command" and msg.get("command") == "get_rssi":
+            self.stats["rssi_requests"] += 1
+            self.sim.clock.callLater(ADAPTOR_DELAY, self.sim.app.onAdaptorData, \
+                                     {"id": self.id, "characteristic": "rssi", "data": self.lastRssi})
+        elif "data" in msg:
+            frame = base64.b64decode(msg["data"])
+            self.stats["tx_frames"] += 1
+            self.stats["tx_bytes"] += len(frame)
+            if len(frame) < TX_HEADER.size:
+                self.stats["beacons"] += 1
+                return
+            destination, source, function, length, timeStamp, wakeup = TX_HEADER.unpack_from(frame)
+            function = FUNCTION_NAMES.get(function, "undefined")
+            data = frame[TX_HEADER.size:]
+            if function == "include_grant":
+                self.stats["grant_frames"] += 1
+                self.stats["grant_bytes"] += len(frame)
+            delay = ADAPTOR_DELAY + len(frame) * BYTE_TIME
+            if destination == GRANT_ADDRESS:
+                buttons = self.sim.buttons      # Buttons check the node ID in grants themselves
+            else:
+                buttons = [self.sim.buttonsByAddr[destination]] if destination in self.sim.buttonsByAddr else []
+            for b in [b for b in buttons if b.channel == self.channel]:
+                if random.random() < self.loss:
+                    self.stats["lost"] += 1
+                else:
+                    self.sim.clock.callLater(delay, b.receive, destination, function, wakeup, data)
+
+    def fromButton(self, button, frame):
+        now = self.sim.clock.now
+        window = int(now // 10)
+        if window != self.window[0]:
+            self.window = [window, 0]
+        self.window[1] += 1
+        self.stats["peak_heard_per_10s"] = max(self.stats["peak_heard_per_10s"], self.window[1])
+        end = now + len(frame) * BYTE_TIME
+        self.inAir = [t for t in self.inAir if t[0] > now]
+        transmission = [end, False]
+        for t in self.inAir:
+            t[1] = True
+            transmission[1] = True
+        self.inAir.append(transmission)
+        self.sim.clock.callLater(end - now, self.received, transmission, button, frame)
+
+    def received(self, transmission, button, frame):
+        if transmission[1]:
+            self.stats["collisions"] += 1
+            return
+        if random.random() < self.loss:
+            self.stats["lost"] += 1
+            return
+        self.stats["rx_frames"] += 1
+        self.stats["rx_bytes"] += len(frame)
+        self.lastRssi = button.rssi
+        self.sim.app.onAdaptorData({"id": self.id, "characteristic": "spur", "data": base64.b64encode(frame)})
+
+class SimCloud(object):
+    """ Stands in for the Spur cloud client. """
+    def __init__(self, sim, screens, batch=False):
+        self.sim      = sim
+        self.screens  = screens
+        self.batch    = batch
+        self.waiting  = []              # Messages for the next batch
+        self.nextAddr = 0x0100
+        self.granted  = {}              # node ID: address
+        self.received = {}              # function: count
+        self.edits    = {}              # node ID: number of config updates sent after the first
+
+    def startUpdates(self, interval):
+        """ Sends a complete config with one screen changed to a random button every interval seconds. """
+        self.sim.clock.callLater(random.expovariate(1.0 / interval), self.sendUpdate, interval)
+
+    def sendUpdate(self, interval):
+        if self.granted:
+            nodeID = random.choice(sorted(self.granted))
+            self.edits[nodeID] = self.edits.get(nodeID, 0) + 1
+            self.toApp({"function": "config", "id": nodeID, "config": self.buttonConfig(nodeID)})
+        self.startUpdates(interval)
+
+    def toApp(self, msg):
+        if not self.batch or "function" not in msg:
+            self.sim.clock.callLater(CLOUD_DELAY, self.sim.app.onClientMessage, msg)
+            return
+        if not self.waiting:
+            self.sim.clock.callLater(CLOUD_DELAY, self.sendBatch)
+        self.waiting.append(msg)
+
+    def sendBatch(self):
+        msg = {"function": "batch", "messages": self.waiting}
+        self.waiting = []
+        self.sim.app.onClientMessage(msg)
+
+    def fromApp(self, msg):
+        if msg.get("function") == "batch":
+            for m in msg["messages"]:
+                self.fromApp(m)
+            return
+        function = msg.get("function", msg.get("status"))
+        self.received[function] = self.received.get(function, 0) + 1
+        if function == "init":
+            self.toApp({"status": "ok"})
+        elif function == "include_req":
+            nodeID = msg["include_req"]
+            if nodeID not in self.granted:
+                self.granted[nodeID] = self.nextAddr
+                self.nextAddr += 1
+            self.toApp({"function": "include_grant", "id": nodeID, "address": self.granted[nodeID]})
+            self.toApp({"function": "config", "id": nodeID, "config": self.buttonConfig(nodeID)})
+
+    def buttonConfig(self, nodeID):
+        config = {"name": "Button {}".format(nodeID)}
+        for state in range(3):
+            config["S{}".format(state)] = {
+                "state": state,
+                "alert": state,
+                "SingleLeft": (state + 1) % 3,
+                "SingleRight": (state + 2) % 3,
+                "wakeup": [300, 900, 1800, 3600]
+            }
+            config["D{}".format(state)] = self.screens[(nodeID + state) % len(self.screens)]
+        edits = self.edits.get(nodeID, 0)
+        if edits:
+            text = base64.b64decode(config["D0"]).split("\n")
+            text[-1] = "Update {}".format(edits)
+            config["D0"] = base64.b64encode("\n".join(text))
+        return config
+
+def defaultScreens():
+    texts = [
+        "Press for\n*Service\nRight to cancel",
+        "Room 12\n*Coffee|*Tea\nPress to order",
+        "Thank you\n*Request sent\nWe'll be with you",
+        "Left|Right\nCall|Cancel\n*Reception\nopen 24 hours"
+    ]
+    return [base64.b64encode(t) for t in texts]
+
+class Simulation(object):
+    current = None
+
+    def __init__(self, buttons=10, loss=0.0, seed=1, pressInterval=3600, screens=None, verbose=False, showWarnings=False, \
+                 updateInterval=None, adaptors=1, channels=None, trace=None, cloudBatch=False, batchGrants=False, \
+                 oldFirmware=0.0, powerOnSpread=POWER_ON_SPREAD, uplinkBatchSize=1):
+        Simulation.current   = self
+        random.seed(seed)
+        self.clock           = VirtualClock()
+        self.startTime       = self.clock.now
+        self.verbose         = verbose
+        self.showWarnings    = showWarnings
+        self.managerMessages = []
+        self.configDir       = tempfile.mkdtemp(prefix="spur_sim_") + "/"
+        installStandIns(self.configDir)
+        import spur_app_a
+        spur_app_a.CB_CONFIG_DIR = self.configDir   # Bound when spur_app_a was first imported
+        spur_app_a.config["channels"] = [FIRST_CHANNEL + c for c in range(channels or adaptors)]
+        spur_app_a.config["trace_file"] = trace
+        spur_app_a.config["batch_grants"] = batchGrants
+        spur_app_a.config["uplink_batch_size"] = uplinkBatchSize
+        self.appModule       = spur_app_a
+        self.adaptors        = [SimAdaptor(self, "ADA{}".format(n + 1), loss) for n in range(adaptors)]
+        self.adaptorsByID    = dict((a.id, a) for a in self.adaptors)
+        self.cloud           = SimCloud(self, screens or defaultScreens(), cloudBatch)
+        self.buttons         = [SimButton(self, 1000 + n, pressInterval, oldFirmware > 0 and random.random() < oldFirmware) \
+                                for n in range(buttons)]
+        for n, b in enumerate(self.buttons):
+            b.channel = spur_app_a.config["channels"][n % len(spur_app_a.config["channels"])]
+        self.buttonsByAddr   = {}
+        self.app             = spur_app_a.App(["spur_sim"])
+        if verbose:
+            self.app.logger.setLevels("debug")
+        self.app.onConfigureMessage({})
+        for a in self.adaptors:
+            self.app.onAdaptorService({"id": a.id, "service": [{"characteristic": "spur"}, {"characteristic": "rssi"}]})
+        for b in self.buttons:
+            b.start(spur_app_a.CHECK_START_DELAY + 5 + random.random() * powerOnSpread)
+        if updateInterval:
+            self.cloud.startUpdates(updateInterval)
+
+    def run(self, seconds):
+        Simulation.current = self
+        self.clock.runUntil(self.clock.now + seconds)
+
+    def close(self):
+        """ Removes the app's config directory, once the app has stopped. """
+        shutil.rmtree(self.configDir, ignore_errors=True)
+
+    def commissioning(self):
+        """ Times from the start of the simulation until buttons were included and started. """
+        included = sorted(b.includedAt - self.startTime for b in self.buttons if b.includedAt is not None)
+        started = sorted(b.startedAt - self.startTime for b in self.buttons if b.startedAt is not None)
+        waits = [b.includedAt - b.includeReqAt for b in self.buttons if b.includedAt is not None]
+        return {
+            "included": len(included),
+            "started": len(started),
+            "all_included_after": included[-1] if len(included) == len(self.buttons) else None,
+            "all_started_after": started[-1] if len(started) == len(self.buttons) else None,
+            "started_p50": percentile(started, 0.5),
+            "include_latency_p50": percentile(waits, 0.5),
+            "include_latency_max": max(waits) if waits else None
+        }
+
+    def report(self):
+        latencies = []
+        totals = {}
+        for b in self.buttons:
+            latencies.extend(b.ackLatency)
+            for k, v in b.stats.items():
+                totals[k] = totals.get(k, 0) + v
+        radio = {}
+        for a in self.adaptors:
+            for k, v in a.stats.items():
+                radio[k] = max(radio.get(k, 0), v) if k.startswith("peak") else radio.get(k, 0) + v
+        return {
+            "buttons": len(self.buttons),
+            "included": len(self.buttonsByAddr),
+            "simulated_hours": (self.clock.now - self.startTime) / 3600.0,
+            "reactor_calls": self.clock.calls,
+            "radio": radio,
+            "radio_by_adaptor": dict((a.id, a.stats) for a in self.adaptors),
+            "buttons_total": totals,
+            "ack_latency_p50": percentile(latencies, 0.5),
+            "ack_latency_p99": percentile(latencies, 0.99),
+            "cloud_received": self.cloud.received,
+            "commissioning": self.commissioning(),
+            "app_logs": self.app.simLogs,
+            "queue_depth": sum(len(s.radioQueue) for s in self.app.shards),
+            "metrics": self.app.metricsReport(),
+            "memory": self.app.memory.report()
+        }
+
+def commission(buttons, seed, batchGrants, oldFirmware=0.0, limit=COMMISSION_LIMIT, step=10):
+    """ Switches on a box of buttons together and runs until every one has been started, or for limit seconds.
+        Returns the commissioning report, with the grant frames sent and the wall time taken.
+    """
+    sim = Simulation(buttons, seed=seed, pressInterval=0, cloudBatch=True, batchGrants=batchGrants, oldFirmware=oldFirmware, \
+                     powerOnSpread=COMMISSION_SPREAD)
+    wallStart = wallClock()
+    while sim.clock.now - sim.startTime < limit and not all(b.startedAt for b in sim.buttons):
+        sim.run(step)
+    report = sim.commissioning()
+    report["wall_seconds"] = wallClock() - wallStart
+    for k in ("grant_frames", "grant_bytes", "collisions"):
+        report[k] = sum(a.stats[k] for a in sim.adaptors)
+    report["fallbacks"] = sim.app.grantBatcher.ackedFallback
+    sim.app.onStop()
+    sim.close()
+    return report
+
+def compareCommissioning(buttons, seed, runs, oldFirmware=0.0):
+    """ Commissions the same boxes of buttons with single and batched include_grants, with seeds
+        seed to seed + runs - 1, and reports the mean of each figure over the runs.
+    """
+    result = {"buttons": buttons, "runs": runs}
+    for name, batch in (("single", False), ("batched", True)):
+        reports = [commission(buttons, s, batch, oldFirmware) for s in range(seed, seed + runs)]
+        result[name] = dict((k, mean([r[k] for r in reports])) for k in reports[0])
+    for k in ("all_included_after", "all_started_after", "include_latency_p50", "grant_bytes", "wall_seconds"):
+        single, batched = result["single"][k], result["batched"][k]
+        result.setdefault("saved", {})[k] = single - batched if single is not None and batched is not None else None
+    return result
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Simulate a fleet of Spur buttons against one bridge")
+    parser.add_argument("--buttons", type=int, default=50)
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that any frame is lost")
+    parser.add_argument("--press-interval", type=float, default=3600, help="mean time between presses per button, seconds")
+    parser.add_argument("--update-interval", type=float, default=None, help="mean time between config updates from the cloud, seconds")
+    parser.add_argument("--batch-grants", action="store_true", help="send include_grants for several buttons in one frame")
+    parser.add_argument("--old-firmware", type=float, default=0.0, help="fraction of buttons that only read the first record of a grant")
+    parser.add_argument("--commission", action="store_true", help="time commissioning --buttons with single and batched grants")
+    parser.add_argument("--runs", type=int, default=5, help="seeds to average over with --commission")
+    parser.add_argument("--cloud-batch", action="store_true", help="send commands from the cloud in batches")
+    parser.add_argument("--uplink-batch-size", type=int, default=1, help="messages the app may send to the cloud in one batch")
+    parser.add_argument("--adaptors", type=int, default=1, help="number of spur adaptors")
+    parser.add_argument("--channels", type=int, default=None, help="number of radio channels, shared out between the adaptors (default: one each)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace", default=None, help="record the app's inputs and outputs to this file, for spur_replay.py")
+    parser.add_argument("--verbose", action="store_true", help="print every App log line")
+    parser.add_argument("--warnings", action="store_true", help="print App warnings")
+    args = parser.parse_args(argv)
+    if args.commission:
+        report = compareCommissioning(args.buttons, args.seed, args.runs, args.old_firmware)
+        sys.stdout.write(json.dumps(report, indent=4, sort_keys=True) + "\n")
+        return
+    sim = Simulation(args.buttons, args.loss, args.seed, args.press_interval, verbose=args.verbose, showWarnings=args.warnings, \
+                     updateInterval=args.update_interval, adaptors=args.adaptors, channels=args.channels, trace=args.trace, \
+                     cloudBatch=args.cloud_batch, batchGrants=args.batch_grants, oldFirmware=args.old_firmware, \
+                     uplinkBatchSize=args.uplink_batch_size)
+    wallStart = wallClock()
+    sim.run(args.hours * 3600)
+    sim.app.onStop()
+    report = sim.report()
+    sim.close()
+    report["wall_seconds"] = wallClock() - wallStart
+    sys.stdout.write(json.dumps(report, indent=4, sort_keys=True) + "\n")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
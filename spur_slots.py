@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# spur_slots.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Planning of button wakeups so that they are spread out in time.
+
+Time is divided into SLOT_LENGTH slots and the planner counts how many
+nodes are expected to wake up in each. When a node is given a wakeup
+interval, plan() may shorten it by up to the allowed jitter so that the
+node wakes in the least loaded slot in reach. Intervals are never made
+longer, so a node is never heard from later than its config asks for.
+Buttons configured at the same time, which would otherwise wake together
+on every cycle, drift apart instead.
+
+Each expected wakeup is a woken_up and an ack, with retries if they
+collide. stats() turns slot counts into a channel utilisation estimate
+using WAKEUP_AIRTIME.
+"""
+
+import heapq
+
+SLOT_LENGTH    = 10                     # seconds
+WAKEUP_JITTER  = 0.1                    # Fraction by which a wakeup interval may be shortened
+MAX_CANDIDATES = 16                     # Slots considered per plan
+WAKEUP_AIRTIME = 0.05                   # Channel time for a woken_up and its ack, seconds
+WAKEUP_UNIT    = 2                      # Wakeup intervals sent to buttons are in units of 2 seconds
+
+class WakeupPlanner(object):
+    def __init__(self, jitter=WAKEUP_JITTER, slotLength=SLOT_LENGTH):
+        self.jitter     = jitter
+        self.slotLength = slotLength
+        self.counts     = {}            # slot: number of nodes expected to wake up in it
+        self.slots      = []            # heap of the slots in counts, for pruning
+        self.expected   = {}            # address: slot it is expected to wake up in
+        self.moved      = 0             # Wakeups that were shortened
+
+    def __len__(self):
+        return len(self.expected)
+
+    def slot(self, t):
+        return int(t // self.slotLength)
+
+    def plan(self, addr, now, wakeup):
+        """ Returns the wakeup interval, in button units, to give addr instead of wakeup. """
+        self.forget(addr)
+        counts = self.counts
+        longest = wakeup * WAKEUP_UNIT
+        shortest = longest * (1 - self.jitter)
+        first = int((now + shortest) // self.slotLength)
+        best = last = int((now + longest) // self.slotLength)
+        bestCount = counts.get(last, 0)
+        if bestCount:
+            step = max(1, (last - first + 1) // MAX_CANDIDATES)
+            for s in range(last - step, first - 1, -step):
+                c = counts.get(s, 0)
+                if c < bestCount:
+                    best, bestCount = s, c
+                    if not c:
+                        break
+        if best != last:
+            # Aim for the middle of the chosen slot, as buttons do not wake exactly on time
+            target = max((best + 0.5) * self.slotLength, now + shortest)
+            wakeup = max(1, int((target - now) // WAKEUP_UNIT))
+            best = self.slot(now + wakeup * WAKEUP_UNIT)
+            self.moved += 1
+        self.add(addr, best)
+        return wakeup
+
+    def add(self, addr, slot):
+        self.expected[addr] = slot
+        if slot not in self.counts:
+            self.counts[slot] = 0
+            heapq.heappush(self.slots, slot)
+        self.counts[slot] += 1
+
+    def forget(self, addr):
+        """ Called when addr is heard from or removed. """
+        slot = self.expected.pop(addr, None)
+        if slot is not None and slot in self.counts:
+            self.counts[slot] -= 1
+
+    def prune(self, now):
+        """ Drops slots that have passed. """
+        current = self.slot(now)
+        while self.slots and self.slots[0] < current:
+            del self.counts[heapq.heappop(self.slots)]
+
+    def stats(self):
+        counts = [c for c in self.counts.values() if c]
+        peak = max(counts) if counts else 0
+        return {
+            "nodes": len(self.expected),
+            "slots_used": len(counts),
+            "peak_per_slot": peak,
+            "mean_per_used_slot": float(sum(counts)) / len(counts) if counts else None,
+            "peak_utilisation": peak * WAKEUP_AIRTIME / self.slotLength,
+            "shortened": self.moved
+        }
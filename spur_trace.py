@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# spur_trace.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Recording of the Spur app's inputs and outputs, for replay with spur_replay.py.
+
+With config "trace_file" set, the app starts a trace when it is configured
+and wraps onAdaptorData, onAdaptorService, onClientMessage and
+onConfigureMessage, and what it sends to adaptors and the client, so that
+the arguments of every call are written to the trace with the time they
+were made. The node table and config are written once
+the saved state has been loaded on start, so a replay starts from the same
+state.
+
+Each record is a RECORD header (time, kind, length) and a payload. Radio
+frames, which are most of the traffic, are stored as the adaptor ID and the
+raw frame; everything else is pickled. A path ending .gz is compressed.
+Recording stops, with a warning, once the trace reaches maxBytes.
+"""
+
+import base64
+import gzip
+import pickle
+import struct
+import time
+
+ADAPTOR_DATA    = 0
+ADAPTOR_SERVICE = 1
+CLIENT_MESSAGE  = 2
+CONFIGURE       = 3
+STATE           = 4
+ADAPTOR_OUT     = 5
+CLIENT_OUT      = 6
+
+INPUTS = {                              # App method: kind of record
+    "onAdaptorData": ADAPTOR_DATA,
+    "onAdaptorService": ADAPTOR_SERVICE,
+    "onClientMessage": CLIENT_MESSAGE,
+    "onConfigureMessage": CONFIGURE
+}
+OUTPUTS = (ADAPTOR_OUT, CLIENT_OUT)
+KIND_NAMES = {
+    ADAPTOR_DATA: "adaptor_data",
+    ADAPTOR_SERVICE: "adaptor_service",
+    CLIENT_MESSAGE: "client_message",
+    CONFIGURE: "configure",
+    STATE: "state",
+    ADAPTOR_OUT: "adaptor_out",
+    CLIENT_OUT: "client_out"
+}
+
+RECORD          = struct.Struct(">dBI") # time, kind, payload length
+FRAME           = struct.Struct(">cB")  # FRAME_TAG, length of the adaptor ID that follows
+FRAME_TAG       = b"F"
+PICKLE_TAG      = b"P"
+TRACE_MAX_BYTES = 100 * 1024 * 1024
+
+def openTrace(path, mode):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+def encode(kind, args):
+    """ The payload for a call with args. """
+    if kind == ADAPTOR_DATA and args[0].get("characteristic") == "spur":
+        ident = str(args[0]["id"])
+        return FRAME.pack(FRAME_TAG, len(ident)) + ident + base64.b64decode(args[0]["data"])
+    if kind == ADAPTOR_OUT and args[1] is not None and "data" in args[0] and args[0].get("request") == "command":
+        ident = str(args[1])
+        return FRAME.pack(FRAME_TAG, len(ident)) + ident + base64.b64decode(args[0]["data"])
+    return PICKLE_TAG + pickle.dumps(args, pickle.HIGHEST_PROTOCOL)
+
+def decode(kind, payload):
+    """ The args of the call that payload was recorded from. """
+    if payload[:1] == PICKLE_TAG:
+        return pickle.loads(payload[1:])
+    tag, idLength = FRAME.unpack_from(payload)
+    ident = payload[FRAME.size:FRAME.size + idLength]
+    frame = payload[FRAME.size + idLength:]
+    if kind == ADAPTOR_DATA:
+        return ({"id": ident, "characteristic": "spur", "data": base64.b64encode(frame)},)
+    return ({"id": None, "length": len(frame), "request": "command", "data": base64.b64encode(frame)}, ident)
+
+def readTrace(path):
+    """ Yields (time, kind, args) for each record. Stops at a record that was only partly written. """
+    with openTrace(path, "rb") as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            t, kind, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield t, kind, decode(kind, payload)
+
+class TraceWriter(object):
+    def __init__(self, path, log=None, maxBytes=TRACE_MAX_BYTES, clock=time.time):
+        self.path     = path
+        self.log      = log
+        self.maxBytes = maxBytes
+        self.clock    = clock
+        self.file     = openTrace(path, "wb")
+        self.bytes    = 0
+        self.records  = 0
+
+    def write(self, kind, args):
+        if self.file is None:
+            return
+        payload = encode(kind, args)
+        self.file.write(RECORD.pack(self.clock(), kind, len(payload)) + payload)
+        self.bytes += RECORD.size + len(payload)
+        self.records += 1
+        if self.bytes >= self.maxBytes:
+            if self.log:
+                self.log("warning", "Trace {} reached {} bytes, recording stopped".format(self.path, self.bytes))
+            self.close()
+
+    def wrap(self, kind, func):
+        """ Returns func with each call recorded before it is made. """
+        def traced(*args):
+            try:
+                self.write(kind, args)
+            except Exception as ex:
+                if self.log:
+                    self.log("warning", "Problem writing trace. Type: " + str(type(ex)) + ", exception: " + str(ex.args))
+            return func(*args)
+        return traced
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {"path": self.path, "records": self.records, "bytes": self.bytes, "recording": self.file is not None}
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# spur_uplink.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Outbound pipeline from the Spur app to the client.
+
+By default, batchSize is 1 and every message is sent on its own as soon as
+it is queued. Batching is for clients that accept the batch envelope: with a
+larger batchSize, messages are coalesced for up to latency seconds, or until
+batchSize are waiting, and then sent. A flush of more than one message is
+sent as a single batch message:
+    {"function": "batch", "messages": [...]}
+sendAll() queues several messages and flushes them at once, so that with
+batching on they go in one batch message, and with it off, one after another.
+
+Messages whose function is in LATE_FUNCTIONS (rssi) are held back and always
+sent after every other message queued before them. A held message for a node
+is sent straight after the next message about the same node (its source, or
+id) is flushed. If none is, it is sent after hold seconds, which gives the
+client time to see woken_up from the bridge that owns the node before rssi
+reports for it from other bridges.
+"""
+
+import time
+from collections import deque
+
+UPLINK_BATCH_SIZE = 1                   # Max messages in one batch, 1 for no batches
+UPLINK_LATENCY    = 0.5                 # Max time a message waits to be batched, seconds
+RSSI_HOLD         = 3                   # Max time rssi messages are held back, seconds
+LATE_FUNCTIONS    = ("rssi",)
+
+def nodeOf(msg):
+    """ The ID of the node a message to the client is about, or None. """
+    return msg.get("source", msg.get("id"))
+
+class Uplink(object):
+    def __init__(self, send, callLater, batchSize=UPLINK_BATCH_SIZE, latency=UPLINK_LATENCY, hold=RSSI_HOLD, clock=time.time):
+        self.clientSend   = send
+        self.callLater    = callLater
+        self.batchSize    = batchSize
+        self.latency      = latency
+        self.hold         = hold
+        self.clock        = clock
+        self.queue        = deque()     # (time queued, message)
+        self.late         = deque()     # (time due, time queued, message)
+        self.call         = None
+        self.callTime     = None
+        self.batches      = 0
+        self.sent         = 0
+        self.maxDepth     = 0
+        self.totalLatency = 0.0
+        self.maxLatency   = 0.0
+
+    def __len__(self):
+        return len(self.queue) + len(self.late)
+
+    def send(self, msg):
+        self.add(msg, self.clock())
+        if len(self.queue) >= self.batchSize:
+            self.flush()
+        elif self.queue:
+            self.schedule(self.queue[0][0] + self.latency)
+        self.maxDepth = max(self.maxDepth, len(self))
+
+    def sendAll(self, messages):
+        """ Sends messages in the same flush. """
+        if not messages:
+            return
+        now = self.clock()
+        for msg in messages:
+            self.add(msg, now)
+        self.maxDepth = max(self.maxDepth, len(self))
+        self.flush()
+
+    def add(self, msg, now):
+        if msg.get("function") in LATE_FUNCTIONS:
+            self.late.append((now + self.hold, now, msg))
+            self.schedule(now + self.hold)
+        else:
+            self.queue.append((now, msg))
+
+    def schedule(self, when):
+        if self.call is not None and self.callTime <= when:
+            return
+        if self.call is not None:
+            self.call.cancel()
+        self.callTime = when
+        self.call = self.callLater(max(0, when - self.clock()), self.onTimer)
+
+    def onTimer(self):
+        self.call = None
+        self.flush()
+
+    def flush(self):
+        """ Sends everything queued, then the late messages that are due or are for a node just sent. """
+        now = self.clock()
+        toSend = list(self.queue)
+        self.queue.clear()
+        flushedNodes = set(nodeOf(msg) for queued, msg in toSend)
+        flushedNodes.discard(None)
+        if flushedNodes:
+            held = deque()
+            for entry in self.late:
+                due, queued, msg = entry
+                if due <= now or nodeOf(msg) in flushedNodes:
+                    toSend.append((queued, msg))
+                else:
+                    held.append(entry)
+            self.late = held
+        else:
+            while self.late and self.late[0][0] <= now:
+                due, queued, msg = self.late.popleft()
+                toSend.append((queued, msg))
+        for i in range(0, len(toSend), self.batchSize):
+            batch = toSend[i:i + self.batchSize]
+            if len(batch) == 1:
+                self.clientSend(batch[0][1])
+            else:
+                self.clientSend({"function": "batch", "messages": [msg for queued, msg in batch]})
+            self.batches += 1
+            self.sent += len(batch)
+            for queued, msg in batch:
+                self.totalLatency += now - queued
+                self.maxLatency = max(self.maxLatency, now - queued)
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        if self.late:
+            self.schedule(self.late[0][0])
+
+    def stats(self):
+        return {
+            "depth": len(self),
+            "max_depth": self.maxDepth,
+            "batches": self.batches,
+            "sent": self.sent,
+            "mean_flush_latency": self.totalLatency / self.sent if self.sent else 0,
+            "max_flush_latency": self.maxLatency
+        }
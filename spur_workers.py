@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# spur_workers.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Work done off the reactor thread.
+
+run() calls a function in the reactor's thread pool (deferToThread) and
+returns a Deferred that fires on the reactor thread with the result, so the
+caller can put it back into the app's state there. Functions given to run()
+must only use data that the reactor thread will not change while they run:
+callers pass copies. Failures are logged here and passed on to the caller's
+errback.
+
+The time each function took in its thread is returned with its result, so
+the counters are only ever changed on the reactor thread.
+"""
+
+import time
+
+class Workers(object):
+    def __init__(self, deferToThread, log=None, clock=time.time):
+        self.deferToThread = deferToThread
+        self.log           = log        # log(level, message), for failures
+        self.clock         = clock
+        self.submitted     = 0
+        self.running       = 0
+        self.peakRunning   = 0
+        self.failed        = 0
+        self.busy          = 0.0        # Total time spent in worker threads, seconds
+        self.longest       = 0.0
+
+    def run(self, func, *args):
+        """ Calls func(*args) in a worker thread. Returns a Deferred. """
+        self.submitted += 1
+        self.running += 1
+        self.peakRunning = max(self.peakRunning, self.running)
+        d = self.deferToThread(self.timed, func, args)
+        d.addCallbacks(self.done, self.fail)
+        return d
+
+    def timed(self, func, args):
+        start = self.clock()
+        result = func(*args)
+        return result, self.clock() - start
+
+    def done(self, timedResult):
+        result, elapsed = timedResult
+        self.running -= 1
+        self.busy += elapsed
+        self.longest = max(self.longest, elapsed)
+        return result
+
+    def fail(self, failure):
+        self.running -= 1
+        self.failed += 1
+        if self.log:
+            self.log("warning", "Problem in worker thread. Type: " + str(failure.type) + ", exception: " + str(failure.value.args))
+        return failure
+
+    def stats(self):
+        return {
+            "submitted": self.submitted,
+            "running": self.running,
+            "peak_running": self.peakRunning,
+            "failed": self.failed,
+            "busy_seconds": self.busy,
+            "longest": self.longest
+        }
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# test_spur_codec.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of encoding and decoding radio frames, against the frames the app
+built before the codec existed.
+Run with python -m unittest test_spur_codec.
+"""
+
+import struct
+import unittest
+from spur_codec import encodeFrame, encodeFrames, decodeFrame, decodeFrames, FUNCTIONS
+
+BRIDGE = 0x8012
+
+def legacyFrame(destination, source, function, wakeupInterval, data=None):
+    """ formatRadioMessage's frame as built before spur_codec. """
+    length = 4 if function != "beacon" else 10
+    if data:
+        length += len(data)
+    m = b""
+    m += struct.pack(">H", destination)
+    m += struct.pack(">H", source)
+    if function != "beacon":
+        m += struct.pack("B", FUNCTIONS[function])
+        m += struct.pack("B", length)
+        m += struct.pack("I", 0)
+        m += struct.pack(">H", wakeupInterval)
+    if data:
+        m += data
+    return m
+
+def received(source, function, length=0, payload=b""):
+    """ A frame as the adaptor passes it on: header, padding to the length byte, then the payload. """
+    return struct.pack(">HHB", BRIDGE, source, FUNCTIONS[function]) + b"\x00" * 4 + struct.pack(">b", length) + payload
+
+class EncodeTest(unittest.TestCase):
+    def test_same_bytes_as_before(self):
+        cases = [
+            (0x4001, "ack", 300, None),
+            (0x4001, "config", 0, b"M\x01\x01\x00" + b"\xff" * 13),
+            (0xBB00, "include_grant", 0, struct.pack(">IH", 1001, 0x4001)),
+            (0x4002, "start", 600, b"\x00\x01"),
+            (0xBBBB, "beacon", 0, None)
+        ]
+        for destination, function, wakeup, data in cases:
+            self.assertEqual(encodeFrame(destination, BRIDGE, function, wakeup, data),
+                             legacyFrame(destination, BRIDGE, function, wakeup, data), function)
+
+    def test_length_byte(self):
+        frame = bytearray(encodeFrame(0x4001, BRIDGE, "config", 0, b"x" * 20))
+        self.assertEqual(frame[5], 24)
+        self.assertEqual(len(frame), 32)
+
+    def test_bulk(self):
+        frames = [(0x4001, BRIDGE, "ack", 60, None), (0x4002, BRIDGE, "start", 0, b"ab")]
+        self.assertEqual(encodeFrames(frames), [encodeFrame(*f) for f in frames])
+
+class DecodeTest(unittest.TestCase):
+    def test_round_trip_header(self):
+        for function in ("ack", "config", "woken_up", "include_not"):
+            frame = decodeFrame(encodeFrame(0x4001, BRIDGE, function, 300, b"data"))
+            self.assertEqual((frame.destination, frame.source, frame.function), (0x4001, BRIDGE, function))
+
+    def test_too_short(self):
+        self.assertIsNone(decodeFrame(b"\x00" * 5))
+
+    def test_unknown_function(self):
+        frame = decodeFrame(struct.pack(">HHB", BRIDGE, 0x4001, 0x7F) + b"\x00")
+        self.assertEqual(frame.function, "undefined")
+
+    def test_include_req(self):
+        frame = decodeFrame(received(0, "include_req", 16, struct.pack(">Ibb", 1001, 3, -70)))
+        self.assertEqual((frame.nodeID, frame.version, frame.rssi), (1001, 3, -70))
+        self.assertIsNone(frame.error)
+
+    def test_include_req_without_version(self):
+        frame = decodeFrame(received(0, "include_req", 14, struct.pack(">I", 1001)))
+        self.assertEqual((frame.nodeID, frame.version, frame.rssi), (1001, 0, 0))
+
+    def test_alert(self):
+        payload = struct.pack(">Hbb", 0x0102, -60, 21)
+        frame = decodeFrame(received(0x4001, "alert", 14, payload))
+        self.assertEqual((frame.alertType, frame.rssi, frame.temperature), (0x0102, -60, 21))
+        self.assertEqual(frame.payload.tobytes(), payload)
+
+    def test_short_alert(self):
+        frame = decodeFrame(received(0x4001, "alert", 6, struct.pack(">H", 2)))
+        self.assertEqual((frame.alertType, frame.rssi, frame.temperature), (2, None, None))
+
+    def test_truncated_alert(self):
+        frame = decodeFrame(received(0x4001, "alert", 14, b"\x01"))
+        self.assertEqual(frame.alertType, 0xFFFF)
+        self.assertIsNotNone(frame.error)
+
+    def test_bulk(self):
+        messages = [received(0x4001, "woken_up"), b"\x00"]
+        frames = decodeFrames(messages)
+        self.assertEqual(frames[0].function, "woken_up")
+        self.assertIsNone(frames[1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# test_spur_grants.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of batching include_grants and include_nots into one frame.
+Run with python -m unittest test_spur_grants.
+"""
+
+import unittest
+from spur_codec import HEADER
+from spur_grants import GrantBatcher, GRANT, NOT, GRANT_ADDRESS
+
+BUDGET = 60
+
+def candidate(seq, function, nodeID, attempt=0):
+    m = {"seq": seq, "function": function, "destination": 0x4000 + seq, "attempt": attempt}
+    if function == "include_grant":
+        m["record"] = GRANT.pack(nodeID, m["destination"])
+    elif function == "include_not":
+        m["record"] = NOT.pack(nodeID)
+    return m
+
+class GrantBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.formatted = []
+        self.batcher = GrantBatcher(self.format, BUDGET, enabled=True)
+
+    def format(self, destination, function, wakeup, data):
+        self.formatted.append((destination, function, wakeup, data))
+        return {"length": HEADER.size + len(data)}
+
+    def test_disabled(self):
+        batcher = GrantBatcher(self.format, BUDGET)
+        candidates = [candidate(n, "include_grant", 1000 + n) for n in range(3)]
+        self.assertEqual(batcher.takeGrants(candidates), (None, [], candidates))
+        self.assertEqual(self.formatted, [])
+
+    def test_grants_in_one_frame(self):
+        grants = [candidate(n, "include_grant", 1000 + n) for n in range(2)]
+        config = candidate(9, "config", 1009)
+        msg, chosen, others = self.batcher.takeGrants([grants[0], config, grants[1]])
+        self.assertEqual(chosen, grants)
+        self.assertEqual(others, [config])
+        self.assertEqual(self.formatted, [(GRANT_ADDRESS, "include_grant", 0, grants[0]["record"] + grants[1]["record"])])
+        self.assertEqual(msg["length"], HEADER.size + 2 * GRANT.size)
+        self.assertEqual([m["batched"] for m in chosen], [1, 1])
+        self.assertEqual((self.batcher.frames, self.batcher.records), (1, 2))
+
+    def test_one_grant_is_not_batched(self):
+        candidates = [candidate(1, "include_grant", 1001), candidate(2, "include_not", 1002)]
+        self.assertEqual(self.batcher.takeGrants(candidates), (None, [], candidates))
+        self.assertEqual(self.batcher.frames, 0)
+
+    def test_records_fit_in_budget(self):
+        grants = [candidate(n, "include_grant", 1000 + n) for n in range(20)]
+        room = (BUDGET - HEADER.size) // GRANT.size
+        msg, chosen, others = self.batcher.takeGrants(grants)
+        self.assertEqual(chosen, grants[:room])
+        self.assertEqual(others, grants[room:])
+        self.assertLessEqual(msg["length"], BUDGET)
+        msg, chosen, others = self.batcher.takeGrants(grants, used=30)
+        self.assertEqual(len(chosen), (BUDGET - 30 - HEADER.size) // GRANT.size)
+        self.assertIsNone(self.batcher.takeGrants(grants, used=BUDGET - HEADER.size - GRANT.size)[0])
+
+    def test_nots(self):
+        nots = [candidate(n, "include_not", 1000 + n) for n in range(20)]
+        msg, chosen, others = self.batcher.takeNots(nots)
+        self.assertEqual(len(chosen), (BUDGET - HEADER.size) // NOT.size)
+        self.assertEqual(self.formatted[0][1], "include_not")
+
+    def test_repeated_not_is_sent_alone(self):
+        repeat = candidate(1, "include_not", 1001)
+        del repeat["record"]
+        candidates = [repeat, candidate(2, "include_not", 1002)]
+        self.assertIsNone(self.batcher.takeNots(candidates)[0])
+
+    def test_fallback_after_attempts(self):
+        fresh = [candidate(n, "include_grant", 1000 + n) for n in range(2)]
+        tried = candidate(3, "include_grant", 1003, attempt=self.batcher.fallbackAttempts)
+        msg, chosen, others = self.batcher.takeGrants([tried] + fresh)
+        self.assertEqual(chosen, fresh)
+        self.assertEqual(others, [tried])
+
+    def test_acks_are_counted(self):
+        batched = candidate(1, "include_grant", 1001, attempt=1)
+        batched["batched"] = 1
+        fallback = candidate(2, "include_grant", 1002, attempt=3)
+        fallback["batched"] = 2
+        single = candidate(3, "include_grant", 1003, attempt=1)
+        for m in (batched, fallback, single):
+            self.batcher.onAck(m)
+        stats = self.batcher.stats()
+        self.assertEqual((stats["acked_batched"], stats["acked_after_fallback"]), (1, 1))
+        self.assertIsNone(stats["mean_records_per_frame"])
+
+if __name__ == "__main__":
+    unittest.main()
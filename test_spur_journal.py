@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# test_spur_journal.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of saving state as a snapshot plus a journal.
+Run with python -m unittest test_spur_journal.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from spur_journal import StateJournal
+from test_spur_rssi import Clock
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="test_spur_journal_")
+        self.path = os.path.join(self.dir, "app.savestate")
+        self.clock = Clock()
+        self.nodes = {}
+        self.journal = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def open(self, compactRecords=100):
+        return StateJournal(self.path, self.clock.callLater, lambda: {"nodes": dict(self.nodes)}, self.nodes.get, \
+                            flushDelay=2, compactRecords=compactRecords)
+
+    def change(self, nodeID, record):
+        if record is None:
+            self.nodes.pop(nodeID, None)
+        else:
+            self.nodes[nodeID] = record
+        self.journal.record(nodeID)
+
+    def test_changes_are_coalesced(self):
+        self.change(1, "a")
+        self.change(1, "b")
+        self.change(2, "c")
+        self.assertFalse(os.path.exists(self.journal.journalPath))
+        self.clock.advance(2)
+        state, records = self.open().load()
+        self.assertIsNone(state)
+        self.assertEqual(records, [(1, "b"), (2, "c")])
+
+    def test_snapshot_plus_journal(self):
+        self.change(1, "a")
+        self.journal.compact()
+        self.change(1, "b")
+        self.change(2, None)
+        self.journal.flush()
+        state, records = self.open().load()
+        self.assertEqual(state["nodes"], {1: "a"})
+        self.assertEqual(records, [(1, "b"), (2, None)])
+
+    def test_compaction_truncates_journal(self):
+        self.journal = self.open(compactRecords=3)
+        for n in range(3):
+            self.change(n, "x")
+        self.journal.flush()
+        self.assertFalse(os.path.exists(self.journal.journalPath))
+        self.assertEqual(self.journal.records, 0)
+        journal = self.open()
+        state, records = journal.load()
+        self.assertEqual(state["nodes"], {0: "x", 1: "x", 2: "x"})
+        self.assertEqual(records, [])
+        self.assertEqual(journal.generation, state["journalGeneration"])
+
+    def test_journal_from_before_snapshot_is_skipped(self):
+        self.change(1, "a")
+        self.journal.compact()
+        self.change(1, "b")
+        self.journal.flush()
+        shutil.copy(self.journal.journalPath, self.path + ".old")
+        self.change(1, None)
+        self.journal.compact()
+        shutil.copy(self.path + ".old", self.journal.journalPath)  # As if stopped before the journal was removed
+        journal = self.open()
+        state, records = journal.load()
+        self.assertEqual(state["nodes"], {})
+        self.assertEqual(records, [])
+        self.journal = journal
+        self.change(2, "c")
+        self.journal.flush()
+        self.assertEqual(self.open().load()[1], [(2, "c")])
+
+    def test_state_from_before_generations(self):
+        with open(self.path, "wb") as f:
+            pickle.dump({"nodes": {1: "a"}}, f)
+        with open(self.journal.journalPath, "wb") as f:
+            pickle.dump((1, "b"), f)
+        journal = self.open()
+        state, records = journal.load()
+        self.assertEqual(records, [(1, "b")])
+        self.assertEqual(journal.generation, 0)
+
+    def test_partial_write_ends_journal(self):
+        self.change(1, "a")
+        self.journal.flush()
+        with open(self.journal.journalPath, "ab") as f:
+            f.write(pickle.dumps((0, 2, "b"))[:5])
+        self.assertEqual(self.open().load()[1], [(1, "a")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# test_spur_nodes.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of the node table and its saved state.
+Run with python -m unittest test_spur_nodes.
+"""
+
+import pickle
+import unittest
+from spur_nodes import NodeTable, PLACEHOLDER_ID, PLACEHOLDER_ADDR
+
+DAY = 24 * 3600
+
+class NodeTableTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.nodes = NodeTable(clock=lambda: self.now)
+
+    def test_add_and_look_up(self):
+        node = self.nodes.add(1001, 0x4001)
+        self.assertIs(self.nodes.get(1001), node)
+        self.assertIs(self.nodes.at(0x4001), node)
+        self.assertEqual(self.nodes.addr(1001), 0x4001)
+        self.assertEqual(self.nodes.id(0x4001), 1001)
+        self.assertEqual(node.lastSeen, self.now)
+        self.assertIn(1001, self.nodes)
+        self.assertRaises(KeyError, self.nodes.addr, 1002)
+        self.assertRaises(KeyError, self.nodes.id, 0x4002)
+
+    def test_active_at(self):
+        self.nodes.add(1001, 0x4001)
+        self.assertFalse(self.nodes.activeAt(0x4001))
+        self.nodes.active.add(1001)
+        self.assertTrue(self.nodes.activeAt(0x4001))
+        self.assertFalse(self.nodes.activeAt(0x4002))
+
+    def test_new_address_moves_address_flags(self):
+        node = self.nodes.add(1001, 0x4001)
+        self.nodes.sendingConfig.add(0x4001)
+        self.nodes.includeGrants.add(0x4001)
+        self.now += 10
+        self.assertIs(self.nodes.add(1001, 0x4002), node)
+        self.assertIsNone(self.nodes.at(0x4001))
+        self.assertIs(self.nodes.at(0x4002), node)
+        self.assertEqual(self.nodes.sendingConfig, set([0x4002]))
+        self.assertEqual(self.nodes.includeGrants, set([0x4002]))
+        self.assertEqual(node.lastSeen, self.now)
+
+    def test_remove_clears_flags(self):
+        self.nodes.add(1001, 0x4001)
+        self.nodes.active.add(1001)
+        self.nodes.configuring.add(1001)
+        self.nodes.requestBatteries.add(0x4001)
+        self.assertEqual(self.nodes.remove(1001).id, 1001)
+        self.assertEqual(len(self.nodes), 0)
+        self.assertIsNone(self.nodes.at(0x4001))
+        for flag in NodeTable.ID_FLAGS + NodeTable.ADDR_FLAGS:
+            self.assertEqual(getattr(self.nodes, flag), set(), flag)
+        self.assertIsNone(self.nodes.remove(1001))
+
+    def test_dormant_and_revive(self):
+        self.nodes.add(1001, 0x4001)
+        self.nodes.remove(1001, keepAddress=True)
+        self.assertNotIn(1001, self.nodes)
+        self.assertEqual(self.nodes.dormant, {1001: 0x4001})
+        node = self.nodes.revive(1001)
+        self.assertEqual(node.addr, 0x4001)
+        self.assertEqual(self.nodes.dormant, {})
+        self.assertIs(self.nodes.revive(1001), node)
+        self.assertRaises(KeyError, self.nodes.revive, 1002)
+
+    def test_stale_after_ttl(self):
+        self.nodes.add(1, 1)
+        self.nodes.add(2, 2)
+        self.nodes.active.add(2)
+        self.now += 8 * DAY
+        self.nodes.add(3, 3)
+        self.assertEqual(self.nodes.stale(self.now, 7 * DAY, 100), [1])
+
+    def test_stale_beyond_max_inactive(self):
+        for n in range(5):
+            self.nodes.add(n, n)
+            self.now += 1
+        self.nodes.active.add(0)
+        self.assertEqual(sorted(self.nodes.stale(self.now, 7 * DAY, 2)), [1, 2])
+
+class SavedStateTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.nodes = NodeTable(clock=lambda: self.now)
+        node = self.nodes.add(1001, 0x4001)
+        node.buttonState = "normal"
+        node.wakeupCount = 3
+        node.wakeups = {"A": 600}
+        self.nodes.active.add(1001)
+        self.nodes.add(1002, 0x4002)
+        self.nodes.excluded.add(1002)
+
+    def reloaded(self, state):
+        nodes = NodeTable(clock=lambda: self.now)
+        nodes.load(pickle.loads(pickle.dumps(state)))
+        return nodes
+
+    def test_state_has_placeholder(self):
+        state = self.nodes.state()
+        self.assertEqual(state["id2addr"], {PLACEHOLDER_ID: PLACEHOLDER_ADDR, 1001: 0x4001, 1002: 0x4002})
+        self.assertEqual(state["addr2id"], {PLACEHOLDER_ADDR: PLACEHOLDER_ID, 0x4001: 1001, 0x4002: 1002})
+
+    def test_round_trip(self):
+        self.nodes.remove(1002, keepAddress=True)
+        self.now += 10
+        nodes = self.reloaded(self.nodes.state())
+        self.assertEqual(len(nodes), 1)
+        node = nodes.get(1001)
+        self.assertEqual((node.addr, node.buttonState, node.wakeupCount, node.wakeups), (0x4001, "normal", 3, {"A": 600}))
+        self.assertEqual(node.lastSeen, self.now)
+        self.assertEqual(nodes.active, set([1001]))
+        self.assertEqual(nodes.dormant, {1002: 0x4002})
+
+    def test_wakeups_are_copied(self):
+        state = self.nodes.state()
+        self.nodes.get(1001).wakeups["A"] = 300
+        self.assertEqual(state["wakeups"][0x4001], {"A": 600})
+
+    def test_load_skips_placeholder(self):
+        state = self.nodes.state()
+        state["activeNodes"].append(PLACEHOLDER_ID)
+        state["buttonState"][PLACEHOLDER_ADDR] = "normal"
+        nodes = self.reloaded(state)
+        self.assertNotIn(PLACEHOLDER_ID, nodes)
+        self.assertIsNone(nodes.at(PLACEHOLDER_ADDR))
+        self.assertEqual(nodes.active, set([1001]))
+        self.assertEqual(nodes.excluded, set([1002]))
+        self.assertIn(PLACEHOLDER_ID, nodes.state()["id2addr"])
+
+    def test_load_state_from_before_exclusion(self):
+        state = self.nodes.state()
+        del state["excludedNodes"]
+        del state["dormantNodes"]
+        nodes = self.reloaded(state)
+        self.assertEqual(nodes.excluded, set())
+        self.assertEqual(nodes.dormant, {})
+
+    def test_records(self):
+        record = self.nodes.record(1001)
+        nodes = NodeTable(clock=lambda: self.now)
+        nodes.applyRecord(1001, record)
+        node = nodes.get(1001)
+        self.assertEqual((node.addr, node.wakeups), (0x4001, {"A": 600}))
+        self.assertEqual(nodes.active, set([1001]))
+        nodes.applyRecord(1001, None)
+        self.assertNotIn(1001, nodes)
+        self.assertIsNone(self.nodes.record(1003))
+
+    def test_dormant_record(self):
+        self.nodes.remove(1002, keepAddress=True)
+        record = self.nodes.record(1002)
+        self.assertEqual(record, {"addr": 0x4002, "dormant": True})
+        nodes = NodeTable(clock=lambda: self.now)
+        nodes.add(1002, 0x4002)
+        nodes.applyRecord(1002, record)
+        self.assertNotIn(1002, nodes)
+        self.assertEqual(nodes.dormant, {1002: 0x4002})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# test_spur_queue.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of the radio message queue and frame packing.
+Run with python -m unittest test_spur_queue.
+"""
+
+import unittest
+from spur_queue import RadioQueue, packFrame, fillBudget, MAX_CANDIDATES
+
+def frame(length):
+    """ A stand-in for a message from formatRadioMessage. """
+    return {"length": length}
+
+def queued(function, length, destination=1):
+    return {"function": function, "destination": destination, "message": frame(length)}
+
+def lengths(messages):
+    return [m["message"]["length"] for m in messages]
+
+class RadioQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.queue = RadioQueue(retryInterval=9, clock=lambda: self.now)
+
+    def test_one_message_in_flight_per_destination(self):
+        first = self.queue.push(frame(20), 1, "config")
+        self.queue.push(frame(20), 1, "config")
+        self.assertEqual(self.queue.readyMessages(), [first])
+        self.queue.markSent(first, self.now)
+        self.assertTrue(self.queue.isInFlight(1))
+        self.assertEqual(self.queue.readyMessages(), [])
+        self.assertEqual(len(self.queue), 2)
+
+    def test_acknowledge_moves_to_next_message(self):
+        first = self.queue.push(frame(20), 1, "config")
+        second = self.queue.push(frame(20), 1, "start")
+        self.queue.markSent(first, self.now)
+        m, moreToCome = self.queue.acknowledge(1)
+        self.assertIs(m, first)
+        self.assertTrue(moreToCome)
+        self.assertEqual(self.queue.readyMessages(), [second])
+        self.queue.markSent(second, self.now)
+        m, moreToCome = self.queue.acknowledge(1)
+        self.assertIs(m, second)
+        self.assertFalse(moreToCome)
+        self.assertFalse(self.queue.hasPending(1))
+        self.assertEqual(len(self.queue), 0)
+
+    def test_acknowledge_with_nothing_in_flight(self):
+        self.queue.push(frame(20), 1, "config")
+        self.assertEqual(self.queue.acknowledge(1), (None, True))
+        self.assertEqual(self.queue.acknowledge(2), (None, False))
+
+    def test_retry_is_due_after_timeout(self):
+        m = self.queue.push(frame(20), 1, "config")
+        self.queue.markSent(m, self.now, timeout=5)
+        self.assertEqual(self.queue.nextDue(), self.now + 5)
+        self.assertIsNone(self.queue.popDue(self.now + 4))
+        self.assertIs(self.queue.popDue(self.now + 5), m)
+        self.assertIsNone(self.queue.popDue(self.now + 5))
+        self.queue.defer(m)
+        self.assertIs(self.queue.popDue(self.now + 5), m)
+
+    def test_acked_message_is_not_due(self):
+        m = self.queue.push(frame(20), 1, "config")
+        self.queue.markSent(m, self.now)
+        self.queue.acknowledge(1)
+        self.assertIsNone(self.queue.popDue(self.now + 100))
+        self.assertIsNone(self.queue.nextDue())
+
+    def test_expedite(self):
+        m = self.queue.push(frame(20), 1, "config")
+        self.queue.markSent(m, self.now)
+        self.queue.expedite(1, self.now + 1)
+        self.assertIs(self.queue.popDue(self.now + 1), m)
+
+    def test_fire_once_messages(self):
+        ack1 = self.queue.push(frame(12), 1, "ack")
+        self.queue.push(frame(12), 1, "ack")
+        not2 = self.queue.push(frame(12), 2, "include_not")
+        not2again = self.queue.push(frame(12), 2, "include_not")
+        self.assertEqual(self.queue.nextDue(), 0)
+        self.assertEqual(self.queue.fireOnceMessages(), [ack1, not2, not2again])
+        self.queue.discard(ack1)
+        self.assertEqual(len(self.queue), 3)
+        self.assertTrue(self.queue.hasPending(1))
+
+    def test_fire_once_messages_are_limited(self):
+        for d in range(MAX_CANDIDATES * 3):
+            self.queue.push(frame(12), d, "ack")
+        acks = self.queue.fireOnceMessages()
+        self.assertEqual([m["destination"] for m in acks], list(range(MAX_CANDIDATES)))
+        for m in acks:
+            self.queue.discard(m)
+        self.assertEqual(self.queue.fireOnceMessages()[0]["destination"], MAX_CANDIDATES)
+
+    def test_remove_destination(self):
+        m = self.queue.push(frame(20), 1, "config")
+        self.queue.push(frame(20), 1, "start")
+        self.queue.push(frame(12), 1, "ack")
+        other = self.queue.push(frame(20), 2, "config")
+        self.queue.markSent(m, self.now)
+        self.assertEqual(len(self.queue.removeDestination(1)), 3)
+        self.assertFalse(self.queue.hasPending(1))
+        self.assertFalse(self.queue.isInFlight(1))
+        self.assertIsNone(self.queue.popDue(self.now + 100))
+        self.assertEqual(self.queue.readyMessages(), [other])
+
+    def test_remove_queued(self):
+        sent = self.queue.push(frame(20), 1, "config")
+        sent["shows"] = ("D0", "a")
+        superseded = self.queue.push(frame(20), 1, "config")
+        superseded["shows"] = ("D0", "b")
+        other = self.queue.push(frame(20), 1, "config")
+        self.queue.markSent(sent, self.now)
+        isD0 = lambda m: m.get("shows", (None,))[0] == "D0"
+        self.assertEqual(self.queue.removeQueued(1, isD0), [superseded])
+        self.queue.acknowledge(1)
+        self.assertEqual(self.queue.readyMessages(), [other])
+        self.assertEqual(len(self.queue), 1)
+
+    def test_remove_queued_head(self):
+        head = self.queue.push(frame(20), 1, "config")
+        rest = self.queue.push(frame(20), 1, "start")
+        self.assertEqual(self.queue.removeQueued(1, lambda m: m is head), [head])
+        self.assertEqual(self.queue.readyMessages(), [rest])
+        self.assertEqual(self.queue.removeQueued(1, lambda m: True), [rest])
+        self.assertFalse(self.queue.hasPending(1))
+        self.assertIsNone(self.queue.nextDue())
+
+    def test_transfer_keeps_in_flight_state(self):
+        m = self.queue.push(frame(20), 1, "config")
+        waiting = self.queue.push(frame(20), 1, "start")
+        self.queue.markSent(m, self.now, timeout=5)
+        other = RadioQueue(clock=lambda: self.now)
+        self.queue.transfer(1, other)
+        self.assertFalse(self.queue.hasPending(1))
+        self.assertTrue(other.isInFlight(1))
+        self.assertEqual(m["attempt"], 1)
+        self.assertIs(other.popDue(self.now + 5), m)
+        other.acknowledge(1)
+        self.assertEqual(other.readyMessages(), [waiting])
+
+class DeficitRoundRobinTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.queue = RadioQueue(clock=lambda: self.now, quantum=100)
+
+    def push(self, destination, count, function="config", length=40):
+        return [self.queue.push(frame(length), destination, function) for n in range(count)]
+
+    def sendAndAck(self, m):
+        self.queue.markSent(m, self.now)
+        self.queue.acknowledge(m["destination"])
+
+    def test_keeps_turn_while_credit_lasts(self):
+        burst = self.push(1, 3)
+        other = self.push(2, 1)
+        self.assertEqual(self.queue.readyMessages(), [burst[0], other[0]])
+        self.sendAndAck(burst[0])
+        self.assertEqual(self.queue.inTurn[2], 1)
+        self.assertEqual(self.queue.readyMessages(), [burst[1], other[0]])
+        self.sendAndAck(burst[1])
+        self.assertIsNone(self.queue.inTurn[2])
+        self.assertEqual(self.queue.deficit[1], 120)
+        self.assertEqual(self.queue.readyMessages(), [other[0], burst[2]])
+
+    def test_others_served_while_turn_waits_for_ack(self):
+        burst = self.push(1, 3)
+        other = self.push(2, 1)
+        self.sendAndAck(burst[0])
+        self.queue.markSent(burst[1], self.now)
+        self.assertEqual(self.queue.readyMessages(), [other[0]])
+        self.assertEqual(self.queue.nextDue(), 0)
+
+    def test_one_destination_per_class_has_the_turn(self):
+        first = self.push(1, 2)
+        second = self.push(2, 2)
+        self.queue.markSent(first[0], self.now)
+        self.queue.markSent(second[0], self.now)
+        self.queue.acknowledge(1)
+        self.queue.acknowledge(2)
+        self.assertEqual(self.queue.inTurn[2], 1)
+        self.assertEqual(self.queue.deficit[2], 160)
+        self.assertEqual(self.queue.readyMessages(), [first[1], second[1]])
+
+    def test_classes_take_turns_separately(self):
+        configs = self.push(1, 2)
+        starts = self.push(2, 2, "start")
+        self.sendAndAck(configs[0])
+        self.sendAndAck(starts[0])
+        self.assertEqual(self.queue.inTurn[1:3], [2, 1])
+        self.assertEqual(self.queue.readyMessages(), [starts[1], configs[1]])
+
+    def test_credit_is_dropped_when_queue_empties(self):
+        m, = self.push(1, 1)
+        self.sendAndAck(m)
+        self.assertNotIn(1, self.queue.deficit)
+        self.push(1, 1)
+        self.assertEqual(self.queue.deficit[1], 100)
+
+    def test_removing_turn_holder_ends_turn(self):
+        burst = self.push(1, 3)
+        other = self.push(2, 1)
+        self.sendAndAck(burst[0])
+        self.queue.removeDestination(1)
+        self.assertIsNone(self.queue.inTurn[2])
+        self.assertEqual(self.queue.readyMessages(), [other[0]])
+
+class PackFrameTest(unittest.TestCase):
+    def test_fill_budget_is_optimal(self):
+        messages = [queued("config", n) for n in (30, 25, 20, 15)]
+        self.assertEqual(lengths(fillBudget(messages, 60)), [25, 20, 15])
+
+    def test_fill_budget_prefers_earlier_messages(self):
+        messages = [queued("config", n) for n in (20, 20, 20, 20)]
+        self.assertEqual(fillBudget(messages, 45), messages[:2])
+
+    def test_classes_in_priority_order(self):
+        config = queued("config", 30, 1)
+        battery = queued("send_battery", 12, 2)
+        ack = queued("ack", 12, 3)
+        grant = queued("include_grant", 20, 4)
+        self.assertEqual(packFrame([config, battery, ack, grant], 60), [ack, grant, battery])
+        bigConfig = queued("config", 40, 1)
+        self.assertEqual(packFrame([battery, bigConfig, ack], 60), [ack, bigConfig])
+
+    def test_used_bytes_count_against_budget(self):
+        messages = [queued("config", 30), queued("config", 20)]
+        self.assertEqual(lengths(packFrame(messages, 60, 35)), [20])
+        self.assertEqual(packFrame(messages, 60, 50), [])
+
+    def test_oversized_message_is_sent_alone(self):
+        big = queued("config", 80)
+        self.assertEqual(packFrame([big, queued("config", 10)], 60), [big])
+        self.assertEqual(lengths(packFrame([queued("ack", 12), big], 60)), [12])
+
+    def test_only_max_candidates_per_class_are_considered(self):
+        configs = [queued("config", 1, d) for d in range(MAX_CANDIDATES + 4)]
+        ack = queued("ack", 12)
+        chosen = packFrame(configs + [ack], 60)
+        self.assertEqual(chosen, [ack] + configs[:MAX_CANDIDATES])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# test_spur_rssi.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of matching the adaptor's rssi responses to get_rssi requests.
+Run with python -m unittest test_spur_rssi.
+"""
+
+import unittest
+from spur_rssi import RssiRequests
+
+class Timer(object):
+    def __init__(self, when, func, args):
+        self.when      = when
+        self.func      = func
+        self.args      = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Clock(object):
+    """ callLater with time that only moves when advance() is called. """
+    def __init__(self):
+        self.now    = 0
+        self.timers = []
+
+    def callLater(self, delay, func, *args):
+        t = Timer(self.now + delay, func, args)
+        self.timers.append(t)
+        return t
+
+    def advance(self, seconds):
+        self.now += seconds
+        due = sorted((t for t in self.timers if t.when <= self.now and not t.cancelled), key=lambda t: t.when)
+        self.timers = [t for t in self.timers if t.when > self.now and not t.cancelled]
+        for t in due:
+            t.func(*t.args)
+
+class RssiRequestsTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.sent = 0
+        self.answers = []
+        self.requests = RssiRequests(self.send, self.clock.callLater, timeout=2)
+
+    def send(self):
+        self.sent += 1
+
+    def answer(self, rssi, name):
+        self.answers.append((name, rssi))
+
+    def test_in_order(self):
+        self.requests.request(self.answer, "a")
+        self.requests.request(self.answer, "b")
+        self.assertTrue(self.requests.onResponse(-60))
+        self.assertTrue(self.requests.onResponse(-70))
+        self.assertEqual(self.answers, [("a", -60), ("b", -70)])
+        self.assertFalse(self.requests.onResponse(-80))
+
+    def test_late_response_is_not_matched_to_next_request(self):
+        self.requests.request(self.answer, "a")
+        self.clock.advance(3)
+        self.assertEqual(self.answers, [("a", None)])
+        self.requests.request(self.answer, "b")
+        self.assertTrue(self.requests.onResponse(-60))     # a's late answer
+        self.assertTrue(self.requests.onResponse(-70))
+        self.assertEqual(self.answers, [("a", None), ("b", -70)])
+        self.assertEqual(self.requests.discarded, 1)
+
+    def test_late_response_with_nothing_outstanding(self):
+        self.requests.request(self.answer, "a")
+        self.clock.advance(3)
+        self.assertTrue(self.requests.onResponse(-60))
+        self.assertFalse(self.requests.onResponse(-70))
+
+    def test_unanswered_timeout_is_forgotten(self):
+        self.requests.request(self.answer, "a")
+        self.clock.advance(3)
+        self.clock.advance(2)                              # a is never answered
+        self.requests.request(self.answer, "b")
+        self.assertTrue(self.requests.onResponse(-70))
+        self.assertEqual(self.answers, [("a", None), ("b", -70)])
+        self.assertEqual(self.requests.discarded, 0)
+
+if __name__ == "__main__":
+    unittest.main()
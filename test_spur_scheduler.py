@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# test_spur_scheduler.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of transmit tick scheduling.
+Run with python -m unittest test_spur_scheduler.
+"""
+
+import random
+import unittest
+from spur_scheduler import TxScheduler, TX_SPACING, FIRST_BEACON_SLOTS
+from test_spur_rssi import Clock
+
+STEP = 0.05
+SLACK = 2 * STEP                        # Ticks run on the first step after they are due
+
+class TxSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.sent = []              # (time, beacon)
+        self.lags = []
+        self.due = None             # What nextDue returns
+        self.scheduler = TxScheduler(self.clock.callLater, self.send, lambda: self.due, clock=lambda: self.clock.now, \
+                                     lag=lambda seconds, beacon: self.lags.append(seconds), rng=random.Random(1))
+
+    def send(self, beacon):
+        self.sent.append((self.clock.now, beacon))
+        if self.due is not None and self.due <= self.clock.now:
+            self.due = None
+
+    def runFor(self, seconds):
+        end = self.clock.now + seconds
+        while self.clock.now < end - 1e-9:
+            self.clock.advance(STEP)
+
+    def idle(self):
+        """ Starts the scheduler and runs it past its first tick and beacon. """
+        self.scheduler.start(1)
+        self.runFor(5)
+        self.sent = []
+
+    def test_idle_sends_only_beacons(self):
+        self.scheduler.start(1)
+        self.runFor(60)
+        self.assertAlmostEqual(self.sent[0][0], 1)
+        self.assertFalse(self.sent[0][1])
+        self.assertTrue(all(beacon for t, beacon in self.sent[1:]))
+        self.assertAlmostEqual(self.sent[1][0], 1 + FIRST_BEACON_SLOTS * TX_SPACING, delta=SLACK)
+        gaps = [b[0] - a[0] for a, b in zip(self.sent[1:], self.sent[2:])]
+        self.assertTrue(all(5.5 <= g <= 6.5 + SLACK for g in gaps), gaps)
+
+    def test_kick_sends_promptly(self):
+        self.idle()
+        self.due = 0
+        self.scheduler.kick()
+        self.runFor(STEP)
+        self.assertEqual(len(self.sent), 1)
+        self.assertFalse(self.sent[0][1])
+        self.assertAlmostEqual(self.sent[0][0], 5, delta=SLACK)
+
+    def test_ticks_are_spaced(self):
+        self.idle()
+        self.due = 0
+        self.scheduler.kick()
+        self.runFor(STEP)
+        self.due = 0
+        self.scheduler.kick()
+        self.scheduler.kick()
+        self.runFor(1)
+        self.assertEqual(len(self.sent), 2)
+        self.assertAlmostEqual(self.sent[1][0] - self.sent[0][0], TX_SPACING, delta=SLACK)
+
+    def test_tick_when_retry_is_due(self):
+        self.idle()
+        self.due = 7.0
+        self.scheduler.kick()
+        self.runFor(3)
+        times = [t for t, beacon in self.sent if not beacon]
+        self.assertEqual(len(times), 2)
+        self.assertAlmostEqual(times[1], 7.0, delta=SLACK)
+
+    def test_lag_is_reported(self):
+        self.scheduler.start(1)
+        self.runFor(30)
+        self.assertEqual(len(self.lags), len(self.sent))
+        self.assertTrue(all(0 <= lag <= SLACK for lag in self.lags))
+
+if __name__ == "__main__":
+    unittest.main()
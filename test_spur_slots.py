@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# test_spur_slots.py
+"""
+Copyright (c) 2015 ContinuumBridge Limited
+
+Tests of spreading button wakeups over slots.
+Run with python -m unittest test_spur_slots.
+"""
+
+import unittest
+from spur_slots import WakeupPlanner, SLOT_LENGTH, WAKEUP_AIRTIME
+
+WAKEUP = 300                            # 600 seconds, in button units
+
+class WakeupPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.planner = WakeupPlanner(jitter=0.1)
+
+    def test_empty_slot_keeps_interval(self):
+        self.assertEqual(self.planner.plan(1, 0, WAKEUP), WAKEUP)
+        self.assertEqual(self.planner.expected, {1: 60})
+        self.assertEqual(self.planner.moved, 0)
+
+    def test_crowded_slot_is_avoided(self):
+        self.planner.plan(1, 0, WAKEUP)
+        self.assertEqual(self.planner.plan(2, 0, WAKEUP), 297)
+        self.assertEqual(self.planner.plan(3, 0, WAKEUP), 292)
+        self.assertEqual(self.planner.expected, {1: 60, 2: 59, 3: 58})
+        self.assertEqual(self.planner.moved, 2)
+
+    def test_never_lengthened_or_shortened_beyond_jitter(self):
+        for addr in range(200):
+            wakeup = self.planner.plan(addr, 0, WAKEUP)
+            self.assertTrue(WAKEUP * 0.9 <= wakeup <= WAKEUP, wakeup)
+        self.assertEqual(len(self.planner), 200)
+        self.assertEqual(sum(self.planner.counts.values()), 200)
+
+    def test_replan_forgets_previous_slot(self):
+        self.planner.plan(1, 0, WAKEUP)
+        self.assertEqual(self.planner.plan(1, 0, WAKEUP), WAKEUP)
+        self.assertEqual(self.planner.counts[60], 1)
+
+    def test_forget(self):
+        self.planner.plan(1, 0, WAKEUP)
+        self.planner.forget(1)
+        self.planner.forget(2)
+        self.assertEqual(len(self.planner), 0)
+        self.assertEqual(self.planner.counts[60], 0)
+        self.assertEqual(self.planner.plan(2, 0, WAKEUP), WAKEUP)
+
+    def test_only_some_slots_are_candidates(self):
+        planner = WakeupPlanner(jitter=0.5)
+        planner.plan(1, 0, 5000)
+        self.assertEqual(planner.plan(2, 0, 5000), 4847)
+        self.assertEqual(planner.expected[2], 969)
+
+    def test_prune(self):
+        for addr in range(3):
+            self.planner.plan(addr, 0, WAKEUP)
+        self.planner.prune(60 * SLOT_LENGTH)
+        self.assertEqual(self.planner.counts, {60: 1})
+        self.planner.forget(1)
+        self.assertEqual(self.planner.counts, {60: 1})
+        self.assertEqual(len(self.planner), 2)
+
+    def test_stats(self):
+        self.assertEqual(self.planner.stats()["peak_per_slot"], 0)
+        self.assertIsNone(self.planner.stats()["mean_per_used_slot"])
+        planner = WakeupPlanner(jitter=0)
+        for addr in range(3):
+            planner.plan(addr, 0, WAKEUP)
+        planner.plan(3, 0, WAKEUP // 2)
+        stats = planner.stats()
+        self.assertEqual((stats["nodes"], stats["slots_used"], stats["peak_per_slot"], stats["shortened"]), (4, 2, 3, 0))
+        self.assertEqual(stats["mean_per_used_slot"], 2.0)
+        self.assertAlmostEqual(stats["peak_utilisation"], 3 * WAKEUP_AIRTIME / SLOT_LENGTH)
+
+if __name__ == "__main__":
+    unittest.main()